@@ -9,25 +9,30 @@ def parse_args():
     arg_parser.add_argument('--output_type', default='xml',
                             help=('Dataset output type (valid values are: csv, ner, multiner, classification, '
                                   'multi_classification)'))
+    arg_parser.add_argument('--workers', type=int, default=1,
+                            help='Number of worker processes to convert documents with (default: 1, no pool)')
+    arg_parser.add_argument('--streaming', action='store_true',
+                            help='Parse the XML file one document at a time to keep the memory usage bounded')
     return arg_parser.parse_args()
 
 
 def main():
     args = parse_args()
-    dataset = hedge_dataset.HedgeDataset.from_xml_file(args.dataset_xml)
+    dataset_class = hedge_dataset.StreamingHedgeDataset if args.streaming else hedge_dataset.HedgeDataset
+    dataset = dataset_class.from_xml_file(args.dataset_xml)
     if args.output_type == 'multiner':
-        dataset.convert_to_multiple_ner_files(args.dataset_out)
+        dataset.convert_to_multiple_ner_files(args.dataset_out, workers=args.workers)
         return
     elif args.output_type == 'multi_classification':
-        dataset.convert_to_multiple_classification_tsv_files(args.dataset_out)
+        dataset.convert_to_multiple_classification_tsv_files(args.dataset_out, workers=args.workers)
         return
     with open(args.dataset_out, 'w', encoding='utf-8') as dataset_out:
         if args.output_type == 'csv':
-            dataset.convert_to_csv(dataset_out)
+            dataset.convert_to_csv(dataset_out, workers=args.workers)
         elif args.output_type == 'ner':
-            dataset.convert_to_ner_txt(dataset_out)
+            dataset.convert_to_ner_txt(dataset_out, workers=args.workers)
         elif args.output_type == 'classification':
-            dataset.convert_to_sequence_classification_tsv(dataset_out)
+            dataset.convert_to_sequence_classification_tsv(dataset_out, workers=args.workers)
         else:
             raise ValueError(
                 'Wrong dataset output type, expected: csv, ner, multiner, classification, multi_classification')
@@ -1,4 +1,8 @@
 import csv
+import io
+import itertools
+import multiprocessing
+from typing import Iterable, Iterator
 
 import spacy.tokens
 from lxml import etree
@@ -14,6 +18,9 @@ UNCERTAINTY_TO_CLASS = {
     'speculation_modal_probable_': 'EPIST',
 }
 
+# Number of sentences processed by a single nlp.pipe batch.
+NLP_BATCH_SIZE = 256
+
 
 def _match_uncertainty_tokens(doc, uncertain_spans, uncertainty_types):
     current_uncertain_span_i = 0
@@ -42,81 +49,163 @@ def _get_token_class(is_uncertain, current_uncertainty_span_idx, prev_uncertaint
     return class_string + '-' + uncertainty_class
 
 
+def _sentence_to_text_and_uncertainty_spans(element):
+    full_text = element.text or ''
+    uncertainty_spans = []
+    uncertainty_types = []
+    for ccue_element in element.iterchildren():
+        uncertainty_types.append(ccue_element.attrib['type'])
+
+        span_begin = len(full_text)
+        full_text += ccue_element.text or ''
+        span_end = len(full_text)
+        full_text += ccue_element.tail or ''
+        uncertainty_spans.append((span_begin, span_end))
+    return full_text, uncertainty_spans, uncertainty_types
+
+
+def _document_to_csv(document):
+    out_file_obj = io.StringIO()
+    csv_file = csv.writer(out_file_obj)
+    document_id = next(document.iterchildren('DocID'))
+    document_type = document_id.attrib['type']
+    document_id = document_id.text
+
+    all_sentences_iter = document.iterdescendants('Sentence')
+    all_parsed_sentences = HedgeDataset.sentences_to_tagged_tokens(all_sentences_iter)
+    for sentence_i, parsed_sentence in enumerate(all_parsed_sentences):
+        for token in parsed_sentence:
+            token_i = token.i
+            token_text = token.text
+            is_untertain = token._.is_uncertain
+            uncertainty_type = token._.uncertainty_type
+            row = (document_id, document_type, sentence_i, token_i, token_text, is_untertain, uncertainty_type)
+            csv_file.writerow(row)
+    return out_file_obj.getvalue()
+
+
+def _document_to_ner_txt(document):
+    out_file_obj = io.StringIO()
+    all_sentences_iter = document.iterdescendants('Sentence')
+    all_parsed_sentences = HedgeDataset.sentences_to_tagged_tokens(all_sentences_iter)
+    for parsed_sentence in all_parsed_sentences:
+        prev_uncertainty_span_idx = None
+        for token in parsed_sentence:
+            token_text = token.text
+            is_uncertain = token._.is_uncertain
+            current_uncertainty_span_idx = token._.uncertainty_span_idx
+            uncertainty_type = token._.uncertainty_type
+            uncertainty_class = _get_token_class(is_uncertain, current_uncertainty_span_idx,
+                                                 prev_uncertainty_span_idx, uncertainty_type)
+
+            print(token_text, uncertainty_class, file=out_file_obj)
+            prev_uncertainty_span_idx = current_uncertainty_span_idx
+
+        # Sentence end, print empty line
+        print(file=out_file_obj)
+    return out_file_obj.getvalue()
+
+
+def _document_to_sequence_classification_tsv(document):
+    out_file_obj = io.StringIO()
+    tsv_writer = csv.writer(out_file_obj, delimiter='\t')
+    all_sentences_iter = document.iterdescendants('Sentence')
+    for sentence_i, sentence in enumerate(all_sentences_iter):
+        is_uncertain = int(sentence.find('ccue') is not None)
+        full_text = ''.join(sentence.itertext())
+        tsv_writer.writerow([full_text, is_uncertain])
+    return out_file_obj.getvalue()
+
+
+def _convert_serialized_document(function_and_document):
+    # lxml elements can't be pickled, so documents are sent to worker processes as XML strings.
+    # Every worker process lazily creates its own nlp_module.nlp(tokenizer_only=True) instance.
+    document_function, document_xml = function_and_document
+    return document_function(etree.fromstring(document_xml))
+
+
+def _iterparse_documents(source):
+    for _, document in etree.iterparse(source, events=('end',), tag='Document'):
+        yield document
+        # The document is converted by now, free it and all the previous documents already removed from the tree.
+        document.clear()
+        while document.getprevious() is not None:
+            del document.getparent()[0]
+
+
 class HedgeDataset(object):
+    # Number of documents sent to a worker process at once.
+    WORKER_CHUNK_SIZE = 8
+    # Number of worker chunks serialized ahead of time, bounds the memory used by documents waiting in the pool.
+    WORKER_CHUNKS_IN_FLIGHT = 4
+
     def __init__(self, root):
         self.root = root
 
-    def convert_to_csv(self, out_file):
+    def documents(self):
         # Convert to a list to know the full size
-        documents_iterator = list(self.root.iterdescendants('Document'))
+        return list(self.root.iterdescendants('Document'))
+
+    def convert_documents(self, document_function, documents_iterator=None, use_tqdm=True, workers=1):
+        """Applies document_function to every document and yields the results in the original document order.
+
+        If workers > 1, the documents are sharded across a process pool of this size.
+        """
+        if documents_iterator is None:
+            documents_iterator = self.documents()
+        if workers <= 1:
+            if use_tqdm:
+                documents_iterator = tqdm.tqdm(documents_iterator, desc='Converting documents')
+            for document in documents_iterator:
+                yield document_function(document)
+            return
+
+        total_documents = len(documents_iterator) if hasattr(documents_iterator, '__len__') else None
+        documents_iterator = iter(documents_iterator)
+        window_size = workers * self.WORKER_CHUNK_SIZE * self.WORKER_CHUNKS_IN_FLIGHT
+        progress_bar = tqdm.tqdm(total=total_documents, desc='Converting documents', disable=not use_tqdm)
+        with multiprocessing.Pool(workers) as pool, progress_bar:
+            while True:
+                # Pool.imap consumes its whole input at once, so feed it a bounded window of documents at a time.
+                serialized_documents = [(document_function, etree.tostring(document, with_tail=False))
+                                        for document in itertools.islice(documents_iterator, window_size)]
+                if not serialized_documents:
+                    break
+                for converted_document in pool.imap(_convert_serialized_document, serialized_documents,
+                                                    chunksize=self.WORKER_CHUNK_SIZE):
+                    progress_bar.update()
+                    yield converted_document
+
+    def convert_to_csv(self, out_file, workers=1):
         csv_file = csv.writer(out_file)
         csv_file.writerow(
             ('doc_id', 'doc_type', 'sentence_id', 'token_id', 'token', 'is_uncertain', 'uncertainty_type')
         )
-        for document in tqdm.tqdm(documents_iterator, desc='Converting documents'):
-            document_id = next(document.iterchildren('DocID'))
-            document_type = document_id.attrib['type']
-            document_id = document_id.text
-
-            all_sentences_iter = document.iterdescendants('Sentence')
-            for sentence_i, sentence in tqdm.tqdm(enumerate(all_sentences_iter)):
-                parsed_sentence = self.sentence_to_tagged_tokens(sentence)
-                for token in parsed_sentence:
-                    token_i = token.i
-                    token_text = token.text
-                    is_untertain = token._.is_uncertain
-                    uncertainty_type = token._.uncertainty_type
-                    row = (document_id, document_type, sentence_i, token_i, token_text, is_untertain, uncertainty_type)
-                    csv_file.writerow(row)
-
-    def convert_to_ner_txt(self, out_file_obj, documents_iterator=None, use_tqdm=True):
-        if documents_iterator is None:
-            documents_iterator = list(self.root.iterdescendants('Document'))
-        if use_tqdm:
-            documents_iterator = tqdm.tqdm(documents_iterator, desc='Converting documents')
-        for document in documents_iterator:
-            all_sentences_iter = document.iterdescendants('Sentence')
-            for sentence_i, sentence in enumerate(all_sentences_iter):
-                parsed_sentence = self.sentence_to_tagged_tokens(sentence)
-                prev_uncertainty_span_idx = None
-                for token in parsed_sentence:
-                    token_text = token.text
-                    is_uncertain = token._.is_uncertain
-                    current_uncertainty_span_idx = token._.uncertainty_span_idx
-                    uncertainty_type = token._.uncertainty_type
-                    uncertainty_class = _get_token_class(is_uncertain, current_uncertainty_span_idx,
-                                                         prev_uncertainty_span_idx, uncertainty_type)
-
-                    print(token_text, uncertainty_class, file=out_file_obj)
-                    prev_uncertainty_span_idx = current_uncertainty_span_idx
-
-                # Sentence end, print empty line
-                print(file=out_file_obj)
-
-    def convert_to_multiple(self, out_file_pattern, function):
-        documents_iterator = list(self.root.iterdescendants('Document'))
-        for i, document in enumerate(tqdm.tqdm(documents_iterator, desc='Converting documents'), 1):
+        for converted_document in self.convert_documents(_document_to_csv, workers=workers):
+            out_file.write(converted_document)
+
+    def convert_to_ner_txt(self, out_file_obj, documents_iterator=None, use_tqdm=True, workers=1):
+        for converted_document in self.convert_documents(_document_to_ner_txt, documents_iterator, use_tqdm,
+                                                         workers):
+            out_file_obj.write(converted_document)
+
+    def convert_to_multiple(self, out_file_pattern, document_function, workers=1):
+        converted_documents = self.convert_documents(document_function, workers=workers)
+        for i, converted_document in enumerate(converted_documents, 1):
             with open(out_file_pattern.format(i), 'w', encoding='utf-8') as out_file_i:
-                function(out_file_i, documents_iterator=[document], use_tqdm=False)
+                out_file_i.write(converted_document)
 
-    def convert_to_multiple_ner_files(self, out_file_pattern):
-        self.convert_to_multiple(out_file_pattern, self.convert_to_ner_txt)
+    def convert_to_multiple_ner_files(self, out_file_pattern, workers=1):
+        self.convert_to_multiple(out_file_pattern, _document_to_ner_txt, workers)
 
-    def convert_to_sequence_classification_tsv(self, out_file_obj, documents_iterator=None, use_tqdm=True):
-        if documents_iterator is None:
-            documents_iterator = list(self.root.iterdescendants('Document'))
-        if use_tqdm:
-            documents_iterator = tqdm.tqdm(documents_iterator, desc='Converting documents')
-        tsv_writer = csv.writer(out_file_obj, delimiter='\t')
-        for document in documents_iterator:
-            all_sentences_iter = document.iterdescendants('Sentence')
-            for sentence_i, sentence in enumerate(all_sentences_iter):
-                is_uncertain = int(sentence.find('ccue') is not None)
-                full_text = ''.join(sentence.itertext())
-                tsv_writer.writerow([full_text, is_uncertain])
-
-    def convert_to_multiple_classification_tsv_files(self, out_file_pattern):
-        self.convert_to_multiple(out_file_pattern, self.convert_to_sequence_classification_tsv)
+    def convert_to_sequence_classification_tsv(self, out_file_obj, documents_iterator=None, use_tqdm=True,
+                                               workers=1):
+        for converted_document in self.convert_documents(_document_to_sequence_classification_tsv,
+                                                         documents_iterator, use_tqdm, workers):
+            out_file_obj.write(converted_document)
+
+    def convert_to_multiple_classification_tsv_files(self, out_file_pattern, workers=1):
+        self.convert_to_multiple(out_file_pattern, _document_to_sequence_classification_tsv, workers)
 
     @classmethod
     def from_xml_file(cls, source):
@@ -126,21 +215,44 @@ class HedgeDataset(object):
 
     @classmethod
     def sentence_to_tagged_tokens(cls, element: etree.Element) -> spacy.tokens.Doc:
-        nlp = nlp_module.nlp()
-
-        full_text = element.text or ''
-        uncertainty_spans = []
-        uncertainty_types = []
-        for ccue_element in element.iterchildren():
-            uncertainty_types.append(ccue_element.attrib['type'])
-
-            span_begin = len(full_text)
-            full_text += ccue_element.text or ''
-            span_end = len(full_text)
-            full_text += ccue_element.tail or ''
-            uncertainty_spans.append((span_begin, span_end))
+        nlp = nlp_module.nlp(tokenizer_only=True)
 
+        full_text, uncertainty_spans, uncertainty_types = _sentence_to_text_and_uncertainty_spans(element)
         parsed_text = nlp(full_text)
         _match_uncertainty_tokens(parsed_text, uncertainty_spans, uncertainty_types)
 
         return parsed_text
+
+    @classmethod
+    def sentences_to_tagged_tokens(cls, elements: Iterable[etree.Element],
+                                   batch_size: int = NLP_BATCH_SIZE) -> Iterator[spacy.tokens.Doc]:
+        """Same as sentence_to_tagged_tokens, but runs many sentences through nlp.pipe in batches."""
+        nlp = nlp_module.nlp(tokenizer_only=True)
+
+        texts_with_spans = (
+            (full_text, (uncertainty_spans, uncertainty_types))
+            for full_text, uncertainty_spans, uncertainty_types
+            in map(_sentence_to_text_and_uncertainty_spans, elements)
+        )
+        parsed_texts = nlp.pipe(texts_with_spans, as_tuples=True, batch_size=batch_size)
+        for parsed_text, (uncertainty_spans, uncertainty_types) in parsed_texts:
+            _match_uncertainty_tokens(parsed_text, uncertainty_spans, uncertainty_types)
+            yield parsed_text
+
+
+class StreamingHedgeDataset(HedgeDataset):
+    """HedgeDataset that parses one Document at a time with etree.iterparse.
+
+    Processed documents are cleared from the tree, so the memory usage doesn't grow with the XML file size.
+    """
+
+    def __init__(self, source):
+        super().__init__(root=None)
+        self.source = source
+
+    def documents(self):
+        return _iterparse_documents(self.source)
+
+    @classmethod
+    def from_xml_file(cls, source):
+        return cls(source)
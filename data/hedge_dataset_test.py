@@ -64,6 +64,24 @@ class MyTestCase(unittest.TestCase):
         parsed_sentence = hedge_dataset.HedgeDataset.sentence_to_tagged_tokens(element)
         self.assertEqual(parsed_sentence[0]._.uncertainty_type, 'speculation')
 
+    def test_sentences_to_tagged_tokens_returns_same_tokens_as_single_sentence_parsing(self):
+        elements = [
+            etree.fromstring('<Sentence>A cat <ccue type="speculation one">maybe</ccue> does a roll.</Sentence>'),
+            etree.fromstring('<Sentence>No uncertainty here.</Sentence>'),
+            etree.fromstring(('<Sentence><ccue type="speculation one">Maybe, but not sure</ccue> a cat '
+                              'does a barrel roll, <ccue type="speculation two">not sure</ccue>.</Sentence>')),
+        ]
+        parsed_sentences = list(hedge_dataset.HedgeDataset.sentences_to_tagged_tokens(elements, batch_size=2))
+        self.assertEqual(len(parsed_sentences), len(elements))
+        for element, parsed_sentence in zip(elements, parsed_sentences):
+            expected_sentence = hedge_dataset.HedgeDataset.sentence_to_tagged_tokens(element)
+            self.assertSequenceEqual(
+                [(tok.text, tok._.is_uncertain, tok._.uncertainty_type, tok._.uncertainty_span_idx)
+                 for tok in parsed_sentence],
+                [(tok.text, tok._.is_uncertain, tok._.uncertainty_type, tok._.uncertainty_span_idx)
+                 for tok in expected_sentence],
+            )
+
     def test_convert_to_csv_returns_tagged_sentences(self):
         element = etree.fromstring(
             '''<Annotation>
@@ -206,6 +224,83 @@ class MyTestCase(unittest.TestCase):
 
         self.assertEqual(result_txt, expected_result)
 
+    def test_convert_to_ner_txt_with_workers_returns_same_txt_as_serial(self):
+        element = etree.fromstring(
+            '''<Annotation>
+                <DocumentSet>
+                    <Document>
+                        <DocID type="test_doc">test_doc_id1</DocID>
+                        <Sentence>A <ccue type="speculation_hypo_condition _">m1 m2</ccue> B C</Sentence>
+                    </Document>
+                    <Document>
+                        <DocID type="test_doc">test_doc_id2</DocID>
+                        <Sentence>D <ccue type="speculation_hypo_doxastic _">m3</ccue> E</Sentence>
+                        <Sentence>F G</Sentence>
+                    </Document>
+                    <Document>
+                        <DocID type="test_doc">test_doc_id3</DocID>
+                        <Sentence><ccue type="speculation_modal_possible_">m4</ccue> H</Sentence>
+                    </Document>
+                </DocumentSet>
+            </Annotation>'''
+        )
+        ds = hedge_dataset.HedgeDataset(element)
+        serial_output_file = io.StringIO()
+        ds.convert_to_ner_txt(serial_output_file)
+        parallel_output_file = io.StringIO()
+        ds.convert_to_ner_txt(parallel_output_file, workers=2)
+
+        self.assertEqual(parallel_output_file.getvalue(), serial_output_file.getvalue())
+
+    def test_convert_to_sequence_classification_with_workers_returns_same_tsv_as_serial(self):
+        element = etree.fromstring(
+            '''<Annotation>
+                <DocumentSet>
+                    <Document>
+                        <DocID type="test_doc">test_doc_id1</DocID>
+                        <Sentence>Uncertain sentence <ccue type="speculation_hypo_condition _">m1 m2</ccue> B C</Sentence>
+                    </Document>
+                    <Document>
+                        <DocID type="test_doc">test_doc_id2</DocID>
+                        <Sentence>Certain sentence A B C</Sentence>
+                        <Sentence>Certain sentence D E F</Sentence>
+                    </Document>
+                    <Document>
+                        <DocID type="test_doc">test_doc_id3</DocID>
+                        <Sentence><ccue type="speculation_hypo_investigation _">m3 m4</ccue> A</Sentence>
+                    </Document>
+                </DocumentSet>
+            </Annotation>'''
+        )
+        ds = hedge_dataset.HedgeDataset(element)
+        serial_output_file = io.StringIO()
+        ds.convert_to_sequence_classification_tsv(serial_output_file)
+        parallel_output_file = io.StringIO()
+        ds.convert_to_sequence_classification_tsv(parallel_output_file, workers=2)
+
+        self.assertEqual(parallel_output_file.getvalue(), serial_output_file.getvalue())
+
+    def test_streaming_dataset_convert_to_ner_txt_returns_same_txt_as_in_memory_dataset(self):
+        xml = b'''<Annotation>
+                <DocumentSet>
+                    <Document>
+                        <DocID type="test_doc">test_doc_id1</DocID>
+                        <Sentence>A <ccue type="speculation_hypo_condition _">m1 m2</ccue> B C</Sentence>
+                    </Document>
+                    <Document>
+                        <DocID type="test_doc">test_doc_id2</DocID>
+                        <Sentence>D <ccue type="speculation_hypo_doxastic _">m3</ccue> E</Sentence>
+                        <Sentence>F G</Sentence>
+                    </Document>
+                </DocumentSet>
+            </Annotation>'''
+        in_memory_output_file = io.StringIO()
+        hedge_dataset.HedgeDataset.from_xml_file(io.BytesIO(xml)).convert_to_ner_txt(in_memory_output_file)
+        streaming_output_file = io.StringIO()
+        hedge_dataset.StreamingHedgeDataset.from_xml_file(io.BytesIO(xml)).convert_to_ner_txt(streaming_output_file)
+
+        self.assertEqual(streaming_output_file.getvalue(), in_memory_output_file.getvalue())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,117 @@
+import asyncio
+import concurrent.futures
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BatchingPredictor(object):
+    """Coalesces the sentences of concurrent requests into shared Model.predict_sentences calls.
+
+    A batch is started by the first queued sentence and runs as soon as it has max_batch_size sentences
+    or max_wait_ms have passed. By default all batches run one after another in a single worker thread, so
+    concurrent requests don't compete for the CPU threads used by torch. With an executor of several workers
+    (see process_pool.create_inference_pool) up to max_concurrent_batches batches run at the same time,
+    predict_function is then the picklable function that runs Model.predict_sentences in a worker.
+    """
+
+    def __init__(self, model, max_batch_size=32, max_wait_ms=5.0, executor=None, predict_function=None,
+                 max_concurrent_batches=1):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_concurrent_batches = max_concurrent_batches
+        self._queue = None
+        self._batch_slots = None
+        self._batching_task = None
+        self._batch_tasks = set()
+        self._executor = executor or concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._predict_function = predict_function or model.predict_sentences
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._batch_slots = asyncio.Semaphore(self.max_concurrent_batches)
+        self._batching_task = asyncio.ensure_future(self._run_batches())
+
+    async def stop(self):
+        for task in [self._batching_task, *self._batch_tasks]:
+            task.cancel()
+        for task in [self._batching_task, *self._batch_tasks]:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait=True)
+
+    async def predict_sentences(self, sentences_texts):
+        """Returns (preds_lists, offset_mappings) like Model.predict_sentences."""
+        loop = asyncio.get_event_loop()
+        futures = []
+        for sentence_text in sentences_texts:
+            future = loop.create_future()
+            self._queue.put_nowait((sentence_text, future))
+            futures.append(future)
+        sentence_predictions = await asyncio.gather(*futures)
+        preds_lists = [preds_list for preds_list, _ in sentence_predictions]
+        offset_mappings = [offset_mapping for _, offset_mapping in sentence_predictions]
+        return preds_lists, offset_mappings
+
+    async def predict_text(self, text):
+        # Sentence splitting and merging take long for large texts, so they run in the default executor to keep
+        # the event loop (other requests and the batching) responsive. Only the sentences are queued here.
+        loop = asyncio.get_event_loop()
+        sentences = await loop.run_in_executor(None, self.model.split_sentences, text)
+        preds_lists, offset_mappings = await self.predict_sentences([sent.text for sent in sentences])
+        return await loop.run_in_executor(None, self.model.merge_sentence_predictions,
+                                          sentences, preds_lists, offset_mappings)
+
+    async def _next_batch(self):
+        loop = asyncio.get_event_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # Requests that were cancelled in the meantime (e.g. the client disconnected) don't need predictions.
+        return [(sentence_text, future) for sentence_text, future in batch if not future.done()]
+
+    async def _predict_batch(self, batch):
+        loop = asyncio.get_event_loop()
+        sentences_texts = [sentence_text for sentence_text, _ in batch]
+        try:
+            preds_lists, offset_mappings = await loop.run_in_executor(
+                self._executor, self._predict_function, sentences_texts)
+        except Exception as e:
+            logger.exception('Prediction of a batch of %d sentences failed', len(batch))
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), preds_list, offset_mapping in zip(batch, preds_lists, offset_mappings):
+            if not future.done():
+                future.set_result((preds_list, offset_mapping))
+
+    def _finish_batch(self, task):
+        self._batch_tasks.discard(task)
+        self._batch_slots.release()
+
+    async def _run_batches(self):
+        while True:
+            # Collect the next batch only when it can run, sentences keep coming in the meantime.
+            await self._batch_slots.acquire()
+            batch = await self._next_batch()
+            if not batch:
+                self._batch_slots.release()
+                continue
+            task = asyncio.ensure_future(self._predict_batch(batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._finish_batch)
@@ -0,0 +1,103 @@
+import asyncio
+import concurrent.futures
+import threading
+import unittest
+
+import batching
+
+
+class Sentence(object):
+    def __init__(self, text):
+        self.text = text
+
+
+class UppercaseModel(object):
+    """Tags every upper case word, records the batches it was called with."""
+
+    def __init__(self):
+        self.batches = []
+        self.text_threads = []
+
+    def split_sentences(self, text):
+        self.text_threads.append(threading.current_thread())
+        return [Sentence(sentence_text) for sentence_text in text.split('. ')]
+
+    def merge_sentence_predictions(self, sentences, preds_lists, offset_mappings):
+        self.text_threads.append(threading.current_thread())
+        return [preds for preds_list in preds_lists for preds in preds_list]
+
+    def predict_sentences(self, texts):
+        self.batches.append(list(texts))
+        preds_lists = [['B-DOX' if word.isupper() else 'O' for word in text.split()] for text in texts]
+        offset_mappings = [[(i, i + 1) for i in range(len(text.split()))] for text in texts]
+        return preds_lists, offset_mappings
+
+
+class BatchingPredictorTestCase(unittest.TestCase):
+    def _run(self, predictor, make_coroutine):
+        async def run_started():
+            await predictor.start()
+            try:
+                return await make_coroutine()
+            finally:
+                await predictor.stop()
+
+        return asyncio.run(run_started())
+
+    def test_concurrent_requests_share_a_batch(self):
+        model = UppercaseModel()
+        predictor = batching.BatchingPredictor(model, max_batch_size=8, max_wait_ms=50)
+        results = self._run(predictor, lambda: asyncio.gather(
+            predictor.predict_sentences(['a B', 'c']),
+            predictor.predict_sentences(['D e f']),
+        ))
+
+        self.assertEqual(model.batches, [['a B', 'c', 'D e f']])
+        self.assertEqual(results[0], ([['O', 'B-DOX'], ['O']], [[(0, 1), (1, 2)], [(0, 1)]]))
+        self.assertEqual(results[1], ([['B-DOX', 'O', 'O']], [[(0, 1), (1, 2), (2, 3)]]))
+
+    def test_batches_are_limited_by_max_batch_size(self):
+        model = UppercaseModel()
+        predictor = batching.BatchingPredictor(model, max_batch_size=2, max_wait_ms=50)
+        preds_lists, _ = self._run(predictor, lambda: predictor.predict_sentences(['A', 'b', 'C', 'd', 'E']))
+
+        self.assertEqual(model.batches, [['A', 'b'], ['C', 'd'], ['E']])
+        self.assertEqual(preds_lists, [['B-DOX'], ['O'], ['B-DOX'], ['O'], ['B-DOX']])
+
+    def test_batches_run_concurrently_in_executor_workers(self):
+        model = UppercaseModel()
+        # Both batches must be in predict_sentences at the same time to get through the barrier.
+        barrier = threading.Barrier(2, timeout=5)
+
+        def predict_sentences(texts):
+            barrier.wait()
+            return model.predict_sentences(texts)
+
+        predictor = batching.BatchingPredictor(model, max_batch_size=1, max_wait_ms=0,
+                                               executor=concurrent.futures.ThreadPoolExecutor(max_workers=2),
+                                               predict_function=predict_sentences, max_concurrent_batches=2)
+        preds_lists, _ = self._run(predictor, lambda: predictor.predict_sentences(['A', 'b']))
+
+        self.assertEqual(sorted(model.batches), [['A'], ['b']])
+        self.assertEqual(preds_lists, [['B-DOX'], ['O']])
+
+    def test_texts_are_split_and_merged_outside_the_event_loop(self):
+        model = UppercaseModel()
+        predictor = batching.BatchingPredictor(model, max_batch_size=8, max_wait_ms=50)
+        preds = self._run(predictor, lambda: predictor.predict_text('A b. C'))
+
+        self.assertEqual(model.batches, [['A b', 'C']])
+        self.assertEqual(preds, ['B-DOX', 'O', 'B-DOX'])
+        self.assertEqual(len(model.text_threads), 2)
+        self.assertNotIn(threading.main_thread(), model.text_threads)
+
+    def test_prediction_errors_are_raised_in_every_request_of_the_batch(self):
+        model = UppercaseModel()
+        model.predict_sentences = lambda texts: 1 / 0
+        predictor = batching.BatchingPredictor(model)
+        with self.assertRaises(ZeroDivisionError):
+            self._run(predictor, lambda: predictor.predict_sentences(['A']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+"""Compares latency, throughput and span F1 of the demo model variants on a CoNLL formatted dev set.
+
+Example:
+    python benchmark_model.py --model_path [MODEL] --labels_path ../labels.txt --dev_file [DATA]/dev.txt \
+        --export_path [EXPORTED MODEL] --variants fp32 dynamic torchscript onnx
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+import seqeval.metrics
+import torch
+
+import model
+import sentence_cache
+
+# Model arguments of every variant, torchscript and onnx are loaded from --export_path.
+VARIANTS = {
+    'fp32': {},
+    'dynamic': {'quantize': 'dynamic'},
+    'torchscript': {'backend': 'torchscript'},
+    'onnx': {'backend': 'onnx'},
+}
+
+
+def read_conll_sentences(path):
+    sentences = []
+    words, labels = [], []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('-DOCSTART-') or line == '' or line == '\n':
+                if words:
+                    sentences.append((words, labels))
+                    words, labels = [], []
+                continue
+            splits = line.split()
+            words.append(splits[0])
+            labels.append(splits[-1] if len(splits) > 1 else 'O')
+    if words:
+        sentences.append((words, labels))
+    return sentences
+
+
+def predictions_to_word_labels(words, preds_list, offset_mapping):
+    """Word labels are the predictions of the first token of every word, words without tokens get 'O'."""
+    word_starts = {}
+    position = 0
+    for i, word in enumerate(words):
+        word_starts[position] = i
+        position += len(word) + 1
+    word_labels = ['O'] * len(words)
+    for prediction, (start, _) in zip(preds_list, offset_mapping):
+        word_i = word_starts.pop(start, None)
+        if word_i is not None:
+            word_labels[word_i] = prediction
+    return word_labels
+
+
+def benchmark(bert_model, sentences, latency_sentences):
+    texts = [' '.join(words) for words, _ in sentences]
+
+    latencies = []
+    for text in texts[:latency_sentences]:
+        start_time = time.perf_counter()
+        bert_model.predict_sentence([text])
+        latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    preds_lists, offset_mappings = bert_model.predict_sentences(texts)
+    runtime = time.perf_counter() - start_time
+
+    true_labels = [labels for _, labels in sentences]
+    predicted_labels = [predictions_to_word_labels(words, preds_list, offset_mapping)
+                        for (words, _), preds_list, offset_mapping in zip(sentences, preds_lists, offset_mappings)]
+    return {
+        'latency_mean_ms': 1000 * float(np.mean(latencies)),
+        'latency_p50_ms': 1000 * float(np.percentile(latencies, 50)),
+        'latency_p95_ms': 1000 * float(np.percentile(latencies, 95)),
+        'sentences_per_second': len(texts) / runtime,
+        'words_per_second': sum(len(words) for words, _ in sentences) / runtime,
+        'precision': seqeval.metrics.precision_score(true_labels, predicted_labels),
+        'recall': seqeval.metrics.recall_score(true_labels, predicted_labels),
+        'f1': seqeval.metrics.f1_score(true_labels, predicted_labels),
+    }
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--model_path', required=True, type=str)
+    argparser.add_argument('--labels_path', required=True, type=str)
+    argparser.add_argument('--dev_file', required=True, type=str, help='CoNLL formatted file, e.g. dev.txt.')
+    argparser.add_argument('--export_path', default=None, type=str,
+                           help='Output directory of huggingface_models/export_model.py for the exported variants.')
+    argparser.add_argument('--variants', nargs='+', choices=sorted(VARIANTS), default=['fp32', 'dynamic'],
+                           help='Model variants to compare.')
+    argparser.add_argument('--latency_sentences', default=200, type=int,
+                           help='Number of sentences predicted one by one to measure the latency.')
+    argparser.add_argument('--threads', default=None, type=int, help='Number of torch intra-op threads.')
+    argparser.add_argument('--output_file', default=None, type=str, help='Also write the results as JSON.')
+    return argparser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    sentences = read_conll_sentences(args.dev_file)
+
+    all_results = {}
+    for variant in args.variants:
+        model_kwargs = VARIANTS[variant]
+        model_path = args.export_path if 'backend' in model_kwargs else args.model_path
+        # Without a cache every variant predicts every sentence.
+        bert_model = model.Model(model_path, args.labels_path,
+                                 sentence_cache=sentence_cache.SentenceCache(max_entries=0),
+                                 **model_kwargs)
+        all_results[variant] = benchmark(bert_model, sentences, args.latency_sentences)
+        print('{}: {}'.format(variant, ', '.join('{} = {:.4f}'.format(key, value)
+                                                 for key, value in all_results[variant].items())))
+
+    if args.output_file:
+        with open(args.output_file, 'w') as f:
+            json.dump(all_results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,16 @@ import aiohttp_jinja2
 import jinja2
 from aiohttp import web
 import argparse
+import json
 import os
+import time
 
-import model
 import examples
+import batching
+import sentence_cache
+
+# Time from the start of the server to the model being ready is reported by /ready.
+SERVER_START_TIME = time.perf_counter()
 
 routes = web.RouteTableDef()
 
@@ -20,6 +26,23 @@ class MainView(web.View):
             'class': text_class,
         } if text else None
 
+    @staticmethod
+    def _merge_adjacent_predictions(text_line, predictions):
+        """Merges the tokens of a span (B-X followed by I-X tokens) into a single prediction of the first token type.
+
+        Tokens are adjacent if only whitespace is between them, so word pieces of one word are merged as well.
+        """
+        merged_predictions = []
+        for start, end, prediction_type in predictions:
+            if merged_predictions:
+                previous_start, previous_end, previous_type = merged_predictions[-1]
+                if (prediction_type.startswith('I-') and previous_type[2:] == prediction_type[2:] and
+                        not text_line[previous_end:start].strip()):
+                    merged_predictions[-1] = (previous_start, end, previous_type)
+                    continue
+            merged_predictions.append((start, end, prediction_type))
+        return merged_predictions
+
     def _convert_predictions_to_output(self, text, predictions):
         text_lines = text.split(os.linesep)
 
@@ -30,19 +53,26 @@ class MainView(web.View):
             line_end = line_start + len(text_line)
             lines_spans.append((line_start, line_end))
 
-        # For every line find all matching predictions O(|lines| * |predictions|) complexity,
-        # may be implemented more efficiently.
+        # For every line find all matching predictions. Both lines and sorted predictions go from the start of
+        # the text to its end, so a single pass with a pointer to the current line is enough.
         all_matching_predictions = [[] for _ in range(len(lines_spans))]
-        for line_span, matching_predictions in zip(lines_spans, all_matching_predictions):
-            for prediction in predictions:
-                start = prediction['start']
-                end = prediction['end']
-                span_start, span_end = line_span
-                if span_start <= start <= end <= span_end:
-                    # Move the prediction span to the beginning of the line.
-                    start -= span_start
-                    end -= span_start
-                    matching_predictions.append((start, end, prediction['type']))
+        line_i = 0
+        for prediction in sorted(predictions, key=lambda prediction: prediction['start']):
+            start = prediction['start']
+            end = prediction['end']
+            while line_i < len(lines_spans) and lines_spans[line_i][1] < start:
+                line_i += 1
+            if line_i == len(lines_spans):
+                break
+            span_start, span_end = lines_spans[line_i]
+            if span_start <= start <= end <= span_end:
+                # Move the prediction span to the beginning of the line.
+                start -= span_start
+                end -= span_start
+                all_matching_predictions[line_i].append((start, end, prediction['type']))
+
+        all_matching_predictions = [self._merge_adjacent_predictions(text_line, matching_predictions)
+                                    for text_line, matching_predictions in zip(text_lines, all_matching_predictions)]
 
         all_results = [[] for _ in range(len(lines_spans))]
         for text_line, predictions, result in zip(text_lines, all_matching_predictions, all_results):
@@ -81,19 +111,215 @@ class MainView(web.View):
         main_text = post_arguments['main_text']
         print('Got POST request with text:\n{}'.format(main_text))
 
-        model = self.request.config_dict['bert_model']
-        loop = asyncio.get_event_loop()
-        prediction = await loop.run_in_executor(None, model.predict_text, main_text)
+        predictor = self.request.config_dict['serving'].get_predictor()
+        prediction = await predictor.predict_text(main_text)
 
         formatted_text = self._convert_predictions_to_output(main_text, prediction)
 
         return {'main_text': main_text, 'output_text': formatted_text, 'examples_list': examples.titles}
 
 
+async def _read_api_texts(request):
+    """Reads {"text": "..."} or {"texts": ["...", ...]} from the request body.
+
+    Returns the list of texts and whether a single text was sent.
+    """
+    try:
+        body = await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(text='The request body must be JSON.')
+    if isinstance(body, dict) and isinstance(body.get('text'), str):
+        return [body['text']], True
+    if (isinstance(body, dict) and isinstance(body.get('texts'), list) and
+            all(isinstance(text, str) for text in body['texts'])):
+        return body['texts'], False
+    raise web.HTTPBadRequest(text='Expected {"text": "..."} or {"texts": ["...", ...]}.')
+
+
+@routes.view('/api/predict')
+class PredictApiView(web.View):
+    """Returns the uncertainty spans of every text, same as the ones highlighted on the main page."""
+
+    async def post(self):
+        texts, is_single_text = await _read_api_texts(self.request)
+        predictor = self.request.config_dict['serving'].get_predictor()
+        predictions = await asyncio.gather(*(predictor.predict_text(text) for text in texts))
+        if is_single_text:
+            return web.json_response({'predictions': predictions[0]})
+        return web.json_response({'predictions': predictions})
+
+
+@routes.view('/api/predict/stream')
+class PredictStreamApiView(web.View):
+    """Streams newline delimited JSON, one line per sentence, written as soon as its sub-batch is predicted.
+
+    Sentences come in the order they are predicted, every line has the text_id and sentence_id it belongs to
+    and the start and end of the sentence. Span offsets are relative to the whole text.
+
+    The sentences of a text are grouped like Model.sub_batches and every group is written as one chunk once all
+    of its sentences are predicted. BatchingPredictor may still split a group over several batches and combine it
+    with sentences of other requests, so the chunks follow the sub-batches of Model.predict_text only approximately.
+    """
+
+    async def _predict_sub_batch(self, text_id, sentences, sub_batch):
+        serving = self.request.config_dict['serving']
+        preds_lists, offset_mappings = await serving.predictor.predict_sentences(
+            [sentences[i].text for i in sub_batch])
+        lines = []
+        for sentence_id, preds_list, offset_mapping in zip(sub_batch, preds_lists, offset_mappings):
+            sentence = sentences[sentence_id]
+            lines.append(json.dumps({
+                'text_id': text_id,
+                'sentence_id': sentence_id,
+                'start': sentence.start_char,
+                'end': sentence.end_char,
+                'spans': serving.bert_model.merge_sentence_predictions([sentence], [preds_list], [offset_mapping]),
+            }) + '\n')
+        return ''.join(lines)
+
+    async def post(self):
+        texts, _ = await _read_api_texts(self.request)
+        serving = self.request.config_dict['serving']
+        # Responds with 503 while the model is loading
+        serving.get_predictor()
+
+        loop = asyncio.get_event_loop()
+        sub_batch_predictions = []
+        for text_id, text in enumerate(texts):
+            # Sentence splitting and tokenization run in the default executor to keep the event loop responsive
+            sentences, sub_batches = await loop.run_in_executor(
+                None, serving.bert_model.split_sentence_sub_batches, text)
+            sub_batch_predictions += [self._predict_sub_batch(text_id, sentences, sub_batch)
+                                      for sub_batch in sub_batches]
+
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(self.request)
+        for lines in asyncio.as_completed(sub_batch_predictions):
+            await response.write((await lines).encode('utf-8'))
+        await response.write_eof()
+        return response
+
+
+class ServingState(object):
+    """Model and predictor, loaded in the background after the server started listening."""
+
+    def __init__(self):
+        self.bert_model = None
+        self.predictor = None
+        self.loading_error = None
+        self.timings = {}
+
+    def get_predictor(self):
+        if self.predictor is None:
+            raise web.HTTPServiceUnavailable(text='The model is not loaded yet, see /ready.')
+        return self.predictor
+
+
+@routes.view('/ready')
+class ReadyView(web.View):
+    """Readiness probe: 200 once the model is loaded and warmed up, 503 before."""
+
+    async def get(self):
+        serving = self.request.config_dict['serving']
+        body = {'ready': serving.predictor is not None, 'timings': serving.timings}
+        if serving.loading_error is not None:
+            body['error'] = serving.loading_error
+        return web.json_response(body, status=200 if body['ready'] else 503)
+
+
+def _import_and_load_model(args):
+    # torch, transformers and spacy take seconds to import, so they are imported here instead of at the top
+    # of the file, after the server is already listening.
+    start_time = time.perf_counter()
+    import model
+    import_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    bert_model = model.Model(args.model_path, args.labels_path,
+                             max_sub_batch_size=args.max_sub_batch_size,
+                             max_sub_batch_tokens=args.max_sub_batch_tokens,
+                             sentence_cache=sentence_cache.SentenceCache(args.sentence_cache_size,
+                                                                         args.sentence_cache_mb * 2 ** 20),
+                             quantize=args.quantize,
+                             backend=args.backend,
+                             window_stride=args.window_stride)
+    return bert_model, {'import_seconds': import_seconds, 'load_seconds': time.perf_counter() - start_time}
+
+
+async def load_model(app):
+    args = app['args']
+    serving = app['serving']
+    loop = asyncio.get_event_loop()
+    try:
+        bert_model, serving.timings = await loop.run_in_executor(None, _import_and_load_model, args)
+
+        start_time = time.perf_counter()
+        warmup_texts = examples.examples if args.sentence_cache_size > 0 else ()
+        if args.inference_workers > 0:
+            import process_pool
+            # The workers are forked from this process with the loaded model and warm up themselves.
+            inference_pool = process_pool.create_inference_pool(bert_model, args.inference_workers,
+                                                                args.threads_per_worker, warmup_texts)
+            predictor = batching.BatchingPredictor(bert_model, args.max_batch_size, args.max_batch_wait_ms,
+                                                   executor=inference_pool,
+                                                   predict_function=process_pool.predict_sentences,
+                                                   max_concurrent_batches=args.inference_workers)
+            await process_pool.wait_for_workers(inference_pool, args.inference_workers)
+        else:
+            await loop.run_in_executor(None, bert_model.warm_up, warmup_texts)
+            predictor = batching.BatchingPredictor(bert_model, args.max_batch_size, args.max_batch_wait_ms)
+        serving.timings['warmup_seconds'] = time.perf_counter() - start_time
+
+        await predictor.start()
+        serving.bert_model = bert_model
+        serving.predictor = predictor
+        serving.timings['ready_seconds'] = time.perf_counter() - SERVER_START_TIME
+        print('Model is ready: {}'.format(', '.join('{} = {:.2f}'.format(key, value)
+                                                    for key, value in serving.timings.items())))
+    except Exception as e:
+        serving.loading_error = repr(e)
+        raise
+
+
+async def start_loading_model(app):
+    app['model_loading'] = asyncio.ensure_future(load_model(app))
+
+
+async def stop_model(app):
+    app['model_loading'].cancel()
+    serving = app['serving']
+    if serving.predictor is not None:
+        await serving.predictor.stop()
+
+
 def parse_args():
     argparser = argparse.ArgumentParser()
     argparser.add_argument('--model_path', required=True, type=str)
     argparser.add_argument('--labels_path', required=True, type=str)
+    argparser.add_argument('--backend', choices=['eager', 'torchscript', 'onnx'], default='eager',
+                           help='torchscript and onnx load a model exported by huggingface_models/export_model.py.')
+    argparser.add_argument('--quantize', choices=['dynamic'], default=None,
+                           help='Quantize the linear layers of the model to int8 when it is loaded.')
+    argparser.add_argument('--max_sub_batch_size', default=32, type=int,
+                           help='Maximum number of sentences in a single forward pass of the model.')
+    argparser.add_argument('--max_sub_batch_tokens', default=8192, type=int,
+                           help='Maximum number of padded tokens in a single forward pass of the model.')
+    argparser.add_argument('--window_stride', default=0, type=int,
+                           help='Predict sentences longer than the model input in overlapping windows starting every '
+                                'window_stride tokens instead of truncating them, 0 truncates.')
+    argparser.add_argument('--sentence_cache_size', default=10000, type=int,
+                           help='Maximum number of cached sentence predictions, 0 disables the cache.')
+    argparser.add_argument('--sentence_cache_mb', default=256, type=int,
+                           help='Maximum approximate memory used by cached sentence predictions.')
+    argparser.add_argument('--inference_workers', default=0, type=int,
+                           help='Number of forked inference processes, 0 runs inference in a thread of the server.')
+    argparser.add_argument('--threads_per_worker', default=None, type=int,
+                           help='torch intra-op threads of every inference process, all cores split evenly '
+                                'between the processes by default.')
+    argparser.add_argument('--max_batch_size', default=32, type=int,
+                           help='Maximum number of sentences of concurrent requests predicted together.')
+    argparser.add_argument('--max_batch_wait_ms', default=5.0, type=float,
+                           help='Maximum time the first sentence of a batch waits for more sentences.')
     return argparser.parse_args()
 
 
@@ -101,7 +327,11 @@ def main():
     args = parse_args()
 
     app = web.Application()
-    app['bert_model'] = model.Model(args.model_path, args.labels_path)
+    app['args'] = args
+    app['serving'] = ServingState()
+    # The model is loaded after the server starts listening, requests get 503 until /ready says otherwise.
+    app.on_startup.append(start_loading_model)
+    app.on_cleanup.append(stop_model)
 
     app.add_routes(routes)
     aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader('templates/'))
@@ -1,13 +1,24 @@
+import json
 import logging
+import os
+import threading
 import transformers
 import torch
 import numpy as np
 import spacy.lang.en
 
+from sentence_cache import SentenceCache
+
 logger = logging.getLogger(__name__)
 
 TOKENIZER_ARGS = ["do_lower_case", "strip_accents", "keep_accents", "use_fast"]
 
+# Written next to the exported model by huggingface_models/export_model.py
+EXPORT_CONFIG_FILE = "export_config.json"
+BACKENDS = ("eager", "torchscript", "onnx")
+# Canned sentence for the first forward pass, which allocates the memory and starts the thread pools.
+WARMUP_SENTENCE = "He believes that the Earth may be flat, but we are not sure about it."
+
 
 def get_labels(path):
     if path:
@@ -20,11 +31,57 @@ def get_labels(path):
         return ["O", "B-MISC", "I-MISC", "B-PER", "I-PER", "B-ORG", "I-ORG", "B-LOC", "I-LOC"]
 
 
+# Same as window_starts in huggingface_models/utils_ner.py, keep them identical.
+def window_starts(num_tokens, window_size, stride):
+    """Starts of the windows of window_size tokens, stride tokens apart, that cover all num_tokens tokens.
+    The last window is moved back to end at the last token. Without a stride there is only the first window,
+    so the tokens after it are truncated.
+    """
+    if not stride or num_tokens <= window_size:
+        return [0]
+    return list(range(0, num_tokens - window_size, stride)) + [num_tokens - window_size]
+
+
 class Model(object):
-    def __init__(self, model_path, labels_path, max_seq_len=512):
+    def __init__(self, model_path, labels_path, max_seq_len=512, max_sub_batch_size=32, max_sub_batch_tokens=8192,
+                 sentence_cache=None, quantize=None, backend='eager', window_stride=0):
+        """backend "torchscript" and "onnx" load a model exported by huggingface_models/export_model.py from
+        model_path instead of building the transformers model.
+
+        With a window_stride, sentences longer than max_seq_len are predicted in overlapping windows starting every
+        window_stride tokens instead of being truncated.
+        """
         self.tokenizer = transformers.AutoTokenizer.from_pretrained(model_path, use_fast=True)
-        self.model = transformers.AutoModelForTokenClassification.from_pretrained(model_path)
+        # batch_encode_plus and encode_plus of fast tokenizers temporarily enable truncation and padding on the
+        # shared tokenizer, so tokenizing in several threads at once (e.g. lengths of streamed texts while a
+        # sub-batch is predicted) needs a lock.
+        self.tokenizer_lock = threading.Lock()
+        self.backend = backend
+        if backend == 'eager':
+            self.model = transformers.AutoModelForTokenClassification.from_pretrained(model_path)
+            self.model.eval()
+        elif backend in BACKENDS:
+            self._load_exported_model(model_path, backend)
+        else:
+            raise ValueError('Unknown backend: {}'.format(backend))
+
+        if quantize == 'dynamic':
+            if backend != 'eager':
+                raise ValueError('Only the eager backend can be quantized')
+            # int8 weights for all linear layers, activations are quantized on the fly. CPU only.
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        elif quantize is not None:
+            raise ValueError('Unknown quantization: {}'.format(quantize))
         self.max_seq_len = max_seq_len
+        self.max_sub_batch_size = max_sub_batch_size
+        # Budget of padded tokens (sentences * longest sentence) of a single forward pass.
+        self.max_sub_batch_tokens = max_sub_batch_tokens
+        if window_stride < 0 or window_stride > max_seq_len - self.tokenizer.num_added_tokens():
+            raise ValueError('window_stride must be between 0 and the window size, got {}'.format(window_stride))
+        self.window_stride = window_stride
+        # Cached predictions are only valid for the same weights, truncation length and windows.
+        self.identity = (os.path.abspath(model_path), max_seq_len, quantize, backend, window_stride)
+        self.sentence_cache = sentence_cache if sentence_cache is not None else SentenceCache()
         self.pad_token_label_id = torch.nn.CrossEntropyLoss().ignore_index
 
         labels = get_labels(labels_path)
@@ -33,14 +90,35 @@ class Model(object):
         self.nlp = spacy.lang.en.English()
         self.nlp.add_pipe(self.nlp.create_pipe('sentencizer'))
 
-        self.model.eval()
+    def _load_exported_model(self, model_path, backend):
+        with open(os.path.join(model_path, EXPORT_CONFIG_FILE)) as f:
+            export_config = json.load(f)
+        self.input_names = export_config['input_names']
+        if backend == 'torchscript':
+            self.model = torch.jit.load(os.path.join(model_path, export_config['torchscript_file']))
+            self.model.eval()
+        else:
+            # onnxruntime is only needed for this backend
+            import onnxruntime
+            self.model = onnxruntime.InferenceSession(os.path.join(model_path, export_config['onnx_file']))
+
+    def _forward(self, input_ids, attention_mask, token_type_ids):
+        inputs = {'input_ids': input_ids, 'attention_mask': attention_mask, 'token_type_ids': token_type_ids}
+        if self.backend == 'eager':
+            return self.model(**inputs)[0]
+        if self.backend == 'torchscript':
+            # Traced models take positional arguments in the order they were traced with
+            return self.model(*[inputs[name] for name in self.input_names])[0]
+        onnx_inputs = {name: inputs[name].numpy() for name in self.input_names}
+        return torch.from_numpy(self.model.run(None, onnx_inputs)[0])
 
     def predict_sentence(self, texts):
-        encoded_text = self.tokenizer.batch_encode_plus(texts,
-                                                        max_length=self.max_seq_len,
-                                                        pad_to_max_length=True,
-                                                        return_input_lengths=True,
-                                                        return_offsets_mapping=True)
+        with self.tokenizer_lock:
+            encoded_text = self.tokenizer.batch_encode_plus(texts,
+                                                            max_length=self.max_seq_len,
+                                                            pad_to_max_length=True,
+                                                            return_input_lengths=True,
+                                                            return_offsets_mapping=True)
 
         with torch.no_grad():
             input_ids = torch.tensor(encoded_text['input_ids'], dtype=torch.long)
@@ -59,8 +137,7 @@ class Model(object):
             attention_mask = attention_mask[:, :total_len]
             token_type_ids = token_type_ids[:, :total_len]
 
-            outputs = self.model(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)
-            logits = outputs[0]
+            logits = self._forward(input_ids, attention_mask, token_type_ids)
 
         sequence_lengths = sequence_lengths.detach().cpu().numpy()
         preds = logits.detach().cpu().numpy()
@@ -83,13 +160,143 @@ class Model(object):
 
         return preds_list, offset_mapping
 
-    def predict_text(self, text):
+    def predict_sentence_windows(self, texts):
+        """Same as predict_sentence, but splits every text into overlapping windows of max_seq_len tokens,
+        window_stride tokens apart, and averages the logits of the tokens in several windows.
+
+        The windows of all texts are predicted together, in batches of the same budget as sub_batches.
+        """
+        special_tokens_count = self.tokenizer.num_added_tokens()
+        window_size = self.max_seq_len - special_tokens_count
+        with self.tokenizer_lock:
+            encoded_texts = [self.tokenizer.encode_plus(text, add_special_tokens=False, return_offsets_mapping=True)
+                             for text in texts]
+        # (text index, start, end) of the windows of all texts
+        windows = []
+        logit_sums = []
+        window_counts = []
+        for i, encoded_text in enumerate(encoded_texts):
+            num_tokens = len(encoded_text['input_ids'])
+            windows += [(i, start, min(start + window_size, num_tokens))
+                        for start in window_starts(num_tokens, window_size, self.window_stride)]
+            logit_sums.append(np.zeros((num_tokens, len(self.label_map)), dtype=np.float32))
+            window_counts.append(np.zeros((num_tokens, 1), dtype=np.float32))
+
+        window_lengths = [end - start + special_tokens_count for _, start, end in windows]
+        for batch in self.sub_batches(windows, window_lengths):
+            batch_windows = [windows[j] for j in batch]
+            batch_len = max(window_lengths[j] for j in batch)
+            # Windows of texts longer than max_seq_len all have max_seq_len tokens, only shorter texts are padded
+            input_ids = []
+            attention_mask = []
+            for i, start, end in batch_windows:
+                window_ids = self.tokenizer.build_inputs_with_special_tokens(encoded_texts[i]['input_ids'][start:end])
+                padding_length = batch_len - len(window_ids)
+                input_ids.append(window_ids + [self.tokenizer.pad_token_id] * padding_length)
+                attention_mask.append([1] * len(window_ids) + [0] * padding_length)
+            input_ids = torch.tensor(input_ids, dtype=torch.long)
+            attention_mask = torch.tensor(attention_mask, dtype=torch.long)
+            with torch.no_grad():
+                logits = self._forward(input_ids, attention_mask, torch.zeros_like(input_ids))
+            logits = logits.detach().cpu().numpy()
+            for (i, start, end), window_logits in zip(batch_windows, logits):
+                # Skip the [CLS] token in front of the window
+                logit_sums[i][start:end] += window_logits[1: end - start + 1]
+                window_counts[i][start:end] += 1
+
+        preds_list = []
+        offset_mapping = []
+        for encoded_text, text_logit_sums, text_window_counts in zip(encoded_texts, logit_sums, window_counts):
+            preds = np.argmax(text_logit_sums / text_window_counts, axis=1)
+            preds_list.append([self.label_map[pred] for pred in preds])
+            offset_mapping.append(list(encoded_text['offset_mapping']))
+        return preds_list, offset_mapping
+
+    def _token_lengths(self, texts):
+        special_tokens_count = self.tokenizer.num_added_tokens()
+        with self.tokenizer_lock:
+            return [len(self.tokenizer.tokenize(text)) + special_tokens_count for text in texts]
+
+    def sub_batches(self, texts, lengths=None):
+        """Splits texts into batches of similar token length.
+
+        Yields lists of indices of texts. Every batch has at most max_sub_batch_size texts and, unless a single text
+        is longer, at most max_sub_batch_tokens tokens after padding.
+        """
+        if lengths is None:
+            lengths = self._token_lengths(texts)
+        # Longer texts are truncated
+        lengths = [min(length, self.max_seq_len) for length in lengths]
+        batch = []
+        for i in sorted(range(len(texts)), key=lengths.__getitem__):
+            # Texts come in increasing length order, so the current text is the longest one in the batch.
+            if batch and (len(batch) == self.max_sub_batch_size or
+                          (len(batch) + 1) * lengths[i] > self.max_sub_batch_tokens):
+                yield batch
+                batch = []
+            batch.append(i)
+        if batch:
+            yield batch
+
+    def predict_sentences(self, texts):
+        """Same as predict_sentence, but takes cached sentences from sentence_cache and runs the rest in length
+        sorted sub-batches.
+        """
+        preds_lists = [None] * len(texts)
+        offset_mappings = [None] * len(texts)
+        uncached_ids = []
+        for i, text in enumerate(texts):
+            cached_prediction = self.sentence_cache.get(self.identity, text)
+            if cached_prediction is None:
+                uncached_ids.append(i)
+            else:
+                preds_lists[i], offset_mappings[i] = cached_prediction
+
+        uncached_texts = [texts[i] for i in uncached_ids]
+        lengths = self._token_lengths(uncached_texts)
+        batches = [(self.predict_sentence, batch) for batch in self.sub_batches(uncached_texts, lengths)]
+        if self.window_stride:
+            # Texts longer than max_seq_len are predicted in windows instead of being truncated
+            long_ids = [i for i, length in enumerate(lengths) if length > self.max_seq_len]
+            if long_ids:
+                long_id_set = set(long_ids)
+                batches = [(predict, [i for i in batch if i not in long_id_set]) for predict, batch in batches]
+                batches = [(predict, batch) for predict, batch in batches if batch]
+                batches.append((self.predict_sentence_windows, long_ids))
+
+        for predict, batch in batches:
+            batch_preds_lists, batch_offset_mappings = predict([uncached_texts[i] for i in batch])
+            for i, preds_list, offset_mapping in zip(batch, batch_preds_lists, batch_offset_mappings):
+                text_id = uncached_ids[i]
+                preds_lists[text_id] = preds_list
+                offset_mappings[text_id] = offset_mapping
+                self.sentence_cache.put(self.identity, texts[text_id], preds_list, offset_mapping)
+        return preds_lists, offset_mappings
+
+    def warm_up(self, cache_texts=()):
+        """Runs a first forward pass on a canned sentence, so that the first request isn't slower than the rest,
+        then warms up the sentence cache with cache_texts.
+        """
+        self.predict_sentence([WARMUP_SENTENCE])
+        self.warm_up_cache(cache_texts)
+
+    def warm_up_cache(self, texts):
+        """Predicts all sentences of the texts, so that they are served from sentence_cache later."""
+        for text in texts:
+            self.predict_text(text)
+        logger.info('Sentence cache warmed up with %d sentences', len(self.sentence_cache))
+
+    def split_sentences(self, text):
         doc = self.nlp(text)
+        return list(doc.sents)
 
-        sentences = list(doc.sents)
-        sentences_texts = [sent.text for sent in sentences]
-        preds_lists, offset_mappings = self.predict_sentence(sentences_texts)
+    def split_sentence_sub_batches(self, text):
+        """Splits text into sentences and groups them like sub_batches. Returns (sentences, lists of indices)."""
+        sentences = self.split_sentences(text)
+        return sentences, list(self.sub_batches([sentence.text for sentence in sentences]))
 
+    @staticmethod
+    def merge_sentence_predictions(sentences, preds_lists, offset_mappings):
         full_preds_list = []
         full_offset_mapping = []
         for predictions, offset_mapping, sentence in zip(preds_lists, offset_mappings, sentences):
@@ -105,3 +312,9 @@ class Model(object):
         } for prediction, offset_mapping in zip(full_preds_list, full_offset_mapping) if prediction != 'O']
 
         return result
+
+    def predict_text(self, text):
+        sentences = self.split_sentences(text)
+        sentences_texts = [sent.text for sent in sentences]
+        preds_lists, offset_mappings = self.predict_sentences(sentences_texts)
+        return self.merge_sentence_predictions(sentences, preds_lists, offset_mappings)
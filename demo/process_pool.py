@@ -0,0 +1,62 @@
+import asyncio
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# The model used by the worker processes. Set in the parent before the workers are forked,
+# so every worker gets the already loaded weights as copy-on-write memory instead of loading its own copy.
+_worker_model = None
+# Number of workers that finished their warmup, shared with the workers.
+_ready_workers = None
+
+
+def _init_worker(threads_per_worker, warmup_texts):
+    # Every worker uses its own cores, otherwise N workers each starting a thread per core oversubscribe the CPU.
+    torch.set_num_threads(threads_per_worker)
+    _worker_model.warm_up(warmup_texts)
+    with _ready_workers.get_lock():
+        _ready_workers.value += 1
+    logger.info('Inference worker %d is ready with %d threads', os.getpid(), threads_per_worker)
+
+
+def _ping():
+    return os.getpid()
+
+
+def predict_sentences(texts):
+    """Model.predict_sentences in a worker process."""
+    return _worker_model.predict_sentences(texts)
+
+
+def create_inference_pool(model, workers, threads_per_worker=None, warmup_texts=()):
+    """Returns a process pool executor running predict_sentences with the model in every worker.
+
+    Must be called before the model is used for inference in this process: OpenMP thread pools that already
+    ran don't survive fork. Every worker runs Model.warm_up and has its own sentence cache.
+    """
+    global _worker_model, _ready_workers
+    mp_context = multiprocessing.get_context('fork')
+    _worker_model = model
+    _ready_workers = mp_context.Value('i', 0)
+    if threads_per_worker is None:
+        threads_per_worker = max(1, os.cpu_count() // workers)
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=mp_context,
+        initializer=_init_worker,
+        initargs=(threads_per_worker, tuple(warmup_texts)),
+    )
+
+
+async def wait_for_workers(executor, workers, poll_interval=0.1):
+    """Starts all workers of the pool and waits until every one of them has warmed up."""
+    loop = asyncio.get_event_loop()
+    # Workers are started on demand, a task submitted while no worker is idle starts a new one.
+    await asyncio.gather(*(loop.run_in_executor(executor, _ping) for _ in range(workers)))
+    while _ready_workers.value < workers:
+        await asyncio.sleep(poll_interval)
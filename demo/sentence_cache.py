@@ -0,0 +1,69 @@
+import collections
+import sys
+import threading
+
+# Rough size of a single token prediction: a list slot, an (start, end) offsets tuple with two ints.
+TOKEN_PREDICTION_BYTES = 128
+
+
+class SentenceCache(object):
+    """LRU cache of sentence predictions, bounded by the number of sentences and their approximate size.
+
+    Keys are (model identity, sentence text), so the same cache may be shared by several models. The text is
+    stripped of surrounding whitespace, offsets are stored relative to the stripped text and moved back on lookup,
+    so a sentence is found no matter how it was cut from its document.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=256 * 2 ** 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def normalize(text):
+        """Returns the normalized text and the number of characters removed from its beginning."""
+        stripped_text = text.lstrip()
+        return stripped_text.rstrip(), len(text) - len(stripped_text)
+
+    @staticmethod
+    def _entry_bytes(key, preds_list):
+        return sys.getsizeof(key[1]) + TOKEN_PREDICTION_BYTES * len(preds_list)
+
+    def get(self, model_identity, text):
+        """Returns (preds_list, offset_mapping) of the text or None."""
+        normalized_text, shift = self.normalize(text)
+        key = (model_identity, normalized_text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        preds_list, offset_mapping = entry
+        return list(preds_list), [(start + shift, end + shift) for start, end in offset_mapping]
+
+    def put(self, model_identity, text, preds_list, offset_mapping):
+        if self.max_entries <= 0:
+            return
+        normalized_text, shift = self.normalize(text)
+        key = (model_identity, normalized_text)
+        entry = (tuple(preds_list), tuple((start - shift, end - shift) for start, end in offset_mapping))
+        entry_bytes = self._entry_bytes(key, preds_list)
+        if entry_bytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.total_bytes -= self._entry_bytes(key, self._entries.pop(key)[0])
+            self._entries[key] = entry
+            self.total_bytes += entry_bytes
+            while len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                evicted_key, (evicted_preds_list, _) = self._entries.popitem(last=False)
+                self.total_bytes -= self._entry_bytes(evicted_key, evicted_preds_list)
@@ -0,0 +1,47 @@
+import unittest
+
+import sentence_cache
+
+
+class SentenceCacheTestCase(unittest.TestCase):
+    MODEL = ('model', 512)
+
+    def test_get_returns_put_prediction(self):
+        cache = sentence_cache.SentenceCache()
+        cache.put(self.MODEL, 'It may fly.', ['O', 'B-EPIST', 'O', 'O'], [(0, 2), (3, 6), (7, 10), (10, 11)])
+        self.assertEqual(cache.get(self.MODEL, 'It may fly.'),
+                         (['O', 'B-EPIST', 'O', 'O'], [(0, 2), (3, 6), (7, 10), (10, 11)]))
+        self.assertIsNone(cache.get(('other model', 512), 'It may fly.'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_offsets_are_moved_by_leading_whitespace(self):
+        cache = sentence_cache.SentenceCache()
+        cache.put(self.MODEL, '  It may', ['O', 'B-EPIST'], [(2, 4), (5, 8)])
+        self.assertEqual(cache.get(self.MODEL, 'It may '), (['O', 'B-EPIST'], [(0, 2), (3, 6)]))
+
+    def test_least_recently_used_sentence_is_evicted(self):
+        cache = sentence_cache.SentenceCache(max_entries=2)
+        cache.put(self.MODEL, 'a', ['O'], [(0, 1)])
+        cache.put(self.MODEL, 'b', ['O'], [(0, 1)])
+        cache.get(self.MODEL, 'a')
+        cache.put(self.MODEL, 'c', ['O'], [(0, 1)])
+        self.assertIsNotNone(cache.get(self.MODEL, 'a'))
+        self.assertIsNone(cache.get(self.MODEL, 'b'))
+        self.assertIsNotNone(cache.get(self.MODEL, 'c'))
+
+    def test_cache_is_bounded_by_memory(self):
+        cache = sentence_cache.SentenceCache(max_bytes=3 * sentence_cache.TOKEN_PREDICTION_BYTES)
+        cache.put(self.MODEL, 'a b', ['O', 'O'], [(0, 1), (2, 3)])
+        cache.put(self.MODEL, 'c d', ['O', 'O'], [(0, 1), (2, 3)])
+        self.assertEqual(len(cache), 1)
+        self.assertLessEqual(cache.total_bytes, cache.max_bytes)
+        self.assertIsNotNone(cache.get(self.MODEL, 'c d'))
+
+    def test_zero_size_cache_stores_nothing(self):
+        cache = sentence_cache.SentenceCache(max_entries=0)
+        cache.put(self.MODEL, 'a', ['O'], [(0, 1)])
+        self.assertEqual(len(cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
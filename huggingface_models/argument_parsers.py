@@ -5,6 +5,8 @@ from typing import Any, Iterable, NewType, Tuple, Union
 from typing import Optional
 import dataclasses
 
+from precision import PRECISIONS
+
 DataClass = NewType("DataClass", Any)
 DataClassType = NewType("DataClassType", Any)
 
@@ -173,15 +175,12 @@ class TrainingArguments:
     no_cuda: bool = field(default=False, metadata={"help": "Avoid using CUDA even if it is available"})
     seed: int = field(default=42, metadata={"help": "random seed for initialization"})
 
-    fp16: bool = field(
-        default=False,
-        metadata={"help": "Whether to use 16-bit (mixed) precision (through NVIDIA apex) instead of 32-bit"},
-    )
-    fp16_opt_level: str = field(
-        default="O1",
+    precision: str = field(
+        default="fp32",
         metadata={
-            "help": "For fp16: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
-                    "See details at https://nvidia.github.io/apex/amp.html"
+            "choices": PRECISIONS,
+            "help": "Precision of the forward and backward passes with torch.autocast: fp16 (CUDA only, with loss "
+                    "scaling) or bf16 (CUDA or CPU), weights stay in fp32.",
         },
     )
     local_rank: int = field(default=-1, metadata={"help": "For distributed training: local_rank"})
@@ -0,0 +1,74 @@
+""" Compares training step time, memory and dev F1 of run_ner.py with every --precision.
+
+Trains and evaluates a model with every precision, all other arguments are passed on to run_ner.py, e.g.:
+    python benchmark_precision.py --precisions fp32 bf16 --output_dir precision_benchmark -- \
+        --data_dir [DATA] --model_type bert --model_name_or_path bert-base-cased --labels ../labels.txt \
+        --max_seq_length 128 --max_steps 500 --logging_steps 50
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import torch
+
+from precision import PRECISIONS
+
+
+RUN_NER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_ner.py")
+# Keys of training_stats.json reported for every precision
+TRAINING_STATS = ("seconds_per_batch", "examples_per_second", "peak_rss_mb", "peak_cuda_memory_mb")
+
+
+def supported_precisions(use_cuda=True):
+    # fp16 needs CUDA, MixedPrecision would fail for it on a CPU-only machine
+    return [precision for precision in PRECISIONS if precision != "fp16" or (use_cuda and torch.cuda.is_available())]
+
+
+def read_eval_results(path):
+    with open(path) as f:
+        return {key: float(value) for key, value in (line.strip().split(" = ") for line in f if line.strip())}
+
+
+def benchmark(precision, output_dir, run_ner_argv):
+    subprocess.run(
+        [sys.executable, RUN_NER, *run_ner_argv, "--output_dir", output_dir, "--precision", precision,
+         "--do_train", "--do_eval", "--overwrite_output_dir"],
+        check=True,
+    )
+    with open(os.path.join(output_dir, "training_stats.json")) as f:
+        training_stats = json.load(f)["total"]
+    eval_results = read_eval_results(os.path.join(output_dir, "eval_results.txt"))
+    results = {key: training_stats[key] for key in TRAINING_STATS if key in training_stats}
+    results.update({"eval_{}".format(key): eval_results[key] for key in ("loss", "precision", "recall", "f1")})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--precisions", nargs="+", choices=PRECISIONS, default=None,
+                        help="Precisions to compare, all that run on this machine by default.")
+    parser.add_argument("--output_dir", required=True, type=str,
+                        help="Every precision trains into a subdirectory, results.json is written here.")
+    args, run_ner_argv = parser.parse_known_args()
+    if run_ner_argv and run_ner_argv[0] == "--":
+        run_ner_argv = run_ner_argv[1:]
+    supported = supported_precisions(use_cuda="--no_cuda" not in run_ner_argv)
+
+    all_results = {}
+    for precision in args.precisions or supported:
+        if precision not in supported:
+            print("Skipping {}, it needs a CUDA device".format(precision))
+            continue
+        all_results[precision] = benchmark(precision, os.path.join(args.output_dir, precision), run_ner_argv)
+        print("{}: {}".format(precision, ", ".join("{} = {:.4f}".format(key, value)
+                                                   for key, value in all_results[precision].items())))
+
+    with open(os.path.join(args.output_dir, "results.json"), "w") as f:
+        json.dump(all_results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+""" Compact on-disk cache of tokenized features shared by run_ner.py and run_classification.py.
+
+The features are stored unpadded: all token ids of all examples are concatenated into one flat array and
+`offsets[i]:offsets[i + 1]` is the slice that belongs to the i-th example. Every array is a separate .npy file,
+so it can be memory-mapped and only the examples that are actually read get loaded from disk.
+"""
+
+
+import logging
+import os
+import shutil
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler
+
+
+logger = logging.getLogger(__name__)
+
+OFFSETS_FILE = "offsets.npy"
+INPUT_IDS_FILE = "input_ids.npy"
+TOKEN_TYPE_IDS_FILE = "token_type_ids.npy"
+# Per token labels (token classification) or per example labels (sequence classification).
+TOKEN_LABELS_FILE = "token_labels.npy"
+LABELS_FILE = "labels.npy"
+# Only for examples split into overlapping windows: the example of every window and its first labeled token.
+WINDOW_EXAMPLE_IDS_FILE = "window_example_ids.npy"
+WINDOW_LABEL_STARTS_FILE = "window_label_starts.npy"
+
+
+def _smallest_int_dtype(values, candidate_dtypes):
+    if values.size == 0:
+        return candidate_dtypes[0]
+    min_value, max_value = values.min(), values.max()
+    for dtype in candidate_dtypes:
+        if np.iinfo(dtype).min <= min_value and max_value <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def features_to_arrays(input_ids, attention_mask, token_type_ids, labels, window_example_ids=None,
+                       window_label_starts=None):
+    """Converts padded features to unpadded flat arrays.
+
+    Args:
+        input_ids, attention_mask, token_type_ids: lists of padded sequences, one per example.
+        labels: list of padded label sequences (token classification) or list of labels (sequence classification).
+        window_example_ids, window_label_starts: if the examples are split into windows, the example id and
+            the number of labeled tokens before every window.
+
+    Returns:
+        A dict from the cache file name to the array stored in it.
+    """
+    input_ids = np.asarray(input_ids)
+    real_tokens_mask = np.asarray(attention_mask) == 1
+    token_type_ids = np.asarray(token_type_ids)
+    labels = np.asarray(labels)
+
+    offsets = np.zeros(len(input_ids) + 1, dtype=np.int64)
+    np.cumsum(real_tokens_mask.sum(axis=1), out=offsets[1:])
+
+    # Boolean indexing of a 2D array returns the elements row by row, which keeps the examples in order
+    # and works for both left and right padding.
+    flat_input_ids = input_ids[real_tokens_mask]
+    flat_token_type_ids = token_type_ids[real_tokens_mask]
+    arrays = {
+        OFFSETS_FILE: offsets,
+        INPUT_IDS_FILE: flat_input_ids.astype(_smallest_int_dtype(flat_input_ids, (np.uint16, np.int32))),
+        TOKEN_TYPE_IDS_FILE: flat_token_type_ids.astype(_smallest_int_dtype(flat_token_type_ids, (np.int8,))),
+    }
+    if labels.ndim == 2:
+        flat_labels = labels[real_tokens_mask]
+        arrays[TOKEN_LABELS_FILE] = flat_labels.astype(_smallest_int_dtype(flat_labels, (np.int16, np.int32)))
+    elif np.issubdtype(labels.dtype, np.floating):
+        arrays[LABELS_FILE] = labels.astype(np.float32)
+    else:
+        arrays[LABELS_FILE] = labels.astype(np.int64)
+    if window_example_ids is not None:
+        arrays[WINDOW_EXAMPLE_IDS_FILE] = np.asarray(window_example_ids, dtype=np.int64)
+        arrays[WINDOW_LABEL_STARTS_FILE] = np.asarray(window_label_starts, dtype=np.int64)
+    return arrays
+
+
+def save_arrays(cache_dir, arrays):
+    # Write into a temporary directory first, so that concurrent runs never see a partially written cache.
+    tmp_cache_dir = "{}.tmp{}".format(cache_dir, os.getpid())
+    os.makedirs(tmp_cache_dir, exist_ok=True)
+    for file_name, array in arrays.items():
+        np.save(os.path.join(tmp_cache_dir, file_name), array)
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.replace(tmp_cache_dir, cache_dir)
+
+
+def load_arrays(cache_dir):
+    arrays = {}
+    for file_name in (OFFSETS_FILE, INPUT_IDS_FILE, TOKEN_TYPE_IDS_FILE, TOKEN_LABELS_FILE, LABELS_FILE,
+                      WINDOW_EXAMPLE_IDS_FILE, WINDOW_LABEL_STARTS_FILE):
+        path = os.path.join(cache_dir, file_name)
+        if os.path.exists(path):
+            arrays[file_name] = np.load(path, mmap_mode="r")
+    return arrays
+
+
+class BinaryFeaturesDataset(Dataset):
+    """Dataset over unpadded arrays.
+
+    Every item is (input_ids, attention_mask, token_type_ids, labels), same as the TensorDataset it replaces.
+    Items are padded to max_seq_length, or returned unpadded if pad_to_max_length is False. In the latter case
+    `pad_batch` must be used as the DataLoader collate_fn, it pads every batch only to its longest member.
+    """
+
+    def __init__(
+        self,
+        arrays,
+        max_seq_length,
+        pad_token_id=0,
+        pad_token_segment_id=0,
+        pad_token_label_id=-100,
+        pad_on_left=False,
+        pad_to_max_length=True,
+    ):
+        self.offsets = arrays[OFFSETS_FILE]
+        self.input_ids = arrays[INPUT_IDS_FILE]
+        self.token_type_ids = arrays[TOKEN_TYPE_IDS_FILE]
+        self.token_labels = arrays.get(TOKEN_LABELS_FILE)
+        self.labels = arrays.get(LABELS_FILE)
+        self.window_example_ids = arrays.get(WINDOW_EXAMPLE_IDS_FILE)
+        self.window_label_starts = arrays.get(WINDOW_LABEL_STARTS_FILE)
+        self.max_seq_length = max_seq_length
+        self.pad_token_id = pad_token_id
+        self.pad_token_segment_id = pad_token_segment_id
+        self.pad_token_label_id = pad_token_label_id
+        self.pad_on_left = pad_on_left
+        self.pad_to_max_length = pad_to_max_length
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        """Number of real (not padding) tokens of every example."""
+        return np.diff(self.offsets)
+
+    @property
+    def label_counts(self):
+        """Number of labeled (not pad_token_label_id) tokens of every item with per token labels."""
+        labeled_tokens_before = np.concatenate([[0], np.cumsum(self.token_labels != self.pad_token_label_id)])
+        return labeled_tokens_before[self.offsets[1:]] - labeled_tokens_before[self.offsets[:-1]]
+
+    def _pad(self, values, pad_value, seq_length):
+        padded = np.full(seq_length, pad_value, dtype=np.int64)
+        if self.pad_on_left:
+            padded[seq_length - len(values):] = values
+        else:
+            padded[: len(values)] = values
+        return torch.from_numpy(padded)
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        seq_length = self.max_seq_length if self.pad_to_max_length else end - start
+        input_ids = self._pad(self.input_ids[start:end], self.pad_token_id, seq_length)
+        attention_mask = self._pad(np.ones(end - start, dtype=np.int64), 0, seq_length)
+        token_type_ids = self._pad(self.token_type_ids[start:end], self.pad_token_segment_id, seq_length)
+        if self.token_labels is not None:
+            labels = self._pad(self.token_labels[start:end], self.pad_token_label_id, seq_length)
+        else:
+            labels = torch.tensor(self.labels[index])
+        return input_ids, attention_mask, token_type_ids, labels
+
+    def _stack_padded(self, sequences, pad_value, seq_length):
+        padded = torch.full((len(sequences), seq_length), pad_value, dtype=torch.long)
+        for i, sequence in enumerate(sequences):
+            if self.pad_on_left:
+                padded[i, seq_length - len(sequence):] = sequence
+            else:
+                padded[i, : len(sequence)] = sequence
+        return padded
+
+    def pad_batch(self, batch):
+        """collate_fn that pads every sequence of the batch to the longest one."""
+        all_input_ids, all_attention_mask, all_token_type_ids, all_labels = zip(*batch)
+        seq_length = max(len(input_ids) for input_ids in all_input_ids)
+        if self.token_labels is not None:
+            labels = self._stack_padded(all_labels, self.pad_token_label_id, seq_length)
+        else:
+            labels = torch.stack(all_labels)
+        return (
+            self._stack_padded(all_input_ids, self.pad_token_id, seq_length),
+            self._stack_padded(all_attention_mask, 0, seq_length),
+            self._stack_padded(all_token_type_ids, self.pad_token_segment_id, seq_length),
+            labels,
+        )
+
+
+class LengthBucketBatchSampler(Sampler):
+    """Batch sampler that puts examples of similar length together, so that dynamically padded batches
+    contain little padding.
+
+    The examples are shuffled and split into buckets of `bucket_size_multiplier` batches, every bucket is
+    sorted by length and cut into batches, then the order of all batches is shuffled. Shuffling uses the
+    global torch RNG like RandomSampler does, so the batches are reproducible with the same seed.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_size_multiplier=100, shuffle=True):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        if self.shuffle:
+            indices = torch.randperm(len(self.lengths)).numpy()
+        else:
+            indices = np.arange(len(self.lengths))
+
+        batches = []
+        for bucket_start in range(0, len(indices), self.bucket_size):
+            bucket = indices[bucket_start: bucket_start + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            batches.extend(bucket[i: i + self.batch_size].tolist() for i in range(0, len(bucket), self.batch_size))
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return iter(batches)
+
+    def __len__(self):
+        full_buckets, last_bucket_size = divmod(len(self.lengths), self.bucket_size)
+        batches_per_bucket = -(-self.bucket_size // self.batch_size)
+        return full_buckets * batches_per_bucket + -(-last_bucket_size // self.batch_size)
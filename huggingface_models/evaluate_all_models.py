@@ -0,0 +1,256 @@
+""" Evaluates all fine-tuned NER or classification models of an experiment in a single process.
+
+Runs the same evaluations as the evaluate_all_models.sh job array, but every base model's tokenizer, evaluation
+features and model instance are loaded once and reused for all model types and seeds: checkpoints only swap the
+weights of the model. Results are written to {experiments_dir}/results/{base_model}_{model_type}_at_{dataset}_{seed},
+the layout read by aggregate_results.py --eval_all_script_format.
+
+Arguments not listed below are passed on to run_ner.py or run_classification.py, e.g.:
+    python evaluate_all_models.py --task ner --experiments_dir ner_experiments --per_gpu_eval_batch_size 64
+"""
+
+import argparse
+import logging
+import os
+
+import torch
+from torch.nn import CrossEntropyLoss
+from transformers import (
+    WEIGHTS_NAME,
+    AutoModelForSequenceClassification,
+    AutoModelForTokenClassification,
+    AutoTokenizer,
+)
+
+import run_classification
+import run_ner
+from classification_utils import output_modes
+from utils_ner import get_labels, write_predictions_to_file
+
+
+logger = logging.getLogger(__name__)
+
+BASE_MODELS = ["bert_base_cased", "scibert_scivocab_cased", "biobert_base"]
+# (model type, evaluated dataset) pairs, every model type is evaluated on its own and on other datasets
+EVALUATIONS = [
+    ("wiki", "wiki"),
+    ("bio", "bio"),
+    ("wiki_to_bio", "bio"),
+    ("bio_to_wiki", "wiki"),
+    ("wiki", "factbank"),
+    ("bio", "factbank"),
+    ("wiki", "bio"),
+    ("bio", "wiki"),
+]
+TASK_DEFAULTS = {
+    "ner": {
+        "data_dir": "../uncertainty_dataset/output_datasets/result",
+        "experiments_dir": "ner_experiments",
+    },
+    "classification": {
+        "data_dir": "../uncertainty_dataset/output_datasets/result/classification",
+        "experiments_dir": "classification_experiment",
+    },
+}
+
+
+def find_checkpoints(experiments_dir, base_model, model_types, seeds):
+    """Returns (model type, seed, checkpoint dir) of the existing checkpoints of the base model."""
+    checkpoints = []
+    for model_type in model_types:
+        for seed in seeds:
+            checkpoint = os.path.join(experiments_dir, "{}_{}_{}".format(base_model, model_type, seed))
+            if os.path.isfile(os.path.join(checkpoint, WEIGHTS_NAME)):
+                checkpoints.append((model_type, seed, checkpoint))
+            else:
+                logger.warning("Skipping missing checkpoint %s", checkpoint)
+    return checkpoints
+
+
+def load_weights(model, model_class, checkpoint, device):
+    """Loads the checkpoint weights into the model, the model is only created for the first checkpoint."""
+    if model is None:
+        model = model_class.from_pretrained(checkpoint)
+        model.to(device)
+    else:
+        model.load_state_dict(torch.load(os.path.join(checkpoint, WEIGHTS_NAME), map_location=device))
+    model.eval()
+    return model
+
+
+def write_results(output_file, results):
+    with open(output_file, "w") as writer:
+        for key in sorted(results.keys()):
+            writer.write("{} = {}\n".format(key, str(results[key])))
+
+
+def load_ner_dataset(task_args, tokenizer):
+    # Same features as run_ner.py --do_predict, cached under the base model name and shared by all checkpoints
+    labels = get_labels(task_args.labels)
+    return run_ner.load_and_cache_examples(task_args, tokenizer, labels, CrossEntropyLoss().ignore_index, mode="test")
+
+
+def evaluate_ner(task_args, tokenizer, eval_dataset, checkpoints, output_dirs, ensemble_output_dir=None):
+    labels = get_labels(task_args.labels)
+    pad_token_label_id = CrossEntropyLoss().ignore_index
+    test_file = os.path.join(task_args.data_dir, "test.txt")
+    if ensemble_output_dir is not None:
+        models = [load_weights(None, AutoModelForTokenClassification, checkpoint, task_args.device)
+                  for checkpoint in checkpoints]
+        member_results, ensemble_results, member_predictions, ensemble_predictions = run_ner.evaluate_ensemble(
+            task_args, models, tokenizer, labels, pad_token_label_id, mode="test", eval_dataset=eval_dataset,
+        )
+        for output_dir, result, predictions in zip(output_dirs, member_results, member_predictions):
+            write_results(os.path.join(output_dir, "test_results.txt"), result)
+            write_predictions_to_file(test_file, os.path.join(output_dir, "test_predictions.txt"), predictions)
+        write_results(os.path.join(ensemble_output_dir, "test_results.txt"), ensemble_results)
+        write_predictions_to_file(test_file, os.path.join(ensemble_output_dir, "test_predictions.txt"),
+                                  ensemble_predictions)
+        return
+
+    model = None
+    for checkpoint, output_dir in zip(checkpoints, output_dirs):
+        model = load_weights(model, AutoModelForTokenClassification, checkpoint, task_args.device)
+        result, predictions, _ = run_ner.evaluate(
+            task_args, model, tokenizer, labels, pad_token_label_id, mode="test", eval_dataset=eval_dataset,
+        )
+        write_results(os.path.join(output_dir, "test_results.txt"), result)
+        write_predictions_to_file(test_file, os.path.join(output_dir, "test_predictions.txt"), predictions)
+
+
+def load_classification_dataset(task_args, tokenizer):
+    task_args.task_name = task_args.task_name.lower()
+    task_args.output_mode = output_modes[task_args.task_name]
+    # Same features as run_classification.py --do_eval, cached under the base model name and shared by all checkpoints
+    return run_classification.load_and_cache_examples(task_args, task_args.task_name, tokenizer, evaluate=True)
+
+
+def evaluate_classification(task_args, tokenizer, eval_dataset, checkpoints, output_dirs, ensemble_output_dir=None):
+    if ensemble_output_dir is not None:
+        models = [load_weights(None, AutoModelForSequenceClassification, checkpoint, task_args.device)
+                  for checkpoint in checkpoints]
+        member_results, ensemble_results = run_classification.evaluate_ensemble(
+            task_args, models, tokenizer, eval_dataset=eval_dataset
+        )
+        for output_dir, result in zip(output_dirs, member_results):
+            write_results(os.path.join(output_dir, "eval_results.txt"), result)
+        write_results(os.path.join(ensemble_output_dir, "eval_results.txt"), ensemble_results)
+        return
+
+    model = None
+    for checkpoint, output_dir in zip(checkpoints, output_dirs):
+        model = load_weights(model, AutoModelForSequenceClassification, checkpoint, task_args.device)
+        # evaluate writes eval_results.txt to the output dir
+        task_args.output_dir = output_dir
+        run_classification.evaluate(task_args, model, tokenizer, eval_dataset=eval_dataset)
+
+
+TASKS = {
+    "ner": (run_ner.parse_args, load_ner_dataset, evaluate_ner),
+    "classification": (run_classification.parse_args, load_classification_dataset, evaluate_classification),
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--task", required=True, choices=sorted(TASKS), help="Task the models were fine-tuned for.")
+    parser.add_argument("--data_dir", default=None, type=str, help="Directory with a folder of every dataset.")
+    parser.add_argument(
+        "--experiments_dir", default=None, type=str, help="Directory with the {base_model}_{model_type}_{seed} models.",
+    )
+    parser.add_argument("--base_models", nargs="+", default=BASE_MODELS, help="Base models to evaluate.")
+    parser.add_argument("--datasets", nargs="+", default=None, help="Only evaluate on these datasets.")
+    parser.add_argument("--seeds_start", default=1, type=int, help="First seed of the models.")
+    parser.add_argument("--number_of_seeds", default=20, type=int, help="Number of seeds of every model type.")
+    parser.add_argument("--model_type", default="bert", type=str, help="Model type of all the models.")
+    parser.add_argument("--max_seq_length", default=512, type=int, help="Same as for run_ner.py.")
+    parser.add_argument("--labels", default="../labels.txt", type=str, help="NER labels file, same as for run_ner.py.")
+    parser.add_argument("--task_name", default="hedge", type=str, help="Same as for run_classification.py.")
+    parser.add_argument(
+        "--ensemble",
+        action="store_true",
+        help="Evaluate all seeds of a model type in a single pass over the data, with all of them on the device at "
+             "once, and also write the results of the ensemble averaging their logits to "
+             "results/{base_model}_{model_type}_at_{dataset}_ensemble.",
+    )
+    args, task_argv = parser.parse_known_args()
+    for key, value in TASK_DEFAULTS[args.task].items():
+        if getattr(args, key) is None:
+            setattr(args, key, value)
+    return args, task_argv
+
+
+def main():
+    args, task_argv = parse_args()
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    parse_task_args, load_dataset, evaluate_task = TASKS[args.task]
+    seeds = range(args.seeds_start, args.seeds_start + args.number_of_seeds)
+    datasets = [dataset for _, dataset in EVALUATIONS if args.datasets is None or dataset in args.datasets]
+
+    for base_model in args.base_models:
+        tokenizer = None
+        for dataset in sorted(set(datasets)):
+            model_types = [model_type for model_type, evaluated_at in EVALUATIONS if evaluated_at == dataset]
+            checkpoints = find_checkpoints(args.experiments_dir, base_model, model_types, seeds)
+            if not checkpoints:
+                continue
+            output_dirs = [
+                os.path.join(
+                    args.experiments_dir, "results", "{}_{}_at_{}_{}".format(base_model, model_type, dataset, seed)
+                )
+                for model_type, seed, _ in checkpoints
+            ]
+            for output_dir in output_dirs:
+                os.makedirs(output_dir, exist_ok=True)
+
+            # The model name only names the features cache, the output dir is set per checkpoint where needed
+            task_args = parse_task_args(
+                [
+                    "--data_dir", os.path.join(args.data_dir, dataset),
+                    "--model_type", args.model_type,
+                    "--model_name_or_path", base_model,
+                    "--output_dir", output_dirs[0],
+                    "--max_seq_length", str(args.max_seq_length),
+                ]
+                + (["--labels", args.labels] if args.task == "ner" else ["--task_name", args.task_name])
+                + task_argv
+            )
+            task_args.device = torch.device("cuda" if torch.cuda.is_available() and not task_args.no_cuda else "cpu")
+            task_args.n_gpu = 0 if task_args.no_cuda else torch.cuda.device_count()
+            if tokenizer is None:
+                # All models fine-tuned from the same base model share its vocabulary
+                tokenizer = AutoTokenizer.from_pretrained(checkpoints[0][2])
+
+            eval_dataset = load_dataset(task_args, tokenizer)
+
+            logger.info("Evaluating %d %s models at %s", len(checkpoints), base_model, dataset)
+            if not args.ensemble:
+                evaluate_task(
+                    task_args, tokenizer, eval_dataset, [checkpoint for _, _, checkpoint in checkpoints], output_dirs
+                )
+                continue
+            for model_type in model_types:
+                seed_ids = [i for i, (checkpoint_type, _, _) in enumerate(checkpoints) if checkpoint_type == model_type]
+                if not seed_ids:
+                    continue
+                # Not matched by aggregate_results.py, so the ensemble doesn't count as another seed
+                ensemble_output_dir = os.path.join(
+                    args.experiments_dir, "results", "{}_{}_at_{}_ensemble".format(base_model, model_type, dataset)
+                )
+                os.makedirs(ensemble_output_dir, exist_ok=True)
+                evaluate_task(
+                    task_args,
+                    tokenizer,
+                    eval_dataset,
+                    [checkpoints[i][2] for i in seed_ids],
+                    [output_dirs[i] for i in seed_ids],
+                    ensemble_output_dir,
+                )
+
+
+if __name__ == "__main__":
+    main()
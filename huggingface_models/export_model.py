@@ -0,0 +1,133 @@
+""" Exports a model fine-tuned by run_ner.py or run_classification.py to TorchScript and, optionally, ONNX.
+
+The export directory gets the traced model, the tokenizer and config of the fine-tuned model and an
+export_config.json describing the exported files, so it can be loaded by demo/model.py with
+backend="torchscript" or backend="onnx".
+"""
+
+import argparse
+import json
+import logging
+import os
+
+import torch
+from transformers import AutoConfig, AutoModelForSequenceClassification, AutoModelForTokenClassification, AutoTokenizer
+
+
+logger = logging.getLogger(__name__)
+
+EXPORT_CONFIG_FILE = "export_config.json"
+TORCHSCRIPT_FILE = "model.pt"
+ONNX_FILE = "model.onnx"
+
+MODEL_CLASSES = {
+    "ner": AutoModelForTokenClassification,
+    "classification": AutoModelForSequenceClassification,
+}
+
+
+def input_names_for(config):
+    # Same inputs as run_ner.py and run_classification.py feed to the model
+    if config.model_type in ["bert", "xlnet", "albert"]:
+        return ["input_ids", "attention_mask", "token_type_ids"]
+    return ["input_ids", "attention_mask"]
+
+
+def example_inputs(tokenizer, input_names, texts, max_length):
+    # Without max_length all texts would be padded to tokenizer.max_len, so every example had the same length
+    encoded = tokenizer.batch_encode_plus(texts, max_length=max_length, pad_to_max_length=True)
+    return tuple(torch.tensor(encoded[name], dtype=torch.long) for name in input_names)
+
+
+def export_torchscript(model, inputs, check_inputs, output_path):
+    # Tracing records the operations for these inputs, check_inputs of another shape verify that the traced
+    # graph doesn't depend on the batch size or sequence length.
+    traced_model = torch.jit.trace(model, inputs, check_inputs=[check_inputs])
+    torch.jit.save(traced_model, output_path)
+    return traced_model
+
+
+def export_onnx(model, inputs, input_names, logits_axes, output_path, opset_version=11):
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["logits"] = logits_axes
+    torch.onnx.export(
+        model,
+        inputs,
+        output_path,
+        input_names=input_names,
+        output_names=["logits"],
+        dynamic_axes=dynamic_axes,
+        opset_version=opset_version,
+    )
+
+
+def prediction_mismatch_rate(model, exported_model, inputs):
+    """Fraction of different argmax predictions of the eager and the exported model."""
+    with torch.no_grad():
+        logits = model(*inputs)[0]
+        exported_logits = exported_model(*inputs)[0]
+    return (logits.argmax(dim=-1) != exported_logits.argmax(dim=-1)).float().mean().item()
+
+
+def export_model(model_path, output_dir, task, onnx=False):
+    config = AutoConfig.from_pretrained(model_path, torchscript=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = MODEL_CLASSES[task].from_pretrained(model_path, config=config)
+    model.eval()
+
+    input_names = input_names_for(config)
+    inputs = example_inputs(
+        tokenizer, input_names, ["Export this model .", "It may be traced with other shapes ."], max_length=16
+    )
+    check_inputs = example_inputs(
+        tokenizer, input_names, ["A single , longer sentence to check the traced model ."], max_length=24
+    )
+
+    os.makedirs(output_dir, exist_ok=True)
+    export_config = {"task": task, "input_names": input_names, "torchscript_file": TORCHSCRIPT_FILE}
+    traced_model = export_torchscript(model, inputs, check_inputs, os.path.join(output_dir, TORCHSCRIPT_FILE))
+    logger.info(
+        "Fraction of different predictions of the TorchScript model: %.4f",
+        prediction_mismatch_rate(model, traced_model, check_inputs),
+    )
+    if onnx:
+        logits_axes = {0: "batch", 1: "sequence"} if task == "ner" else {0: "batch"}
+        export_onnx(model, inputs, input_names, logits_axes, os.path.join(output_dir, ONNX_FILE))
+        export_config["onnx_file"] = ONNX_FILE
+
+    tokenizer.save_pretrained(output_dir)
+    config.save_pretrained(output_dir)
+    with open(os.path.join(output_dir, EXPORT_CONFIG_FILE), "w") as f:
+        json.dump(export_config, f, indent=2)
+    logger.info("Exported %s model from %s to %s", task, model_path, output_dir)
+    return export_config
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model_path",
+        default=None,
+        type=str,
+        required=True,
+        help="Output directory of run_ner.py or run_classification.py with the fine-tuned model.",
+    )
+    parser.add_argument(
+        "--output_dir", default=None, type=str, required=True, help="Directory to write the exported model to.",
+    )
+    parser.add_argument(
+        "--task", default="ner", choices=sorted(MODEL_CLASSES), help="Task the model was fine-tuned for.",
+    )
+    parser.add_argument("--onnx", action="store_true", help="Also export the model to ONNX.")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    export_model(args.model_path, args.output_dir, args.task, args.onnx)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+
+try:
+    import torch
+    import transformers
+except ImportError:
+    torch = None
+    transformers = None
+
+if torch is not None:
+    import export_model
+
+
+VOCAB = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', 'a', 'cat', 'may', 'fly', 'does', 'not', '.', ',']
+
+
+@unittest.skipIf(torch is None, 'Requires torch and transformers')
+class ExportModelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.model_path = os.path.join(self.tmp_dir.name, 'model')
+        self.export_path = os.path.join(self.tmp_dir.name, 'export')
+        os.makedirs(self.model_path)
+        vocab_file = os.path.join(self.model_path, 'vocab.txt')
+        with open(vocab_file, 'w') as f:
+            f.write('\n'.join(VOCAB) + '\n')
+        transformers.BertTokenizer(vocab_file).save_pretrained(self.model_path)
+
+        torch.manual_seed(42)
+        self.config = transformers.BertConfig(
+            vocab_size=len(VOCAB), hidden_size=16, num_hidden_layers=2, num_attention_heads=2,
+            intermediate_size=32, num_labels=5,
+        )
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _predictions(self, model, inputs):
+        with torch.no_grad():
+            return model(*inputs)[0].argmax(dim=-1)
+
+    def _assert_same_predictions(self, model_class, task):
+        model = model_class(self.config)
+        model.eval()
+        model.save_pretrained(self.model_path)
+        export_model.export_model(self.model_path, self.export_path, task)
+
+        traced_model = torch.jit.load(os.path.join(self.export_path, export_model.TORCHSCRIPT_FILE))
+        tokenizer = transformers.BertTokenizer.from_pretrained(self.export_path)
+        # A batch size and sequence length different from the ones the model was traced with
+        inputs = export_model.example_inputs(tokenizer, export_model.input_names_for(self.config),
+                                             ['a cat may fly .', 'a cat does not', 'may a cat fly , a cat may'],
+                                             max_length=12)
+        self.assertTrue(torch.equal(self._predictions(model, inputs), self._predictions(traced_model, inputs)))
+
+    def test_traced_ner_model_has_same_token_predictions(self):
+        self._assert_same_predictions(transformers.BertForTokenClassification, 'ner')
+
+    def test_traced_classification_model_has_same_predictions(self):
+        self._assert_same_predictions(transformers.BertForSequenceClassification, 'classification')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+""" Mixed precision for the training and evaluation loops with torch.autocast and GradScaler. """
+
+
+import contextlib
+import os
+
+import torch
+
+
+PRECISIONS = ("fp32", "fp16", "bf16")
+SCALER_FILE = "scaler.pt"
+
+
+class MixedPrecision(object):
+    """Autocast context and loss scaling of a --precision.
+
+    fp16 only runs on CUDA and scales the loss so that small gradients don't underflow. bf16 has the exponent range
+    of fp32, so it needs no loss scaling and also runs on CPU. Weights and optimizer states stay in fp32.
+    """
+
+    def __init__(self, precision, device):
+        if precision not in PRECISIONS:
+            raise ValueError("Unknown precision: {}".format(precision))
+        if precision == "fp16" and device.type != "cuda":
+            raise ValueError("fp16 needs a CUDA device, use bf16 on CPU")
+        self.precision = precision
+        self.device = device
+        self.scaler = torch.cuda.amp.GradScaler() if precision == "fp16" else None
+
+    def autocast(self):
+        if self.precision == "fp32":
+            return contextlib.nullcontext()
+        dtype = torch.float16 if self.precision == "fp16" else torch.bfloat16
+        return torch.autocast(device_type=self.device.type, dtype=dtype)
+
+    def backward(self, loss):
+        if self.scaler is not None:
+            self.scaler.scale(loss).backward()
+        else:
+            loss.backward()
+
+    def step(self, optimizer, parameters, max_grad_norm):
+        """Clips the gradients and steps the optimizer, skipping the step if fp16 gradients overflowed."""
+        if self.scaler is not None:
+            # Gradients are clipped at their real scale
+            self.scaler.unscale_(optimizer)
+            torch.nn.utils.clip_grad_norm_(parameters, max_grad_norm)
+            self.scaler.step(optimizer)
+            self.scaler.update()
+        else:
+            torch.nn.utils.clip_grad_norm_(parameters, max_grad_norm)
+            optimizer.step()
+
+    def save(self, output_dir):
+        if self.scaler is not None:
+            torch.save(self.scaler.state_dict(), os.path.join(output_dir, SCALER_FILE))
+
+    def load(self, checkpoint_dir):
+        scaler_file = os.path.join(checkpoint_dir, SCALER_FILE)
+        if self.scaler is not None and os.path.isfile(scaler_file):
+            self.scaler.load_state_dict(torch.load(scaler_file))
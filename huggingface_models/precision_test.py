@@ -0,0 +1,46 @@
+import tempfile
+import unittest
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+if torch is not None:
+    import precision
+
+
+@unittest.skipIf(torch is None, 'Requires torch')
+class MixedPrecisionTestCase(unittest.TestCase):
+    def _train_step(self, mixed_precision):
+        torch.manual_seed(0)
+        model = torch.nn.Linear(4, 2)
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+        weight = model.weight.detach().clone()
+        with mixed_precision.autocast():
+            output = model(torch.ones(3, 4))
+        mixed_precision.backward(output.float().sum())
+        mixed_precision.step(optimizer, model.parameters(), max_grad_norm=1.0)
+        return output, weight, model.weight.detach()
+
+    def test_fp16_requires_cuda(self):
+        with self.assertRaises(ValueError):
+            precision.MixedPrecision('fp16', torch.device('cpu'))
+
+    def test_fp32_and_bf16_update_fp32_weights(self):
+        for name, dtype in [('fp32', torch.float32), ('bf16', torch.bfloat16)]:
+            output, weight, updated_weight = self._train_step(precision.MixedPrecision(name, torch.device('cpu')))
+            self.assertEqual(output.dtype, dtype)
+            self.assertEqual(updated_weight.dtype, torch.float32)
+            self.assertFalse(torch.equal(weight, updated_weight))
+
+    def test_save_and_load_without_scaler(self):
+        mixed_precision = precision.MixedPrecision('bf16', torch.device('cpu'))
+        with tempfile.TemporaryDirectory() as output_dir:
+            mixed_precision.save(output_dir)
+            mixed_precision.load(output_dir)
+            self.assertIsNone(mixed_precision.scaler)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+""" Opt-in torch.profiler window for the training and evaluation loops of run_ner.py and run_classification.py. """
+
+
+import argparse
+import contextlib
+import logging
+import os
+
+import torch
+
+try:
+    from torch.profiler import ProfilerActivity, profile, record_function
+except ImportError:  # torch < 1.8 only has the autograd profiler
+    from torch.autograd.profiler import profile, record_function
+
+    ProfilerActivity = None
+
+
+logger = logging.getLogger(__name__)
+
+
+def parse_profile_steps(value):
+    """Parses START:END into the (start, end) range of loop steps, END excluded."""
+    try:
+        start, end = (int(step) for step in value.split(":"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected START:END, got {}".format(value))
+    if not 0 <= start < end:
+        raise argparse.ArgumentTypeError("Expected 0 <= START < END, got {}".format(value))
+    return start, end
+
+
+class StepProfiler(object):
+    """Profiles the steps START <= step < END of a loop and exports a Chrome trace and an operator summary.
+
+    Steps are the batches taken from the iterable passed to iterate(), counted from 0. Fetching a batch is recorded
+    as a "data_loading" span, span(name) records any other part of a step. Without steps nothing is profiled and
+    spans cost nothing. Profilers can't be nested, a loop that starts inside the window of another one (e.g.
+    evaluation during training) is recorded as part of the outer profile.
+    """
+
+    # The profiler of the loop that is currently profiled
+    running = None
+
+    def __init__(self, steps, output_dir, name):
+        self.start, self.end = steps if steps is not None else (-1, -1)
+        self.output_dir = output_dir
+        self.name = name
+        self.step = 0
+        self.profiler = None
+
+    def _create_profiler(self):
+        use_cuda = torch.cuda.is_available()
+        if ProfilerActivity is None:
+            return profile(use_cuda=use_cuda, record_shapes=True)
+        activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if use_cuda else [])
+        return profile(activities=activities, record_shapes=True, profile_memory=True)
+
+    def span(self, name):
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return record_function(name)
+
+    def iterate(self, iterable):
+        iterator = iter(iterable)
+        while True:
+            if self.step == self.start and StepProfiler.running is None:
+                logger.info("Profiling %s steps %d to %d", self.name, self.start, self.end - 1)
+                self.profiler = self._create_profiler()
+                self.profiler.__enter__()
+                StepProfiler.running = self
+            elif self.step == self.end:
+                self.stop()
+            with self.span("data_loading"):
+                batch = next(iterator, None)
+            if batch is None:
+                return
+            self.step += 1
+            yield batch
+
+    def stop(self):
+        """Stops the profiler, if running, and exports its results. Call after the loop, it may end in the window."""
+        if self.profiler is None:
+            return
+        self.profiler.__exit__(None, None, None)
+        StepProfiler.running = None
+        os.makedirs(self.output_dir, exist_ok=True)
+        trace_file = os.path.join(self.output_dir, "{}_trace.json".format(self.name))
+        self.profiler.export_chrome_trace(trace_file)
+        sort_by = "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+        with open(os.path.join(self.output_dir, "{}_operators.txt".format(self.name)), "w") as f:
+            f.write(self.profiler.key_averages().table(sort_by=sort_by, row_limit=50))
+        logger.info("Saved %s profile to %s", self.name, self.output_dir)
+        self.profiler = None
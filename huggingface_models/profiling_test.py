@@ -0,0 +1,41 @@
+import argparse
+import os
+import tempfile
+import unittest
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+if torch is not None:
+    import profiling
+
+
+@unittest.skipIf(torch is None, 'Requires torch')
+class StepProfilerTestCase(unittest.TestCase):
+    def test_parse_profile_steps(self):
+        self.assertEqual(profiling.parse_profile_steps('2:5'), (2, 5))
+        for value in ['5', '5:2', '-1:3', 'a:b']:
+            with self.assertRaises(argparse.ArgumentTypeError):
+                profiling.parse_profile_steps(value)
+
+    def test_without_steps_yields_all_batches(self):
+        profiler = profiling.StepProfiler(None, 'unused', 'train')
+        self.assertEqual(list(profiler.iterate(range(4))), [0, 1, 2, 3])
+        profiler.stop()
+
+    def test_exports_trace_and_operators_of_window(self):
+        with tempfile.TemporaryDirectory() as profile_dir:
+            profiler = profiling.StepProfiler((1, 3), profile_dir, 'train')
+            for batch in profiler.iterate([torch.ones(4)] * 5):
+                with profiler.span('forward'):
+                    (batch * 2).sum()
+            profiler.stop()
+            self.assertTrue(os.path.isfile(os.path.join(profile_dir, 'train_trace.json')))
+            self.assertTrue(os.path.isfile(os.path.join(profile_dir, 'train_operators.txt')))
+            self.assertIsNone(profiling.StepProfiler.running)
+
+
+if __name__ == '__main__':
+    unittest.main()
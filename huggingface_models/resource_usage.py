@@ -0,0 +1,151 @@
+""" Wall time and peak memory measurements for the training and evaluation loops. """
+
+
+import logging
+import resource
+import sys
+import time
+
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+
+def peak_rss_mb():
+    """Peak resident set size of the current process (not resettable)."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    return max_rss / 2 ** 20 if sys.platform == "darwin" else max_rss / 2 ** 10
+
+
+def current_rss_mb():
+    """Resident set size of the current process, falls back to the peak where /proc isn't available."""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return peak_rss_mb()
+    return resident_pages * resource.getpagesize() / 2 ** 20
+
+
+class LoopStats(object):
+    """Measures the wall time and peak memory of a loop from the moment it's created.
+
+    The peak RSS of the loop is sampled at every batch_done(), ru_maxrss would be the peak of the whole process.
+    The stats are timings of the machine, not metrics, so they are logged instead of written to the results files.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self.peak_rss_mb = current_rss_mb()
+        self.start_time = time.perf_counter()
+
+    def batch_done(self):
+        self.peak_rss_mb = max(self.peak_rss_mb, current_rss_mb())
+
+    def summary(self, num_examples):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        runtime = time.perf_counter() - self.start_time
+        stats = {
+            "runtime": runtime,
+            "examples_per_second": num_examples / runtime if runtime > 0 else 0.0,
+            "peak_rss_mb": self.peak_rss_mb,
+            "process_peak_rss_mb": peak_rss_mb(),
+        }
+        if self.device.type == "cuda":
+            stats["peak_cuda_memory_mb"] = torch.cuda.max_memory_allocated(self.device) / 2 ** 20
+        return stats
+
+    def log(self, num_examples, name):
+        stats = self.summary(num_examples)
+        logger.info("***** %s loop stats *****", name)
+        for key in sorted(stats.keys()):
+            logger.info("  %s = %s", key, str(stats[key]))
+        return stats
+
+
+class TrainingStats(object):
+    """Throughput, padding and wall time split of a training loop, per logging window and for the whole run.
+
+    The wall time between consecutive calls is attributed to waiting for the data loader (batch_loaded), to the
+    forward, backward and optimizer passes (compute_done) or to anything else, like evaluation and checkpoints
+    (other_done). Compute times are as seen by the host, i.e. up to the last synchronization with the device.
+    """
+
+    COUNTERS = ("batches", "examples", "real_tokens", "padded_tokens", "data_wait_seconds", "compute_seconds", "other_seconds")
+
+    def __init__(self, device):
+        self.device = device
+        self.total = dict.fromkeys(self.COUNTERS, 0)
+        self.windows = []
+        self._start_window()
+        self._mark = time.perf_counter()
+
+    def _start_window(self):
+        self.window = dict.fromkeys(self.COUNTERS, 0)
+        self.window_peak_rss_mb = current_rss_mb()
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def _add(self, key, value):
+        self.window[key] += value
+        self.total[key] += value
+
+    def _elapsed(self):
+        now = time.perf_counter()
+        elapsed = now - self._mark
+        self._mark = now
+        return elapsed
+
+    def batch_loaded(self, num_examples, real_tokens, padded_tokens):
+        self._add("data_wait_seconds", self._elapsed())
+        self._add("batches", 1)
+        self._add("examples", num_examples)
+        self._add("real_tokens", real_tokens)
+        self._add("padded_tokens", padded_tokens)
+        self.window_peak_rss_mb = max(self.window_peak_rss_mb, current_rss_mb())
+
+    def compute_done(self):
+        self._add("compute_seconds", self._elapsed())
+
+    def other_done(self):
+        self._add("other_seconds", self._elapsed())
+
+    @staticmethod
+    def _rates(counters):
+        runtime = counters["data_wait_seconds"] + counters["compute_seconds"]
+        padded_tokens = counters["padded_tokens"]
+        return {
+            "seconds_per_batch": runtime / counters["batches"] if counters["batches"] > 0 else 0.0,
+            "examples_per_second": counters["examples"] / runtime if runtime > 0 else 0.0,
+            "real_tokens_per_second": counters["real_tokens"] / runtime if runtime > 0 else 0.0,
+            "padded_tokens_per_second": counters["padded_tokens"] / runtime if runtime > 0 else 0.0,
+            "padding_ratio": 1 - counters["real_tokens"] / padded_tokens if padded_tokens > 0 else 0.0,
+            "data_wait_fraction": counters["data_wait_seconds"] / runtime if runtime > 0 else 0.0,
+            "data_wait_seconds": counters["data_wait_seconds"],
+            "compute_seconds": counters["compute_seconds"],
+            "other_seconds": counters["other_seconds"],
+        }
+
+    def window_summary(self, global_step):
+        """Returns the stats since the previous window and starts a new one."""
+        stats = {**self._rates(self.window), "peak_rss_mb": self.window_peak_rss_mb}
+        if self.device.type == "cuda":
+            stats["peak_cuda_memory_mb"] = torch.cuda.max_memory_allocated(self.device) / 2 ** 20
+        self.windows.append({"global_step": global_step, **stats})
+        self._start_window()
+        return stats
+
+    def summary(self):
+        """Returns the stats of the whole run and of every logging window, ready to be saved as JSON."""
+        total = {**self._rates(self.total), "examples": self.total["examples"], "peak_rss_mb": peak_rss_mb()}
+        if self.device.type == "cuda":
+            # The peak since the last window, the windows before it have their own peaks
+            peak_cuda_memory = [torch.cuda.max_memory_allocated(self.device) / 2 ** 20]
+            peak_cuda_memory += [window["peak_cuda_memory_mb"] for window in self.windows]
+            total["peak_cuda_memory_mb"] = max(peak_cuda_memory)
+        return {"total": total, "windows": self.windows}
@@ -0,0 +1,69 @@
+import unittest
+from unittest import mock
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+if torch is not None:
+    import resource_usage
+
+
+@unittest.skipIf(torch is None, 'Requires torch')
+class TrainingStatsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.time = 0.0
+        patcher = mock.patch('time.perf_counter', lambda: self.time)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.stats = resource_usage.TrainingStats(torch.device('cpu'))
+
+    def _step(self, wait, compute, other, num_examples, real_tokens, padded_tokens):
+        self.time += wait
+        self.stats.batch_loaded(num_examples, real_tokens, padded_tokens)
+        self.time += compute
+        self.stats.compute_done()
+        self.time += other
+        self.stats.other_done()
+
+    def test_window_summary_splits_wall_time(self):
+        self._step(1.0, 3.0, 10.0, num_examples=8, real_tokens=300, padded_tokens=400)
+        stats = self.stats.window_summary(global_step=1)
+        self.assertEqual(stats['seconds_per_batch'], 4.0)
+        self.assertEqual(stats['examples_per_second'], 2.0)
+        self.assertEqual(stats['real_tokens_per_second'], 75.0)
+        self.assertEqual(stats['padded_tokens_per_second'], 100.0)
+        self.assertEqual(stats['padding_ratio'], 0.25)
+        self.assertEqual(stats['data_wait_fraction'], 0.25)
+        self.assertEqual(stats['other_seconds'], 10.0)
+
+    def test_windows_are_reset_and_summed_in_total(self):
+        self._step(1.0, 1.0, 0.0, num_examples=4, real_tokens=100, padded_tokens=100)
+        self.stats.window_summary(global_step=1)
+        self._step(0.0, 2.0, 0.0, num_examples=4, real_tokens=50, padded_tokens=100)
+        second_window = self.stats.window_summary(global_step=2)
+        self.assertEqual(second_window['examples_per_second'], 2.0)
+        self.assertEqual(second_window['data_wait_seconds'], 0.0)
+
+        summary = self.stats.summary()
+        self.assertEqual([window['global_step'] for window in summary['windows']], [1, 2])
+        self.assertEqual(summary['total']['examples'], 8)
+        self.assertEqual(summary['total']['padding_ratio'], 0.25)
+
+
+@unittest.skipIf(torch is None, 'Requires torch')
+class LoopStatsTestCase(unittest.TestCase):
+    def test_peak_rss_is_sampled_during_the_loop(self):
+        rss_mb = iter([100.0, 300.0, 200.0])
+        with mock.patch('resource_usage.current_rss_mb', lambda: next(rss_mb)):
+            stats = resource_usage.LoopStats(torch.device('cpu'))
+            stats.batch_done()
+            stats.batch_done()
+        summary = stats.summary(num_examples=4)
+        self.assertEqual(summary['peak_rss_mb'], 300.0)
+        self.assertGreaterEqual(summary['process_peak_rss_mb'], 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
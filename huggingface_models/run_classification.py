@@ -26,7 +26,7 @@ from typing import Optional
 
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
 
@@ -44,9 +44,13 @@ from argument_parsers import (
     TrainingArguments,
 )
 from transformers import glue_convert_examples_to_features as convert_examples_to_features
+from binary_features import BinaryFeaturesDataset, features_to_arrays, load_arrays, save_arrays
 from classification_utils import compute_metrics
 from classification_utils import output_modes
 from classification_utils import processors
+from precision import PRECISIONS, MixedPrecision
+from profiling import StepProfiler, parse_profile_steps
+from resource_usage import LoopStats
 
 try:
     from torch.utils.tensorboard import SummaryWriter
@@ -107,18 +111,14 @@ def train(args, train_dataset, model, tokenizer):
         optimizer.load_state_dict(torch.load(os.path.join(args.model_name_or_path, "optimizer.pt")))
         scheduler.load_state_dict(torch.load(os.path.join(args.model_name_or_path, "scheduler.pt")))
 
-    if args.fp16:
-        try:
-            from apex import amp
-        except ImportError:
-            raise ImportError("Please install apex from https://www.github.com/nvidia/apex to use fp16 training.")
-        model, optimizer = amp.initialize(model, optimizer, opt_level=args.fp16_opt_level)
+    mixed_precision = MixedPrecision(args.precision, args.device)
+    mixed_precision.load(args.model_name_or_path)
 
-    # multi-gpu training (should be after apex fp16 initialization)
+    # multi-gpu training
     if args.n_gpu > 1:
         model = torch.nn.DataParallel(model)
 
-    # Distributed training (should be after apex fp16 initialization)
+    # Distributed training
     if args.local_rank != -1:
         model = torch.nn.parallel.DistributedDataParallel(
             model, device_ids=[args.local_rank], output_device=args.local_rank, find_unused_parameters=True,
@@ -162,9 +162,10 @@ def train(args, train_dataset, model, tokenizer):
         epochs_trained, int(args.num_train_epochs), desc="Epoch", disable=args.local_rank not in [-1, 0],
     )
     set_seed(args)  # Added here for reproducibility
+    profiler = StepProfiler(args.profile_steps, args.profile_dir, "train")
     for _ in train_iterator:
         epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=args.local_rank not in [-1, 0])
-        for step, batch in enumerate(epoch_iterator):
+        for step, batch in enumerate(profiler.iterate(epoch_iterator)):
 
             # Skip past any already trained steps if resuming training
             if steps_trained_in_current_epoch > 0:
@@ -178,7 +179,8 @@ def train(args, train_dataset, model, tokenizer):
                 inputs["token_type_ids"] = (
                     batch[2] if args.model_type in ["bert", "xlnet", "albert"] else None
                 )  # XLM, DistilBERT, RoBERTa, and XLM-RoBERTa don't use segment_ids
-            outputs = model(**inputs)
+            with profiler.span("forward"), mixed_precision.autocast():
+                outputs = model(**inputs)
             loss = outputs[0]  # model outputs are always tuple in transformers (see doc)
 
             if args.n_gpu > 1:
@@ -186,11 +188,8 @@ def train(args, train_dataset, model, tokenizer):
             if args.gradient_accumulation_steps > 1:
                 loss = loss / args.gradient_accumulation_steps
 
-            if args.fp16:
-                with amp.scale_loss(loss, optimizer) as scaled_loss:
-                    scaled_loss.backward()
-            else:
-                loss.backward()
+            with profiler.span("backward"):
+                mixed_precision.backward(loss)
 
             tr_loss += loss.item()
             if (step + 1) % args.gradient_accumulation_steps == 0 or (
@@ -198,35 +197,32 @@ def train(args, train_dataset, model, tokenizer):
                     len(epoch_iterator) <= args.gradient_accumulation_steps
                     and (step + 1) == len(epoch_iterator)
             ):
-                if args.fp16:
-                    torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), args.max_grad_norm)
-                else:
-                    torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
-
-                optimizer.step()
-                scheduler.step()  # Update learning rate schedule
-                model.zero_grad()
+                with profiler.span("optimizer_step"):
+                    mixed_precision.step(optimizer, model.parameters(), args.max_grad_norm)
+                    scheduler.step()  # Update learning rate schedule
+                    model.zero_grad()
                 global_step += 1
 
                 if args.local_rank in [-1, 0] and args.logging_steps > 0 and global_step % args.logging_steps == 0:
-                    logs = {}
-                    if (
-                            args.local_rank == -1 and args.evaluate_during_training
-                    ):  # Only evaluate when single GPU otherwise metrics may not average well
-                        results = evaluate(args, model, tokenizer)
-                        for key, value in results.items():
-                            eval_key = "eval_{}".format(key)
-                            logs[eval_key] = value
-
-                    loss_scalar = (tr_loss - logging_loss) / args.logging_steps
-                    learning_rate_scalar = scheduler.get_lr()[0]
-                    logs["learning_rate"] = learning_rate_scalar
-                    logs["loss"] = loss_scalar
-                    logging_loss = tr_loss
-
-                    for key, value in logs.items():
-                        tb_writer.add_scalar(key, value, global_step)
-                    print(json.dumps({**logs, **{"step": global_step}}))
+                    with profiler.span("metrics"):
+                        logs = {}
+                        if (
+                                args.local_rank == -1 and args.evaluate_during_training
+                        ):  # Only evaluate when single GPU otherwise metrics may not average well
+                            results = evaluate(args, model, tokenizer)
+                            for key, value in results.items():
+                                eval_key = "eval_{}".format(key)
+                                logs[eval_key] = value
+
+                        loss_scalar = (tr_loss - logging_loss) / args.logging_steps
+                        learning_rate_scalar = scheduler.get_lr()[0]
+                        logs["learning_rate"] = learning_rate_scalar
+                        logs["loss"] = loss_scalar
+                        logging_loss = tr_loss
+
+                        for key, value in logs.items():
+                            tb_writer.add_scalar(key, value, global_step)
+                        print(json.dumps({**logs, **{"step": global_step}}))
 
                 if args.local_rank in [-1, 0] and args.save_steps > 0 and global_step % args.save_steps == 0:
                     # Save model checkpoint
@@ -244,6 +240,7 @@ def train(args, train_dataset, model, tokenizer):
 
                     torch.save(optimizer.state_dict(), os.path.join(output_dir, "optimizer.pt"))
                     torch.save(scheduler.state_dict(), os.path.join(output_dir, "scheduler.pt"))
+                    mixed_precision.save(output_dir)
                     logger.info("Saving optimizer and scheduler states to %s", output_dir)
 
             if args.max_steps > 0 and global_step > args.max_steps:
@@ -253,20 +250,23 @@ def train(args, train_dataset, model, tokenizer):
             train_iterator.close()
             break
 
+    profiler.stop()
     if args.local_rank in [-1, 0]:
         tb_writer.close()
 
     return global_step, tr_loss / global_step
 
 
-def evaluate(args, model, tokenizer, prefix=""):
+def evaluate(args, model, tokenizer, prefix="", eval_dataset=None):
+    """eval_dataset of args.task_name is loaded with load_and_cache_examples unless it's already given."""
     # Loop to handle MNLI double evaluation (matched, mis-matched)
     eval_task_names = ("mnli", "mnli-mm") if args.task_name == "mnli" else (args.task_name,)
     eval_outputs_dirs = (args.output_dir, args.output_dir + "-MM") if args.task_name == "mnli" else (args.output_dir,)
 
     results = {}
     for eval_task, eval_output_dir in zip(eval_task_names, eval_outputs_dirs):
-        eval_dataset = load_and_cache_examples(args, eval_task, tokenizer, evaluate=True)
+        if eval_dataset is None or eval_task != args.task_name:
+            eval_dataset = load_and_cache_examples(args, eval_task, tokenizer, evaluate=True)
 
         if not os.path.exists(eval_output_dir) and args.local_rank in [-1, 0]:
             os.makedirs(eval_output_dir)
@@ -286,9 +286,15 @@ def evaluate(args, model, tokenizer, prefix=""):
         logger.info("  Batch size = %d", args.eval_batch_size)
         eval_loss = 0.0
         nb_eval_steps = 0
-        preds = None
-        out_label_ids = None
-        for batch in tqdm(eval_dataloader, desc="Evaluating"):
+        # Only the predicted labels are kept, written into preallocated buffers batch by batch
+        preds_dtype = np.int64 if args.output_mode == "classification" else np.float32
+        preds = np.empty(len(eval_dataset), dtype=preds_dtype)
+        out_label_ids = np.empty(len(eval_dataset), dtype=preds_dtype)
+        examples_done = 0
+        profiler = StepProfiler(args.profile_steps, args.profile_dir, "evaluate_{}{}".format(eval_task, prefix))
+        mixed_precision = MixedPrecision(args.precision, args.device)
+        eval_stats = LoopStats(args.device)
+        for batch in profiler.iterate(tqdm(eval_dataloader, desc="Evaluating")):
             model.eval()
             batch = tuple(t.to(args.device) for t in batch)
 
@@ -298,24 +304,28 @@ def evaluate(args, model, tokenizer, prefix=""):
                     inputs["token_type_ids"] = (
                         batch[2] if args.model_type in ["bert", "xlnet", "albert"] else None
                     )  # XLM, DistilBERT, RoBERTa, and XLM-RoBERTa don't use segment_ids
-                outputs = model(**inputs)
+                with profiler.span("forward"), mixed_precision.autocast():
+                    outputs = model(**inputs)
                 tmp_eval_loss, logits = outputs[:2]
 
                 eval_loss += tmp_eval_loss.mean().item()
             nb_eval_steps += 1
-            if preds is None:
-                preds = logits.detach().cpu().numpy()
-                out_label_ids = inputs["labels"].detach().cpu().numpy()
-            else:
-                preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
-                out_label_ids = np.append(out_label_ids, inputs["labels"].detach().cpu().numpy(), axis=0)
+            with profiler.span("metrics"):
+                if args.output_mode == "classification":
+                    batch_preds = logits.argmax(dim=1)
+                elif args.output_mode == "regression":
+                    batch_preds = logits.float().squeeze(dim=1)
+                batch_size = len(batch_preds)
+                preds[examples_done: examples_done + batch_size] = batch_preds.cpu().numpy()
+                out_label_ids[examples_done: examples_done + batch_size] = inputs["labels"].cpu().numpy()
+            examples_done += batch_size
+            eval_stats.batch_done()
 
         eval_loss = eval_loss / nb_eval_steps
-        if args.output_mode == "classification":
-            preds = np.argmax(preds, axis=1)
-        elif args.output_mode == "regression":
-            preds = np.squeeze(preds)
-        result = compute_metrics(preds, out_label_ids)
+        eval_stats.log(len(eval_dataset), "Evaluation {}".format(prefix))
+        with profiler.span("metrics"):
+            result = compute_metrics(preds, out_label_ids)
+        profiler.stop()
         results.update(result)
         results['loss'] = eval_loss
 
@@ -329,6 +339,78 @@ def evaluate(args, model, tokenizer, prefix=""):
     return results
 
 
+def evaluate_ensemble(args, models, tokenizer, eval_dataset=None):
+    """Evaluates every model and the ensemble averaging their logits in a single pass over the data.
+
+    Every batch is moved to the device once and run through all models back to back, so K models (e.g. the seeds
+    of one configuration) cost one data pass instead of K. Returns (member results, ensemble results).
+    """
+    if eval_dataset is None:
+        eval_dataset = load_and_cache_examples(args, args.task_name, tokenizer, evaluate=True)
+
+    args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
+    eval_sampler = SequentialSampler(eval_dataset)
+    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
+
+    logger.info("***** Running ensemble evaluation of %d models *****", len(models))
+    logger.info("  Num examples = %d", len(eval_dataset))
+    logger.info("  Batch size = %d", args.eval_batch_size)
+    losses = np.zeros(len(models) + 1)
+    nb_eval_steps = 0
+    # Predictions of every model, the ensemble is the last row
+    preds_dtype = np.int64 if args.output_mode == "classification" else np.float32
+    preds = np.empty((len(models) + 1, len(eval_dataset)), dtype=preds_dtype)
+    out_label_ids = np.empty(len(eval_dataset), dtype=preds_dtype)
+    loss_function = torch.nn.CrossEntropyLoss() if args.output_mode == "classification" else torch.nn.MSELoss()
+    examples_done = 0
+    mixed_precision = MixedPrecision(args.precision, args.device)
+    eval_stats = LoopStats(args.device)
+    for model in models:
+        model.eval()
+    for batch in tqdm(eval_dataloader, desc="Evaluating"):
+        batch = tuple(t.to(args.device) for t in batch)
+
+        with torch.no_grad():
+            inputs = {"input_ids": batch[0], "attention_mask": batch[1], "labels": batch[3]}
+            if args.model_type != "distilbert":
+                inputs["token_type_ids"] = (
+                    batch[2] if args.model_type in ["bert", "xlnet", "albert"] else None
+                )  # XLM, DistilBERT, RoBERTa, and XLM-RoBERTa don't use segment_ids
+            all_logits = []
+            for i, model in enumerate(models):
+                with mixed_precision.autocast():
+                    tmp_eval_loss, logits = model(**inputs)[:2]
+                losses[i] += tmp_eval_loss.mean().item()
+                all_logits.append(logits.float())
+            all_logits.append(torch.stack(all_logits).mean(dim=0))
+            if args.output_mode == "classification":
+                losses[-1] += loss_function(all_logits[-1], inputs["labels"]).item()
+                batch_preds = torch.stack(all_logits).argmax(dim=2)
+            elif args.output_mode == "regression":
+                losses[-1] += loss_function(all_logits[-1].squeeze(dim=1), inputs["labels"]).item()
+                batch_preds = torch.stack(all_logits).squeeze(dim=2)
+        nb_eval_steps += 1
+        batch_size = batch_preds.shape[1]
+        preds[:, examples_done: examples_done + batch_size] = batch_preds.cpu().numpy()
+        out_label_ids[examples_done: examples_done + batch_size] = inputs["labels"].cpu().numpy()
+        examples_done += batch_size
+        eval_stats.batch_done()
+
+    eval_stats.log(len(eval_dataset), "Ensemble evaluation")
+    all_results = [
+        {**compute_metrics(model_preds, out_label_ids), "loss": loss / nb_eval_steps}
+        for model_preds, loss in zip(preds, losses)
+    ]
+    member_results, ensemble_results = all_results[:-1], all_results[-1]
+
+    logger.info("***** Ensemble eval results *****")
+    for i, results in enumerate(member_results):
+        logger.info("  model %d: f1 = %s", i, str(results["f1"]))
+    for key in sorted(ensemble_results.keys()):
+        logger.info("  ensemble %s = %s", key, str(ensemble_results[key]))
+    return member_results, ensemble_results
+
+
 def load_and_cache_examples(args, task, tokenizer, evaluate=False):
     if args.local_rank not in [-1, 0] and not evaluate:
         torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
@@ -336,18 +418,18 @@ def load_and_cache_examples(args, task, tokenizer, evaluate=False):
     processor = processors[task]()
     output_mode = output_modes[task]
     # Load data features from cache or dataset file
-    cached_features_file = os.path.join(
+    cached_features_dir = os.path.join(
         args.data_dir,
-        "cached_{}_{}_{}_{}".format(
+        "cached_{}_{}_{}_{}_bin".format(
             "dev" if evaluate else "train",
             list(filter(None, args.model_name_or_path.split("/"))).pop(),
             str(args.max_seq_length),
             str(task),
         ),
     )
-    if os.path.exists(cached_features_file) and not args.overwrite_cache:
-        logger.info("Loading features from cached file %s", cached_features_file)
-        features = torch.load(cached_features_file)
+    if os.path.exists(cached_features_dir) and not args.overwrite_cache:
+        logger.info("Loading features from cached dir %s", cached_features_dir)
+        arrays = load_arrays(cached_features_dir)
     else:
         logger.info("Creating features from dataset file at %s", args.data_dir)
         label_list = processor.get_labels()
@@ -360,23 +442,21 @@ def load_and_cache_examples(args, task, tokenizer, evaluate=False):
         features = convert_examples_to_features(
             examples, tokenizer, max_length=args.max_seq_length, label_list=label_list, output_mode=output_mode,
         )
+        arrays = features_to_arrays(
+            input_ids=[f.input_ids for f in features],
+            attention_mask=[f.attention_mask for f in features],
+            token_type_ids=[f.token_type_ids for f in features],
+            labels=[f.label for f in features],
+        )
         if args.local_rank in [-1, 0]:
-            logger.info("Saving features into cached file %s", cached_features_file)
-            torch.save(features, cached_features_file)
+            logger.info("Saving features into cached dir %s", cached_features_dir)
+            save_arrays(cached_features_dir, arrays)
 
     if args.local_rank == 0 and not evaluate:
         torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
 
-    # Convert to Tensors and build dataset
-    all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-    all_attention_mask = torch.tensor([f.attention_mask for f in features], dtype=torch.long)
-    all_token_type_ids = torch.tensor([f.token_type_ids for f in features], dtype=torch.long)
-    if output_mode == "classification":
-        all_labels = torch.tensor([f.label for f in features], dtype=torch.long)
-    elif output_mode == "regression":
-        all_labels = torch.tensor([f.label for f in features], dtype=torch.float)
-
-    dataset = TensorDataset(all_input_ids, all_attention_mask, all_token_type_ids, all_labels)
+    # glue_convert_examples_to_features pads with zero input and token type ids on the right
+    dataset = BinaryFeaturesDataset(arrays, args.max_seq_length)
     return dataset
 
 
@@ -421,13 +501,43 @@ class DataProcessingArguments:
     )
 
 
-def main():
+def parse_args(argv=None):
     parser = HfArgumentParser((ModelArguments, DataProcessingArguments, TrainingArguments))
-    model_args, dataprocessing_args, training_args = parser.parse_args_into_dataclasses()
+    parser.add_argument(
+        "--ensemble_model_dirs",
+        nargs="+",
+        default=None,
+        help="Fine-tuned models, e.g. the seeds of one configuration, evaluated by --do_eval instead of the model in "
+             "output_dir. All models and the ensemble averaging their logits are evaluated in a single pass over "
+             "the data, results are written to eval_ensemble_results.txt in output_dir.",
+    )
+    parser.add_argument(
+        "--profile_steps",
+        type=parse_profile_steps,
+        default=None,
+        help="START:END range of steps of every training and evaluation loop to profile with torch.profiler.",
+    )
+    parser.add_argument(
+        "--profile_dir",
+        type=str,
+        default=None,
+        help="Where to write the Chrome traces and operator summaries of --profile_steps, output_dir/profile by "
+             "default.",
+    )
+    model_args, dataprocessing_args, training_args, other_args = parser.parse_args_into_dataclasses(argv)
 
     # For now, let's merge all the sets of args into one,
     # but soon, we'll keep distinct sets of args, with a cleaner separation of concerns.
-    args = argparse.Namespace(**vars(model_args), **vars(dataprocessing_args), **vars(training_args))
+    args = argparse.Namespace(
+        **vars(model_args), **vars(dataprocessing_args), **vars(training_args), **vars(other_args)
+    )
+    if args.profile_dir is None:
+        args.profile_dir = os.path.join(args.output_dir, "profile")
+    return args
+
+
+def main():
+    args = parse_args()
 
     if (
             os.path.exists(args.output_dir)
@@ -457,12 +567,12 @@ def main():
         level=logging.INFO if args.local_rank in [-1, 0] else logging.WARN,
     )
     logger.warning(
-        "Process rank: %s, device: %s, n_gpu: %s, distributed training: %s, 16-bits training: %s",
+        "Process rank: %s, device: %s, n_gpu: %s, distributed training: %s, precision: %s",
         args.local_rank,
         device,
         args.n_gpu,
         bool(args.local_rank != -1),
-        args.fp16,
+        args.precision,
     )
 
     # Set seed
@@ -536,6 +646,23 @@ def main():
 
     # Evaluation
     results = {}
+    if args.ensemble_model_dirs and args.do_eval and args.local_rank in [-1, 0]:
+        os.makedirs(args.output_dir, exist_ok=True)
+        tokenizer = AutoTokenizer.from_pretrained(args.ensemble_model_dirs[0])
+        models = [
+            AutoModelForSequenceClassification.from_pretrained(model_dir).to(args.device)
+            for model_dir in args.ensemble_model_dirs
+        ]
+        member_results, ensemble_results = evaluate_ensemble(args, models, tokenizer)
+        results = {"ensemble_{}".format(k): v for k, v in ensemble_results.items()}
+        for model_dir, member_result in zip(args.ensemble_model_dirs, member_results):
+            model_name = os.path.basename(os.path.normpath(model_dir))
+            results.update({"{}_{}".format(model_name, k): v for k, v in member_result.items()})
+        with open(os.path.join(args.output_dir, "eval_ensemble_results.txt"), "w") as writer:
+            for key in sorted(results.keys()):
+                writer.write("%s = %s\n" % (key, str(results[key])))
+        return results
+
     if args.do_eval and args.local_rank in [-1, 0]:
         tokenizer = AutoTokenizer.from_pretrained(args.output_dir)
         checkpoints = [args.output_dir]
@@ -17,15 +17,15 @@
 
 import argparse
 import glob
+import json
 import logging
 import os
 import random
 
 import numpy as np
 import torch
-from seqeval.metrics import f1_score, precision_score, recall_score
 from torch.nn import CrossEntropyLoss
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
 
@@ -36,9 +36,30 @@ from transformers import (
     AutoConfig,
     AutoModelForTokenClassification,
     AutoTokenizer,
+    PreTrainedTokenizerFast,
     get_linear_schedule_with_warmup,
 )
-from utils_ner import convert_examples_to_features, get_labels, read_examples_from_file
+from binary_features import (
+    BinaryFeaturesDataset,
+    LengthBucketBatchSampler,
+    features_to_arrays,
+    load_arrays,
+    save_arrays,
+)
+from precision import PRECISIONS, MixedPrecision
+from profiling import StepProfiler, parse_profile_steps
+from resource_usage import LoopStats, TrainingStats
+from utils_ner import (
+    convert_examples_to_features,
+    convert_examples_to_features_batched,
+    decode_label_ids,
+    get_labels,
+    read_examples_from_file,
+    save_prediction_probabilities,
+    span_precision_recall_f1,
+    write_predictions_to_file,
+    WindowLogitsMerger,
+)
 
 try:
     from torch.utils.tensorboard import SummaryWriter
@@ -69,8 +90,20 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id):
         tb_writer = SummaryWriter()
 
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
+    if args.length_bucketing and args.local_rank == -1:
+        train_batch_sampler = LengthBucketBatchSampler(
+            train_dataset.lengths, args.train_batch_size, bucket_size_multiplier=args.bucket_size_multiplier
+        )
+        train_dataloader = DataLoader(
+            train_dataset, batch_sampler=train_batch_sampler, collate_fn=train_dataset.pad_batch
+        )
+    else:
+        if args.length_bucketing:
+            logger.warning("Length bucketing is not supported for distributed training, ignoring it")
+        train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
+        train_dataloader = DataLoader(
+            train_dataset, sampler=train_sampler, batch_size=args.train_batch_size, collate_fn=train_dataset.pad_batch
+        )
 
     if args.max_steps > 0:
         t_total = args.max_steps
@@ -100,18 +133,14 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id):
         optimizer.load_state_dict(torch.load(os.path.join(args.model_name_or_path, "optimizer.pt")))
         scheduler.load_state_dict(torch.load(os.path.join(args.model_name_or_path, "scheduler.pt")))
 
-    if args.fp16:
-        try:
-            from apex import amp
-        except ImportError:
-            raise ImportError("Please install apex from https://www.github.com/nvidia/apex to use fp16 training.")
-        model, optimizer = amp.initialize(model, optimizer, opt_level=args.fp16_opt_level)
+    mixed_precision = MixedPrecision(args.precision, args.device)
+    mixed_precision.load(args.model_name_or_path)
 
-    # multi-gpu training (should be after apex fp16 initialization)
+    # multi-gpu training
     if args.n_gpu > 1:
         model = torch.nn.DataParallel(model)
 
-    # Distributed training (should be after apex fp16 initialization)
+    # Distributed training
     if args.local_rank != -1:
         model = torch.nn.parallel.DistributedDataParallel(
             model, device_ids=[args.local_rank], output_device=args.local_rank, find_unused_parameters=True
@@ -155,15 +184,19 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id):
         epochs_trained, int(args.num_train_epochs), desc="Epoch", disable=args.local_rank not in [-1, 0]
     )
     set_seed(args)  # Added here for reproductibility
+    training_stats = TrainingStats(args.device)
+    profiler = StepProfiler(args.profile_steps, args.profile_dir, "train")
     for _ in train_iterator:
         epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=args.local_rank not in [-1, 0])
-        for step, batch in enumerate(epoch_iterator):
+        for step, batch in enumerate(profiler.iterate(epoch_iterator)):
 
             # Skip past any already trained steps if resuming training
             if steps_trained_in_current_epoch > 0:
                 steps_trained_in_current_epoch -= 1
                 continue
 
+            # The attention mask is 1 for real tokens and 0 for padding, counted before the batch leaves the CPU
+            training_stats.batch_loaded(len(batch[0]), int(batch[1].sum()), batch[1].numel())
             model.train()
             batch = tuple(t.to(args.device) for t in batch)
             inputs = {"input_ids": batch[0], "attention_mask": batch[1], "labels": batch[3]}
@@ -172,7 +205,8 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id):
                     batch[2] if args.model_type in ["bert", "xlnet"] else None
                 )  # XLM and RoBERTa don"t use segment_ids
 
-            outputs = model(**inputs)
+            with profiler.span("forward"), mixed_precision.autocast():
+                outputs = model(**inputs)
             loss = outputs[0]  # model outputs are always tuple in pytorch-transformers (see doc)
 
             if args.n_gpu > 1:
@@ -180,35 +214,33 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id):
             if args.gradient_accumulation_steps > 1:
                 loss = loss / args.gradient_accumulation_steps
 
-            if args.fp16:
-                with amp.scale_loss(loss, optimizer) as scaled_loss:
-                    scaled_loss.backward()
-            else:
-                loss.backward()
+            with profiler.span("backward"):
+                mixed_precision.backward(loss)
 
             tr_loss += loss.item()
+            training_stats.compute_done()
             if (step + 1) % args.gradient_accumulation_steps == 0:
-                if args.fp16:
-                    torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), args.max_grad_norm)
-                else:
-                    torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
-
-                optimizer.step()
-                scheduler.step()  # Update learning rate schedule
-                model.zero_grad()
+                with profiler.span("optimizer_step"):
+                    mixed_precision.step(optimizer, model.parameters(), args.max_grad_norm)
+                    scheduler.step()  # Update learning rate schedule
+                    model.zero_grad()
                 global_step += 1
+                training_stats.compute_done()
 
                 if args.local_rank in [-1, 0] and args.logging_steps > 0 and global_step % args.logging_steps == 0:
-                    # Log metrics
-                    if (
-                            args.local_rank == -1 and args.evaluate_during_training
-                    ):  # Only evaluate when single GPU otherwise metrics may not average well
-                        results, _ = evaluate(args, model, tokenizer, labels, pad_token_label_id, mode="dev")
-                        for key, value in results.items():
-                            tb_writer.add_scalar("eval_{}".format(key), value, global_step)
-                    tb_writer.add_scalar("lr", scheduler.get_lr()[0], global_step)
-                    tb_writer.add_scalar("loss", (tr_loss - logging_loss) / args.logging_steps, global_step)
-                    logging_loss = tr_loss
+                    with profiler.span("metrics"):
+                        # Log metrics
+                        if (
+                                args.local_rank == -1 and args.evaluate_during_training
+                        ):  # Only evaluate when single GPU otherwise metrics may not average well
+                            results, _, _ = evaluate(args, model, tokenizer, labels, pad_token_label_id, mode="dev")
+                            for key, value in results.items():
+                                tb_writer.add_scalar("eval_{}".format(key), value, global_step)
+                        tb_writer.add_scalar("lr", scheduler.get_lr()[0], global_step)
+                        tb_writer.add_scalar("loss", (tr_loss - logging_loss) / args.logging_steps, global_step)
+                        logging_loss = tr_loss
+                        for key, value in training_stats.window_summary(global_step).items():
+                            tb_writer.add_scalar("train_{}".format(key), value, global_step)
 
                 if args.local_rank in [-1, 0] and args.save_steps > 0 and global_step % args.save_steps == 0:
                     # Save model checkpoint
@@ -226,11 +258,12 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id):
 
                     torch.save(optimizer.state_dict(), os.path.join(output_dir, "optimizer.pt"))
                     torch.save(scheduler.state_dict(), os.path.join(output_dir, "scheduler.pt"))
+                    mixed_precision.save(output_dir)
                     logger.info("Saving optimizer and scheduler states to %s", output_dir)
 
                 if args.local_rank in [-1, 0] and args.eval_steps > 0 and global_step % args.eval_steps == 0:
-                    result, _ = evaluate(args, model, tokenizer, labels, pad_token_label_id, mode="dev",
-                                         prefix=str(global_step))
+                    result, _, _ = evaluate(args, model, tokenizer, labels, pad_token_label_id, mode="dev",
+                                            prefix=str(global_step))
                     eval_loss = result['loss']
                     eval_f1_score = result['f1']
                     eval_precision = result['precision']
@@ -241,6 +274,8 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id):
                     tb_writer.add_scalar('eval_precision', eval_precision, global_step)
                     tb_writer.add_scalar('eval_recall', eval_recall, global_step)
 
+            # Logging, evaluation and checkpoints
+            training_stats.other_done()
             if args.max_steps > 0 and global_step > args.max_steps:
                 epoch_iterator.close()
                 break
@@ -248,19 +283,101 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id):
             train_iterator.close()
             break
 
+    profiler.stop()
     if args.local_rank in [-1, 0]:
         tb_writer.close()
+        training_summary = training_stats.summary()
+        logger.info("  Training stats = %s", training_summary["total"])
+        os.makedirs(args.output_dir, exist_ok=True)
+        with open(os.path.join(args.output_dir, "training_stats.json"), "w") as f:
+            json.dump(training_summary, f, indent=2)
 
     return global_step, tr_loss / global_step
 
 
-def evaluate(args, model, tokenizer, labels, pad_token_label_id, mode, prefix=""):
-    eval_dataset = load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode=mode)
+class EvalPredictions(object):
+    """ Collects the token predictions of a single model over consecutive evaluation batches. """
+
+    def __init__(self, eval_dataset, num_examples, max_seq_length, labels, pad_token_label_id,
+                 return_probabilities=False):
+        self.labels = labels
+        self.pad_token_label_id = pad_token_label_id
+        self.return_probabilities = return_probabilities
+        # Only the argmax label ids are kept, written into preallocated buffers batch by batch.
+        # With dynamic padding batches are shorter than max_seq_length, the rest is left as padding and skipped below.
+        self.preds = np.zeros((num_examples, max_seq_length), dtype=np.int64)
+        self.out_label_ids = np.full((num_examples, max_seq_length), pad_token_label_id, dtype=np.int64)
+        # Probabilities are only kept for the predicted (not padding) tokens of every batch.
+        self.probabilities = []
+        self.window_merger = None
+        if eval_dataset.window_example_ids is not None:
+            # Long examples are split into overlapping windows, the logits of all windows of an example are averaged.
+            self.window_merger = WindowLogitsMerger(
+                eval_dataset.window_example_ids,
+                eval_dataset.window_label_starts,
+                eval_dataset.label_counts,
+                len(labels),
+                pad_token_label_id,
+            )
+        self.examples_done = 0
+
+    def add(self, logits, label_ids):
+        batch_size, seq_length = label_ids.shape
+        if self.window_merger is not None:
+            self.window_merger.add(self.examples_done, logits.float().cpu().numpy(), label_ids.cpu().numpy())
+        else:
+            batch_slice = slice(self.examples_done, self.examples_done + batch_size)
+            self.preds[batch_slice, :seq_length] = logits.argmax(dim=2).cpu().numpy()
+            self.out_label_ids[batch_slice, :seq_length] = label_ids.cpu().numpy()
+            if self.return_probabilities:
+                batch_real_tokens_mask = label_ids != self.pad_token_label_id
+                probabilities = torch.softmax(logits.float(), dim=2)[batch_real_tokens_mask]
+                self.probabilities.append(probabilities.cpu().numpy())
+        self.examples_done += batch_size
+
+    def finish(self):
+        """ Returns (metrics, preds_list, probabilities), probabilities is None unless return_probabilities is set. """
+        preds = self.preds
+        out_label_ids = self.out_label_ids
+        probabilities = self.probabilities
+        if self.window_merger is not None:
+            merged_logits, out_label_ids, real_tokens_mask = self.window_merger.merged()
+            preds = np.zeros(out_label_ids.shape, dtype=np.int64)
+            preds[real_tokens_mask] = merged_logits.argmax(axis=1)
+            if self.return_probabilities:
+                exp_logits = np.exp(merged_logits - merged_logits.max(axis=1, keepdims=True))
+                probabilities = [exp_logits / exp_logits.sum(axis=1, keepdims=True)]
+        else:
+            real_tokens_mask = out_label_ids != self.pad_token_label_id
+        preds_list = decode_label_ids(preds, self.labels, real_tokens_mask)
+        precision, recall, f1 = span_precision_recall_f1(out_label_ids, preds, self.labels, real_tokens_mask)
+
+        if not self.return_probabilities:
+            probabilities = None
+        elif probabilities:
+            probabilities = np.concatenate(probabilities)
+        else:
+            probabilities = np.zeros((0, len(self.labels)), np.float32)
+        return {"precision": precision, "recall": recall, "f1": f1}, preds_list, probabilities
+
+
+def evaluate(args, model, tokenizer, labels, pad_token_label_id, mode, prefix="", return_probabilities=False,
+             eval_dataset=None):
+    """ Returns (results, preds_list, probabilities).
+
+        probabilities is None unless return_probabilities is set, then it's a (number of predicted tokens, number of
+        labels) array of softmax probabilities in the order of the flattened preds_list.
+        eval_dataset is loaded with load_and_cache_examples unless it's already given.
+    """
+    if eval_dataset is None:
+        eval_dataset = load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode=mode)
 
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
     # Note that DistributedSampler samples randomly
     eval_sampler = SequentialSampler(eval_dataset) if args.local_rank == -1 else DistributedSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
+    eval_dataloader = DataLoader(
+        eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size, collate_fn=eval_dataset.pad_batch
+    )
 
     # multi-gpu evaluate
     if args.n_gpu > 1:
@@ -272,10 +389,14 @@ def evaluate(args, model, tokenizer, labels, pad_token_label_id, mode, prefix=""
     logger.info("  Batch size = %d", args.eval_batch_size)
     eval_loss = 0.0
     nb_eval_steps = 0
-    preds = None
-    out_label_ids = None
+    predictions = EvalPredictions(
+        eval_dataset, len(eval_sampler), args.max_seq_length, labels, pad_token_label_id, return_probabilities
+    )
+    profiler = StepProfiler(args.profile_steps, args.profile_dir, "evaluate_{}{}".format(mode, prefix))
+    mixed_precision = MixedPrecision(args.precision, args.device)
+    eval_stats = LoopStats(args.device)
     model.eval()
-    for batch in tqdm(eval_dataloader, desc="Evaluating"):
+    for batch in profiler.iterate(tqdm(eval_dataloader, desc="Evaluating")):
         batch = tuple(t.to(args.device) for t in batch)
 
         with torch.no_grad():
@@ -284,7 +405,8 @@ def evaluate(args, model, tokenizer, labels, pad_token_label_id, mode, prefix=""
                 inputs["token_type_ids"] = (
                     batch[2] if args.model_type in ["bert", "xlnet"] else None
                 )  # XLM and RoBERTa don"t use segment_ids
-            outputs = model(**inputs)
+            with profiler.span("forward"), mixed_precision.autocast():
+                outputs = model(**inputs)
             tmp_eval_loss, logits = outputs[:2]
 
             if args.n_gpu > 1:
@@ -292,59 +414,131 @@ def evaluate(args, model, tokenizer, labels, pad_token_label_id, mode, prefix=""
 
             eval_loss += tmp_eval_loss.item()
         nb_eval_steps += 1
-        if preds is None:
-            preds = logits.detach().cpu().numpy()
-            out_label_ids = inputs["labels"].detach().cpu().numpy()
-        else:
-            preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
-            out_label_ids = np.append(out_label_ids, inputs["labels"].detach().cpu().numpy(), axis=0)
+        with profiler.span("metrics"):
+            predictions.add(logits, inputs["labels"])
+        eval_stats.batch_done()
 
     eval_loss = eval_loss / nb_eval_steps
-    preds = np.argmax(preds, axis=2)
-
-    label_map = {i: label for i, label in enumerate(labels)}
-
-    out_label_list = [[] for _ in range(out_label_ids.shape[0])]
-    preds_list = [[] for _ in range(out_label_ids.shape[0])]
-
-    for i in range(out_label_ids.shape[0]):
-        for j in range(out_label_ids.shape[1]):
-            if out_label_ids[i, j] != pad_token_label_id:
-                out_label_list[i].append(label_map[out_label_ids[i][j]])
-                preds_list[i].append(label_map[preds[i][j]])
+    eval_stats.log(len(eval_sampler), "Evaluation {}".format(prefix))
+    with profiler.span("metrics"):
+        metrics, preds_list, probabilities = predictions.finish()
+    profiler.stop()
 
     results = {
         "loss": eval_loss,
-        "precision": precision_score(out_label_list, preds_list),
-        "recall": recall_score(out_label_list, preds_list),
-        "f1": f1_score(out_label_list, preds_list),
+        **metrics,
     }
 
     logger.info("***** Eval results %s *****", prefix)
     for key in sorted(results.keys()):
         logger.info("  %s = %s", key, str(results[key]))
 
-    return results, preds_list
+    return results, preds_list, probabilities
+
+
+def evaluate_ensemble(args, models, tokenizer, labels, pad_token_label_id, mode, eval_dataset=None):
+    """ Evaluates every model and the ensemble averaging their logits in a single pass over the data.
+
+        Every batch is moved to the device once and run through all models back to back, so K models (e.g. the
+        seeds of one configuration) cost one data pass instead of K. Returns (member results, ensemble results,
+        member preds_lists, ensemble preds_list).
+    """
+    if eval_dataset is None:
+        eval_dataset = load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode=mode)
+
+    args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
+    eval_sampler = SequentialSampler(eval_dataset)
+    eval_dataloader = DataLoader(
+        eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size, collate_fn=eval_dataset.pad_batch
+    )
+
+    logger.info("***** Running ensemble evaluation of %d models *****", len(models))
+    logger.info("  Num examples = %d", len(eval_dataset))
+    logger.info("  Batch size = %d", args.eval_batch_size)
+    member_losses = [0.0] * len(models)
+    ensemble_loss = 0.0
+    nb_eval_steps = 0
+    member_predictions = [
+        EvalPredictions(eval_dataset, len(eval_sampler), args.max_seq_length, labels, pad_token_label_id)
+        for _ in models
+    ]
+    ensemble_predictions = EvalPredictions(
+        eval_dataset, len(eval_sampler), args.max_seq_length, labels, pad_token_label_id
+    )
+    loss_function = CrossEntropyLoss(ignore_index=pad_token_label_id)
+    mixed_precision = MixedPrecision(args.precision, args.device)
+    eval_stats = LoopStats(args.device)
+    for model in models:
+        model.eval()
+    for batch in tqdm(eval_dataloader, desc="Evaluating"):
+        batch = tuple(t.to(args.device) for t in batch)
+
+        with torch.no_grad():
+            inputs = {"input_ids": batch[0], "attention_mask": batch[1], "labels": batch[3]}
+            if args.model_type != "distilbert":
+                inputs["token_type_ids"] = (
+                    batch[2] if args.model_type in ["bert", "xlnet"] else None
+                )  # XLM and RoBERTa don"t use segment_ids
+            logits_sum = None
+            for i, model in enumerate(models):
+                with mixed_precision.autocast():
+                    tmp_eval_loss, logits = model(**inputs)[:2]
+                member_losses[i] += tmp_eval_loss.item()
+                member_predictions[i].add(logits, inputs["labels"])
+                logits_sum = logits.float() if logits_sum is None else logits_sum + logits.float()
+            ensemble_logits = logits_sum / len(models)
+            ensemble_loss += loss_function(ensemble_logits.view(-1, len(labels)), inputs["labels"].view(-1)).item()
+        nb_eval_steps += 1
+        ensemble_predictions.add(ensemble_logits, inputs["labels"])
+        eval_stats.batch_done()
+
+    eval_stats.log(len(eval_sampler), "Ensemble evaluation")
+    member_results = []
+    member_preds_lists = []
+    for loss, predictions in zip(member_losses, member_predictions):
+        metrics, preds_list, _ = predictions.finish()
+        member_results.append({"loss": loss / nb_eval_steps, **metrics})
+        member_preds_lists.append(preds_list)
+    metrics, ensemble_preds_list, _ = ensemble_predictions.finish()
+    ensemble_results = {"loss": ensemble_loss / nb_eval_steps, **metrics}
+
+    logger.info("***** Ensemble eval results *****")
+    for i, results in enumerate(member_results):
+        logger.info("  model %d: f1 = %s", i, str(results["f1"]))
+    for key in sorted(ensemble_results.keys()):
+        logger.info("  ensemble %s = %s", key, str(ensemble_results[key]))
+
+    return member_results, ensemble_results, member_preds_lists, ensemble_preds_list
 
 
 def load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode):
     if args.local_rank not in [-1, 0] and not evaluate:
         torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
 
+    # Training examples are always truncated, evaluation examples may be split into overlapping windows
+    window_stride = args.window_stride if mode != "train" else 0
     # Load data features from cache or dataset file
-    cached_features_file = os.path.join(
+    cached_features_dir = os.path.join(
         args.data_dir,
-        "cached_{}_{}_{}".format(
-            mode, list(filter(None, args.model_name_or_path.split("/"))).pop(), str(args.max_seq_length)
+        "cached_{}_{}_{}{}_bin".format(
+            mode,
+            list(filter(None, args.model_name_or_path.split("/"))).pop(),
+            str(args.max_seq_length),
+            "_stride{}".format(window_stride) if window_stride else "",
         ),
     )
-    if os.path.exists(cached_features_file) and not args.overwrite_cache:
-        logger.info("Loading features from cached file %s", cached_features_file)
-        features = torch.load(cached_features_file)
+    if os.path.exists(cached_features_dir) and not args.overwrite_cache:
+        logger.info("Loading features from cached dir %s", cached_features_dir)
+        arrays = load_arrays(cached_features_dir)
     else:
         logger.info("Creating features from dataset file at %s", args.data_dir)
         examples = read_examples_from_file(args.data_dir, mode)
-        features = convert_examples_to_features(
+        # Fast (Rust) tokenizers can tokenize all words of many examples in one call
+        if isinstance(tokenizer, PreTrainedTokenizerFast):
+            convert_function = convert_examples_to_features_batched
+        else:
+            convert_function = convert_examples_to_features
+        features = convert_function(
             examples,
             labels,
             args.max_seq_length,
@@ -361,26 +555,37 @@ def load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode):
             pad_token=tokenizer.pad_token_id,
             pad_token_segment_id=tokenizer.pad_token_type_id,
             pad_token_label_id=pad_token_label_id,
-            use_i_token_instead_of_pad_for_next_tokens=mode != 'test'
+            use_i_token_instead_of_pad_for_next_tokens=mode != 'test',
+            window_stride=window_stride,
+        )
+        arrays = features_to_arrays(
+            input_ids=[f.input_ids for f in features],
+            attention_mask=[f.input_mask for f in features],
+            token_type_ids=[f.segment_ids for f in features],
+            labels=[f.label_ids for f in features],
+            window_example_ids=[f.example_id for f in features] if window_stride else None,
+            window_label_starts=[f.window_label_start for f in features] if window_stride else None,
         )
         if args.local_rank in [-1, 0]:
-            logger.info("Saving features into cached file %s", cached_features_file)
-            torch.save(features, cached_features_file)
+            logger.info("Saving features into cached dir %s", cached_features_dir)
+            save_arrays(cached_features_dir, arrays)
 
     if args.local_rank == 0 and not evaluate:
         torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
 
-    # Convert to Tensors and build dataset
-    all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-    all_input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
-    all_segment_ids = torch.tensor([f.segment_ids for f in features], dtype=torch.long)
-    all_label_ids = torch.tensor([f.label_ids for f in features], dtype=torch.long)
-
-    dataset = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
+    dataset = BinaryFeaturesDataset(
+        arrays,
+        args.max_seq_length,
+        pad_token_id=tokenizer.pad_token_id,
+        pad_token_segment_id=tokenizer.pad_token_type_id,
+        pad_token_label_id=pad_token_label_id,
+        pad_on_left=bool(args.model_type in ["xlnet"]),
+        pad_to_max_length=not args.dynamic_padding,
+    )
     return dataset
 
 
-def main():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
 
     # Required parameters
@@ -442,9 +647,29 @@ def main():
         help="The maximum total input sequence length after tokenization. Sequences longer "
              "than this will be truncated, sequences shorter will be padded.",
     )
+    parser.add_argument(
+        "--window_stride",
+        default=0,
+        type=int,
+        help="Split dev and test sentences longer than max_seq_length into overlapping windows starting every "
+             "window_stride tokens and average the logits of the overlapping tokens instead of truncating them.",
+    )
     parser.add_argument("--do_train", action="store_true", help="Whether to run training.")
     parser.add_argument("--do_eval", action="store_true", help="Whether to run eval on the dev set.")
     parser.add_argument("--do_predict", action="store_true", help="Whether to run predictions on the test set.")
+    parser.add_argument(
+        "--save_prediction_probabilities",
+        action="store_true",
+        help="With --do_predict, also save test_predictions.npz with the label probabilities of every predicted word.",
+    )
+    parser.add_argument(
+        "--ensemble_model_dirs",
+        nargs="+",
+        default=None,
+        help="Fine-tuned models, e.g. the seeds of one configuration, evaluated by --do_eval and --do_predict instead "
+             "of the model in output_dir. All models and the ensemble averaging their logits are evaluated in a "
+             "single pass over the data, results are written to {dev,test}_ensemble_results.txt in output_dir.",
+    )
     parser.add_argument(
         "--evaluate_during_training",
         action="store_true",
@@ -459,7 +684,28 @@ def main():
     parser.add_argument(
         "--strip_accents", action="store_const", const=True, help="Set this flag if model is trained without accents."
     )
-    parser.add_argument("--use_fast", action="store_const", const=True, help="Set this flag to use fast tokenization.")
+    parser.add_argument(
+        "--use_fast",
+        action="store_const",
+        const=True,
+        help="Set this flag to use fast tokenization. Features are then converted in batches.",
+    )
+    parser.add_argument(
+        "--dynamic_padding",
+        action="store_true",
+        help="Pad every batch only to its longest sequence instead of max_seq_length.",
+    )
+    parser.add_argument(
+        "--length_bucketing",
+        action="store_true",
+        help="Put training examples of similar length in the same batch. Most useful with --dynamic_padding.",
+    )
+    parser.add_argument(
+        "--bucket_size_multiplier",
+        default=100,
+        type=int,
+        help="Number of batches in a single length bucket for --length_bucketing.",
+    )
     parser.add_argument("--per_gpu_train_batch_size", default=8, type=int, help="Batch size per GPU/CPU for training.")
     parser.add_argument(
         "--per_gpu_eval_batch_size", default=8, type=int, help="Batch size per GPU/CPU for evaluation."
@@ -503,21 +749,41 @@ def main():
     parser.add_argument("--seed", type=int, default=42, help="random seed for initialization")
 
     parser.add_argument(
-        "--fp16",
-        action="store_true",
-        help="Whether to use 16-bit (mixed) precision (through NVIDIA apex) instead of 32-bit",
+        "--precision",
+        choices=PRECISIONS,
+        default="fp32",
+        help="Precision of the forward and backward passes with torch.autocast: fp16 (CUDA only, with loss scaling) "
+             "or bf16 (CUDA or CPU), weights stay in fp32.",
     )
     parser.add_argument(
-        "--fp16_opt_level",
+        "--profile_steps",
+        type=parse_profile_steps,
+        default=None,
+        help="START:END range of steps of every training and evaluation loop to profile with torch.profiler.",
+    )
+    parser.add_argument(
+        "--profile_dir",
         type=str,
-        default="O1",
-        help="For fp16: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
-             "See details at https://nvidia.github.io/apex/amp.html",
+        default=None,
+        help="Where to write the Chrome traces and operator summaries of --profile_steps, output_dir/profile by "
+             "default.",
     )
     parser.add_argument("--local_rank", type=int, default=-1, help="For distributed training: local_rank")
     parser.add_argument("--server_ip", type=str, default="", help="For distant debugging.")
     parser.add_argument("--server_port", type=str, default="", help="For distant debugging.")
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+
+    # Windows leave room for up to 3 special tokens, a larger stride would skip the tokens between two windows
+    if args.window_stride < 0 or args.window_stride > args.max_seq_length - 3:
+        raise ValueError("window_stride must be between 0 and max_seq_length - 3 ({}), got {}".format(
+            args.max_seq_length - 3, args.window_stride))
+    if args.profile_dir is None:
+        args.profile_dir = os.path.join(args.output_dir, "profile")
+    return args
+
+
+def main():
+    args = parse_args()
 
     if (
             os.path.exists(args.output_dir)
@@ -558,12 +824,12 @@ def main():
         level=logging.INFO if args.local_rank in [-1, 0] else logging.WARN,
     )
     logger.warning(
-        "Process rank: %s, device: %s, n_gpu: %s, distributed training: %s, 16-bits training: %s",
+        "Process rank: %s, device: %s, n_gpu: %s, distributed training: %s, precision: %s",
         args.local_rank,
         device,
         args.n_gpu,
         bool(args.local_rank != -1),
-        args.fp16,
+        args.precision,
     )
 
     # Set seed
@@ -634,6 +900,33 @@ def main():
 
     # Evaluation
     results = {}
+    if args.ensemble_model_dirs and args.local_rank in [-1, 0]:
+        os.makedirs(args.output_dir, exist_ok=True)
+        tokenizer = AutoTokenizer.from_pretrained(args.ensemble_model_dirs[0], **tokenizer_args)
+        models = [
+            AutoModelForTokenClassification.from_pretrained(model_dir).to(args.device)
+            for model_dir in args.ensemble_model_dirs
+        ]
+        for mode in (["dev"] if args.do_eval else []) + (["test"] if args.do_predict else []):
+            member_results, ensemble_results, _, ensemble_predictions = evaluate_ensemble(
+                args, models, tokenizer, labels, pad_token_label_id, mode=mode
+            )
+            result = {"ensemble_{}".format(k): v for k, v in ensemble_results.items()}
+            for model_dir, member_result in zip(args.ensemble_model_dirs, member_results):
+                model_name = os.path.basename(os.path.normpath(model_dir))
+                result.update({"{}_{}".format(model_name, k): v for k, v in member_result.items()})
+            with open(os.path.join(args.output_dir, "{}_ensemble_results.txt".format(mode)), "w") as writer:
+                for key in sorted(result.keys()):
+                    writer.write("{} = {}\n".format(key, str(result[key])))
+            if mode == "test":
+                write_predictions_to_file(
+                    os.path.join(args.data_dir, "test.txt"),
+                    os.path.join(args.output_dir, "test_ensemble_predictions.txt"),
+                    ensemble_predictions,
+                )
+            results.update({"{}_{}".format(mode, k): v for k, v in result.items()})
+        return results
+
     if args.do_eval and args.local_rank in [-1, 0]:
         tokenizer = AutoTokenizer.from_pretrained(args.output_dir, **tokenizer_args)
         checkpoints = [args.output_dir]
@@ -647,7 +940,7 @@ def main():
             global_step = checkpoint.split("-")[-1] if len(checkpoints) > 1 else ""
             model = AutoModelForTokenClassification.from_pretrained(checkpoint)
             model.to(args.device)
-            result, _ = evaluate(args, model, tokenizer, labels, pad_token_label_id, mode="dev", prefix=global_step)
+            result, _, _ = evaluate(args, model, tokenizer, labels, pad_token_label_id, mode="dev", prefix=global_step)
             if global_step:
                 result = {"{}_{}".format(global_step, k): v for k, v in result.items()}
             results.update(result)
@@ -660,7 +953,10 @@ def main():
         tokenizer = AutoTokenizer.from_pretrained(args.output_dir, **tokenizer_args)
         model = AutoModelForTokenClassification.from_pretrained(args.output_dir)
         model.to(args.device)
-        result, predictions = evaluate(args, model, tokenizer, labels, pad_token_label_id, mode="test")
+        result, predictions, probabilities = evaluate(
+            args, model, tokenizer, labels, pad_token_label_id, mode="test",
+            return_probabilities=args.save_prediction_probabilities,
+        )
         # Save results
         output_test_results_file = os.path.join(args.output_dir, "test_results.txt")
         with open(output_test_results_file, "w") as writer:
@@ -668,19 +964,16 @@ def main():
                 writer.write("{} = {}\n".format(key, str(result[key])))
         # Save predictions
         output_test_predictions_file = os.path.join(args.output_dir, "test_predictions.txt")
-        with open(output_test_predictions_file, "w") as writer:
-            with open(os.path.join(args.data_dir, "test.txt"), "r") as f:
-                example_id = 0
-                for line in f:
-                    if line.startswith("-DOCSTART-") or line == "" or line == "\n":
-                        writer.write(line)
-                        if not predictions[example_id]:
-                            example_id += 1
-                    elif predictions[example_id]:
-                        output_line = line.split()[0] + " " + predictions[example_id].pop(0) + "\n"
-                        writer.write(output_line)
-                    else:
-                        logger.warning("Maximum sequence length exceeded: No prediction for '%s'.", line.split()[0])
+        write_predictions_to_file(os.path.join(args.data_dir, "test.txt"), output_test_predictions_file, predictions)
+        if args.save_prediction_probabilities:
+            output_test_probabilities_file = os.path.join(args.output_dir, "test_predictions.npz")
+            save_prediction_probabilities(
+                output_test_probabilities_file,
+                read_examples_from_file(args.data_dir, "test"),
+                predictions,
+                probabilities,
+                labels,
+            )
 
     return results
 
@@ -16,12 +16,17 @@
 """ Named entity recognition fine-tuning: utilities to work with CoNLL-2003 task. """
 
 
+import itertools
 import logging
 import os
 
+import numpy as np
+
 
 logger = logging.getLogger(__name__)
 
+WRITE_BUFFER_SIZE = 2 ** 20
+
 
 class InputExample(object):
     """A single training/test example for token classification."""
@@ -43,11 +48,14 @@ class InputExample(object):
 class InputFeatures(object):
     """A single set of features of data."""
 
-    def __init__(self, input_ids, input_mask, segment_ids, label_ids):
+    def __init__(self, input_ids, input_mask, segment_ids, label_ids, example_id=None, window_label_start=0):
         self.input_ids = input_ids
         self.input_mask = input_mask
         self.segment_ids = segment_ids
         self.label_ids = label_ids
+        # With overlapping windows, the example the window belongs to and the number of labeled tokens before it
+        self.example_id = example_id
+        self.window_label_start = window_label_start
 
 
 def read_examples_from_file(data_dir, mode):
@@ -77,6 +85,62 @@ def read_examples_from_file(data_dir, mode):
     return examples
 
 
+def write_predictions_to_file(input_file_path, output_file_path, predictions):
+    """ Copies the CoNLL file at `input_file_path` replacing the label of every word by its prediction.
+
+        The predictions are read with cursors, so this is linear in the size of the file.
+    """
+    example_id = 0
+    token_id = 0
+    with open(input_file_path, "r") as f, open(output_file_path, "w", buffering=WRITE_BUFFER_SIZE) as writer:
+        for line in f:
+            example_predictions = predictions[example_id] if example_id < len(predictions) else []
+            if line.startswith("-DOCSTART-") or line == "" or line == "\n":
+                writer.write(line)
+                if token_id >= len(example_predictions):
+                    example_id += 1
+                    token_id = 0
+            elif token_id < len(example_predictions):
+                writer.write(line.split()[0] + " " + example_predictions[token_id] + "\n")
+                token_id += 1
+            else:
+                logger.warning("Maximum sequence length exceeded: No prediction for '%s'.", line.split()[0])
+
+
+def save_prediction_probabilities(output_file_path, examples, predictions, probabilities, label_list):
+    """ Saves a columnar .npz dump with one row per predicted word.
+
+        `probabilities` is a (number of predicted words, number of labels) array in the order of `predictions`.
+        The dump has the arrays: example_ids, word_ids, words, predicted_label_ids, probabilities and labels.
+    """
+    label_map = {label: i for i, label in enumerate(label_list)}
+    lengths = np.array([len(example_predictions) for example_predictions in predictions], dtype=np.int64)
+    example_starts = np.cumsum(lengths) - lengths
+    words = [word for example, example_predictions in zip(examples, predictions)
+             for word in example.words[: len(example_predictions)]]
+    np.savez(
+        output_file_path,
+        example_ids=np.repeat(np.arange(len(predictions), dtype=np.int32), lengths),
+        word_ids=(np.arange(lengths.sum()) - np.repeat(example_starts, lengths)).astype(np.int32),
+        words=np.array(words, dtype=str),
+        predicted_label_ids=np.array(
+            [label_map[label] for example_predictions in predictions for label in example_predictions], dtype=np.int16
+        ),
+        probabilities=probabilities.astype(np.float32),
+        labels=np.array(label_list, dtype=str),
+    )
+
+
+def window_starts(num_tokens, window_size, stride):
+    """ Starts of the windows of `window_size` tokens, `stride` tokens apart, that cover all `num_tokens` tokens.
+        The last window is moved back to end at the last token. Without a stride there is only the first window,
+        so the tokens after it are truncated.
+    """
+    if not stride or num_tokens <= window_size:
+        return [0]
+    return list(range(0, num_tokens - window_size, stride)) + [num_tokens - window_size]
+
+
 def convert_examples_to_features(
     examples,
     label_list,
@@ -94,12 +158,15 @@ def convert_examples_to_features(
     sequence_a_segment_id=0,
     mask_padding_with_zero=True,
     use_i_token_instead_of_pad_for_next_tokens=True,
+    window_stride=0,
 ):
     """ Loads a data file into a list of `InputBatch`s
         `cls_token_at_end` define the location of the CLS token:
             - False (Default, BERT/XLM pattern): [CLS] + A + [SEP] + B + [SEP]
             - True (XLNet/GPT pattern): A + [SEP] + B + [SEP] + [CLS]
         `cls_token_segment_id` define the segment id associated to the CLS token (0 for BERT, 2 for XLNet)
+        `window_stride` splits examples longer than `max_seq_length` into overlapping windows `window_stride`
+        tokens apart instead of truncating them, every window is a separate feature.
     """
 
     label_map = {label: i for i, label in enumerate(label_list)}
@@ -126,84 +193,334 @@ def convert_examples_to_features(
 
         # Account for [CLS] and [SEP] with "- 2" and with "- 3" for RoBERTa.
         special_tokens_count = tokenizer.num_added_tokens()
-        if len(tokens) > max_seq_length - special_tokens_count:
-            tokens = tokens[: (max_seq_length - special_tokens_count)]
-            label_ids = label_ids[: (max_seq_length - special_tokens_count)]
-
-        # The convention in BERT is:
-        # (a) For sequence pairs:
-        #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
-        #  type_ids:   0   0  0    0    0     0       0   0   1  1  1  1   1   1
-        # (b) For single sequences:
-        #  tokens:   [CLS] the dog is hairy . [SEP]
-        #  type_ids:   0   0   0   0  0     0   0
-        #
-        # Where "type_ids" are used to indicate whether this is the first
-        # sequence or the second sequence. The embedding vectors for `type=0` and
-        # `type=1` were learned during pre-training and are added to the wordpiece
-        # embedding vector (and position vector). This is not *strictly* necessary
-        # since the [SEP] token unambiguously separates the sequences, but it makes
-        # it easier for the model to learn the concept of sequences.
-        #
-        # For classification tasks, the first vector (corresponding to [CLS]) is
-        # used as as the "sentence vector". Note that this only makes sense because
-        # the entire model is fine-tuned.
-        tokens += [sep_token]
-        label_ids += [pad_token_label_id]
-        if sep_token_extra:
-            # roberta uses an extra separator b/w pairs of sentences
+        max_tokens_count = max_seq_length - special_tokens_count
+        example_tokens, example_label_ids = tokens, label_ids
+        for window_start in window_starts(len(example_tokens), max_tokens_count, window_stride):
+            tokens = example_tokens[window_start: window_start + max_tokens_count]
+            label_ids = example_label_ids[window_start: window_start + max_tokens_count]
+            window_label_start = sum(label_id != pad_token_label_id for label_id in example_label_ids[:window_start])
+
+            # The convention in BERT is:
+            # (a) For sequence pairs:
+            #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
+            #  type_ids:   0   0  0    0    0     0       0   0   1  1  1  1   1   1
+            # (b) For single sequences:
+            #  tokens:   [CLS] the dog is hairy . [SEP]
+            #  type_ids:   0   0   0   0  0     0   0
+            #
+            # Where "type_ids" are used to indicate whether this is the first
+            # sequence or the second sequence. The embedding vectors for `type=0` and
+            # `type=1` were learned during pre-training and are added to the wordpiece
+            # embedding vector (and position vector). This is not *strictly* necessary
+            # since the [SEP] token unambiguously separates the sequences, but it makes
+            # it easier for the model to learn the concept of sequences.
+            #
+            # For classification tasks, the first vector (corresponding to [CLS]) is
+            # used as as the "sentence vector". Note that this only makes sense because
+            # the entire model is fine-tuned.
             tokens += [sep_token]
             label_ids += [pad_token_label_id]
-        segment_ids = [sequence_a_segment_id] * len(tokens)
+            if sep_token_extra:
+                # roberta uses an extra separator b/w pairs of sentences
+                tokens += [sep_token]
+                label_ids += [pad_token_label_id]
+            segment_ids = [sequence_a_segment_id] * len(tokens)
 
-        if cls_token_at_end:
-            tokens += [cls_token]
-            label_ids += [pad_token_label_id]
-            segment_ids += [cls_token_segment_id]
-        else:
-            tokens = [cls_token] + tokens
-            label_ids = [pad_token_label_id] + label_ids
-            segment_ids = [cls_token_segment_id] + segment_ids
-
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-        # The mask has 1 for real tokens and 0 for padding tokens. Only real
-        # tokens are attended to.
-        input_mask = [1 if mask_padding_with_zero else 0] * len(input_ids)
-
-        # Zero-pad up to the sequence length.
-        padding_length = max_seq_length - len(input_ids)
-        if pad_on_left:
-            input_ids = ([pad_token] * padding_length) + input_ids
-            input_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + input_mask
-            segment_ids = ([pad_token_segment_id] * padding_length) + segment_ids
-            label_ids = ([pad_token_label_id] * padding_length) + label_ids
+            if cls_token_at_end:
+                tokens += [cls_token]
+                label_ids += [pad_token_label_id]
+                segment_ids += [cls_token_segment_id]
+            else:
+                tokens = [cls_token] + tokens
+                label_ids = [pad_token_label_id] + label_ids
+                segment_ids = [cls_token_segment_id] + segment_ids
+
+            input_ids = tokenizer.convert_tokens_to_ids(tokens)
+
+            # The mask has 1 for real tokens and 0 for padding tokens. Only real
+            # tokens are attended to.
+            input_mask = [1 if mask_padding_with_zero else 0] * len(input_ids)
+
+            # Zero-pad up to the sequence length.
+            padding_length = max_seq_length - len(input_ids)
+            if pad_on_left:
+                input_ids = ([pad_token] * padding_length) + input_ids
+                input_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + input_mask
+                segment_ids = ([pad_token_segment_id] * padding_length) + segment_ids
+                label_ids = ([pad_token_label_id] * padding_length) + label_ids
+            else:
+                input_ids += [pad_token] * padding_length
+                input_mask += [0 if mask_padding_with_zero else 1] * padding_length
+                segment_ids += [pad_token_segment_id] * padding_length
+                label_ids += [pad_token_label_id] * padding_length
+
+            assert len(input_ids) == max_seq_length
+            assert len(input_mask) == max_seq_length
+            assert len(segment_ids) == max_seq_length
+            assert len(label_ids) == max_seq_length
+
+            if ex_index < 5:
+                logger.info("*** Example ***")
+                logger.info("guid: %s", example.guid)
+                logger.info("tokens: %s", " ".join([str(x) for x in tokens]))
+                logger.info("input_ids: %s", " ".join([str(x) for x in input_ids]))
+                logger.info("input_mask: %s", " ".join([str(x) for x in input_mask]))
+                logger.info("segment_ids: %s", " ".join([str(x) for x in segment_ids]))
+                logger.info("label_ids: %s", " ".join([str(x) for x in label_ids]))
+
+            features.append(
+                InputFeatures(
+                    input_ids=input_ids,
+                    input_mask=input_mask,
+                    segment_ids=segment_ids,
+                    label_ids=label_ids,
+                    example_id=ex_index,
+                    window_label_start=window_label_start,
+                )
+            )
+    return features
+
+
+def convert_examples_to_features_batched(
+    examples,
+    label_list,
+    max_seq_length,
+    tokenizer,
+    cls_token_at_end=False,
+    cls_token="[CLS]",
+    cls_token_segment_id=1,
+    sep_token="[SEP]",
+    sep_token_extra=False,
+    pad_on_left=False,
+    pad_token=0,
+    pad_token_segment_id=0,
+    pad_token_label_id=-100,
+    sequence_a_segment_id=0,
+    mask_padding_with_zero=True,
+    use_i_token_instead_of_pad_for_next_tokens=True,
+    window_stride=0,
+    batch_size=1000,
+):
+    """ Same as `convert_examples_to_features`, but tokenizes all words of `batch_size` examples
+        with a single `batch_encode_plus` call (which runs in Rust for fast tokenizers) and
+        builds the label ids and the padding with numpy instead of per word Python lists.
+    """
+
+    label_map = {label: i for i, label in enumerate(label_list)}
+    cls_token_id, sep_token_id = tokenizer.convert_tokens_to_ids([cls_token, sep_token])
+    sep_token_ids = [sep_token_id, sep_token_id] if sep_token_extra else [sep_token_id]
+    # Account for [CLS] and [SEP] with "- 2" and with "- 3" for RoBERTa.
+    special_tokens_count = tokenizer.num_added_tokens()
+    max_tokens_count = max_seq_length - special_tokens_count
+
+    features = []
+    for batch_start in range(0, len(examples), batch_size):
+        logger.info("Writing example %d of %d", batch_start, len(examples))
+        batch_examples = examples[batch_start: batch_start + batch_size]
+
+        all_words = [word for example in batch_examples for word in example.words]
+        all_words_token_ids = tokenizer.batch_encode_plus(all_words, add_special_tokens=False)["input_ids"]
+        word_token_counts = np.fromiter((len(token_ids) for token_ids in all_words_token_ids), dtype=np.int64,
+                                        count=len(all_words_token_ids))
+        all_token_ids = np.fromiter(itertools.chain.from_iterable(all_words_token_ids), dtype=np.int64,
+                                    count=word_token_counts.sum())
+
+        # Use the real label id for the first token of the word, and padding ids for the remaining tokens
+        all_labels = [label for example in batch_examples for label in example.labels]
+        word_label_ids = np.array([label_map[label] for label in all_labels], dtype=np.int64)
+        if use_i_token_instead_of_pad_for_next_tokens:
+            word_next_label_ids = np.array([label_map[label.replace('B', 'I')] for label in all_labels],
+                                           dtype=np.int64)
         else:
-            input_ids += [pad_token] * padding_length
-            input_mask += [0 if mask_padding_with_zero else 1] * padding_length
-            segment_ids += [pad_token_segment_id] * padding_length
-            label_ids += [pad_token_label_id] * padding_length
-
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
-        assert len(label_ids) == max_seq_length
-
-        if ex_index < 5:
-            logger.info("*** Example ***")
-            logger.info("guid: %s", example.guid)
-            logger.info("tokens: %s", " ".join([str(x) for x in tokens]))
-            logger.info("input_ids: %s", " ".join([str(x) for x in input_ids]))
-            logger.info("input_mask: %s", " ".join([str(x) for x in input_mask]))
-            logger.info("segment_ids: %s", " ".join([str(x) for x in segment_ids]))
-            logger.info("label_ids: %s", " ".join([str(x) for x in label_ids]))
-
-        features.append(
-            InputFeatures(input_ids=input_ids, input_mask=input_mask, segment_ids=segment_ids, label_ids=label_ids)
-        )
+            word_next_label_ids = np.full(len(all_labels), pad_token_label_id, dtype=np.int64)
+        # Words without tokens (e.g. bert-base-multilingual-cased on a space) disappear in np.repeat
+        is_first_word_token = np.zeros(len(all_token_ids), dtype=bool)
+        is_first_word_token[(np.cumsum(word_token_counts) - word_token_counts)[word_token_counts > 0]] = True
+        all_label_ids = np.where(is_first_word_token,
+                                 np.repeat(word_label_ids, word_token_counts),
+                                 np.repeat(word_next_label_ids, word_token_counts))
+
+        example_word_counts = np.array([len(example.words) for example in batch_examples], dtype=np.int64)
+        word_offsets = np.concatenate([[0], np.cumsum(word_token_counts)])
+        example_token_offsets = word_offsets[np.concatenate([[0], np.cumsum(example_word_counts)])]
+        # labeled_tokens_before[i] is the number of labeled tokens before the i-th token of the batch
+        labeled_tokens_before = np.concatenate([[0], np.cumsum(all_label_ids != pad_token_label_id)])
+
+        for i, example in enumerate(batch_examples):
+            example_start, example_end = example_token_offsets[i], example_token_offsets[i + 1]
+            for window_start in window_starts(example_end - example_start, max_tokens_count, window_stride):
+                start = example_start + window_start
+                end = min(example_end, start + max_tokens_count)
+                window_label_start = int(labeled_tokens_before[start] - labeled_tokens_before[example_start])
+
+                input_ids = all_token_ids[start:end].tolist() + sep_token_ids
+                label_ids = all_label_ids[start:end].tolist() + [pad_token_label_id] * len(sep_token_ids)
+                segment_ids = [sequence_a_segment_id] * len(input_ids)
+
+                if cls_token_at_end:
+                    input_ids += [cls_token_id]
+                    label_ids += [pad_token_label_id]
+                    segment_ids += [cls_token_segment_id]
+                else:
+                    input_ids = [cls_token_id] + input_ids
+                    label_ids = [pad_token_label_id] + label_ids
+                    segment_ids = [cls_token_segment_id] + segment_ids
+
+                # The mask has 1 for real tokens and 0 for padding tokens. Only real
+                # tokens are attended to.
+                input_mask = [1 if mask_padding_with_zero else 0] * len(input_ids)
+
+                # Zero-pad up to the sequence length.
+                padding_length = max_seq_length - len(input_ids)
+                if pad_on_left:
+                    input_ids = ([pad_token] * padding_length) + input_ids
+                    input_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + input_mask
+                    segment_ids = ([pad_token_segment_id] * padding_length) + segment_ids
+                    label_ids = ([pad_token_label_id] * padding_length) + label_ids
+                else:
+                    input_ids += [pad_token] * padding_length
+                    input_mask += [0 if mask_padding_with_zero else 1] * padding_length
+                    segment_ids += [pad_token_segment_id] * padding_length
+                    label_ids += [pad_token_label_id] * padding_length
+
+                if batch_start + i < 5:
+                    logger.info("*** Example ***")
+                    logger.info("guid: %s", example.guid)
+                    logger.info("input_ids: %s", " ".join([str(x) for x in input_ids]))
+                    logger.info("input_mask: %s", " ".join([str(x) for x in input_mask]))
+                    logger.info("segment_ids: %s", " ".join([str(x) for x in segment_ids]))
+                    logger.info("label_ids: %s", " ".join([str(x) for x in label_ids]))
+
+                features.append(
+                    InputFeatures(
+                        input_ids=input_ids,
+                        input_mask=input_mask,
+                        segment_ids=segment_ids,
+                        label_ids=label_ids,
+                        example_id=batch_start + i,
+                        window_label_start=window_label_start,
+                    )
+                )
     return features
 
 
+class WindowLogitsMerger(object):
+    """ Averages the logits of the overlapping windows of every example.
+
+        Only labeled positions (label id is not `pad_token_label_id`) are merged. The k-th labeled position of a window
+        is the (window_label_start + k)-th labeled position of its example.
+    """
+
+    def __init__(self, window_example_ids, window_label_starts, window_label_counts, num_labels, pad_token_label_id):
+        window_example_ids = np.asarray(window_example_ids, dtype=np.int64)
+        window_label_ends = np.asarray(window_label_starts, dtype=np.int64) + np.asarray(window_label_counts)
+        example_label_counts = np.zeros(window_example_ids.max() + 1 if len(window_example_ids) else 0, np.int64)
+        np.maximum.at(example_label_counts, window_example_ids, window_label_ends)
+
+        self.example_offsets = np.concatenate([[0], np.cumsum(example_label_counts)])
+        # Position of the first labeled token of every window among the labeled tokens of all examples
+        self.window_offsets = self.example_offsets[window_example_ids] + window_label_starts
+        self.pad_token_label_id = pad_token_label_id
+        self.logit_sums = np.zeros((self.example_offsets[-1], num_labels), dtype=np.float32)
+        self.window_counts = np.zeros(self.example_offsets[-1], dtype=np.int32)
+        self.label_ids = np.full(self.example_offsets[-1], pad_token_label_id, dtype=np.int64)
+
+    def add(self, first_window, logits, label_ids):
+        """ Adds the (batch size, sequence length, number of labels) logits of consecutive windows. """
+        mask = label_ids != self.pad_token_label_id
+        row_counts = mask.sum(axis=1)
+        row_starts = np.cumsum(row_counts) - row_counts
+        window_offsets = self.window_offsets[first_window: first_window + len(logits)]
+        positions = np.repeat(window_offsets - row_starts, row_counts) + np.arange(row_counts.sum())
+        np.add.at(self.logit_sums, positions, logits[mask])
+        np.add.at(self.window_counts, positions, 1)
+        self.label_ids[positions] = label_ids[mask]
+
+    def merged(self):
+        """ Returns (logits, label_ids, mask): the averaged logits of all labeled tokens one example after another,
+            and (number of examples, longest example) label ids and mask of the labeled tokens of every example.
+        """
+        logits = self.logit_sums / np.maximum(self.window_counts, 1)[:, None]
+        example_label_counts = np.diff(self.example_offsets)
+        max_label_count = example_label_counts.max() if len(example_label_counts) else 0
+        mask = np.arange(max_label_count)[None, :] < example_label_counts[:, None]
+        label_ids = np.full(mask.shape, self.pad_token_label_id, dtype=np.int64)
+        label_ids[mask] = self.label_ids
+        return logits, label_ids, mask
+
+
+def decode_label_ids(label_ids, label_list, mask):
+    """ Converts every row of `label_ids` to a list of label names, keeping only the positions where `mask` is set. """
+    label_names = np.asarray(label_list, dtype=object)[label_ids[mask]]
+    row_ends = np.cumsum(mask.sum(axis=1))
+    return [row.tolist() for row in np.split(label_names, row_ends[:-1])]
+
+
+def _get_entities(flat_label_ids, label_list, separator_id):
+    """ Vectorized version of seqeval's get_entities for a flat sequence of label ids.
+
+        Returns an array with a unique int64 key of every (type, start, end) entity.
+    """
+    # Same tag and type split as seqeval. The separator is an "O" and the type before the first label is "".
+    tags = [label[0] for label in label_list] + ["O"]
+    type_names = [label[1:].split("-", maxsplit=1)[-1] or "_" for label in label_list] + ["_"]
+    type_ids = {type_name: i for i, type_name in enumerate(sorted(set(type_names)))}
+    type_of_label = np.array([type_ids[type_name] for type_name in type_names] + [len(type_ids)])
+    tag_of_label = np.array(tags + ["O"])
+    no_type_label_id = len(label_list) + 1
+
+    tag = tag_of_label[flat_label_ids]
+    type_ = type_of_label[flat_label_ids]
+    prev_tag = tag_of_label[np.concatenate([[separator_id], flat_label_ids[:-1]])]
+    prev_type = type_of_label[np.concatenate([[no_type_label_id], flat_label_ids[:-1]])]
+    type_changed = prev_type != type_
+
+    is_end = (
+        np.isin(prev_tag, ["E", "S"])
+        | (np.isin(prev_tag, ["B", "I"]) & np.isin(tag, ["B", "S", "O"]))
+        | (~np.isin(prev_tag, ["O", "."]) & type_changed)
+    )
+    is_start = (
+        np.isin(tag, ["B", "S"])
+        | (np.isin(prev_tag, ["E", "S", "O"]) & np.isin(tag, ["E", "I"]))
+        | (~np.isin(tag, ["O", "."]) & type_changed)
+    )
+
+    positions = np.arange(len(flat_label_ids))
+    # An entity ending before position i started at the last start before i (or at 0 if there was none)
+    last_start = np.maximum.accumulate(np.where(is_start, positions, 0))
+    ends = np.nonzero(is_end)[0]
+    starts = np.concatenate([[0], last_start])[ends]
+    return (starts * len(flat_label_ids) + (ends - 1)) * (len(type_ids) + 1) + prev_type[ends]
+
+
+def span_precision_recall_f1(out_label_ids, preds, label_list, mask):
+    """ Entity level precision, recall and F1 score, identical to seqeval's precision_score, recall_score and
+        f1_score on the label sequences given by `decode_label_ids(..., mask)`, but without per token Python loops.
+    """
+    # Put all sentences one after another with an "O" after every sentence, the same as seqeval does
+    separator_id = len(label_list)
+    num_tokens = mask.sum()
+    row_of_token = np.nonzero(mask)[0]
+    token_positions = np.arange(num_tokens) + row_of_token
+    sequence_length = num_tokens + mask.shape[0] + 1
+
+    all_entities = []
+    for label_ids in (out_label_ids, preds):
+        flat_label_ids = np.full(sequence_length, separator_id, dtype=np.int64)
+        flat_label_ids[token_positions] = label_ids[mask]
+        all_entities.append(_get_entities(flat_label_ids, label_list, separator_id))
+    true_entities, pred_entities = all_entities
+
+    nb_correct = len(np.intersect1d(true_entities, pred_entities))
+    nb_pred = len(pred_entities)
+    nb_true = len(true_entities)
+    precision = nb_correct / nb_pred if nb_pred > 0 else 0.0
+    recall = nb_correct / nb_true if nb_true > 0 else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+    return precision, recall, f1
+
+
 def get_labels(path):
     if path:
         with open(path, "r") as f:
@@ -0,0 +1,202 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from utils_ner import (
+    InputExample,
+    WindowLogitsMerger,
+    convert_examples_to_features,
+    convert_examples_to_features_batched,
+    decode_label_ids,
+    read_examples_from_file,
+    save_prediction_probabilities,
+    span_precision_recall_f1,
+    window_starts,
+    write_predictions_to_file,
+)
+
+
+class CharTrigramTokenizer(object):
+    """Splits every word into 3 character word pieces, empty for '~'."""
+
+    VOCAB = {'[CLS]': 1, '[SEP]': 2}
+
+    def tokenize(self, word):
+        if word == '~':
+            return []
+        return [word[i:i + 3] if i == 0 else '##' + word[i:i + 3] for i in range(0, len(word), 3)]
+
+    def convert_tokens_to_ids(self, tokens):
+        return [self.VOCAB.get(token, sum(map(ord, token))) for token in tokens]
+
+    def num_added_tokens(self):
+        return 2
+
+    def batch_encode_plus(self, words, add_special_tokens):
+        return {'input_ids': [self.convert_tokens_to_ids(self.tokenize(word)) for word in words]}
+
+
+class ConvertExamplesToFeaturesBatchedTestCase(unittest.TestCase):
+    LABELS = ['O', 'B-DOX', 'I-DOX', 'B-INV', 'I-INV']
+
+    def setUp(self):
+        words = [
+            ['A', 'cat', 'maybe', 'does', 'a', 'barrel', 'roll'],
+            [],
+            ['investigated', '~', 'roll'],
+            ['possibly', 'could', 'be', 'considered', 'uncertain', 'sentence'],
+        ]
+        labels = [
+            ['O', 'O', 'B-DOX', 'O', 'O', 'O', 'O'],
+            [],
+            ['B-INV', 'O', 'O'],
+            ['B-DOX', 'I-DOX', 'O', 'B-INV', 'O', 'O'],
+        ]
+        self.examples = [InputExample(guid='test-{}'.format(i), words=example_words, labels=example_labels)
+                         for i, (example_words, example_labels) in enumerate(zip(words, labels))]
+
+    def assertSameFeatures(self, max_seq_length, **kwargs):
+        expected_features = convert_examples_to_features(
+            self.examples, self.LABELS, max_seq_length, CharTrigramTokenizer(), **kwargs)
+        actual_features = convert_examples_to_features_batched(
+            self.examples, self.LABELS, max_seq_length, CharTrigramTokenizer(), batch_size=3, **kwargs)
+        self.assertEqual([vars(f) for f in actual_features], [vars(f) for f in expected_features])
+
+    def test_batched_returns_same_features_with_i_tokens_for_next_tokens(self):
+        self.assertSameFeatures(32, use_i_token_instead_of_pad_for_next_tokens=True)
+
+    def test_batched_returns_same_features_with_pad_for_next_tokens(self):
+        self.assertSameFeatures(32, use_i_token_instead_of_pad_for_next_tokens=False)
+
+    def test_batched_returns_same_features_when_truncated(self):
+        self.assertSameFeatures(8)
+
+    def test_batched_returns_same_features_with_cls_at_end_and_left_padding(self):
+        self.assertSameFeatures(32, cls_token_at_end=True, cls_token_segment_id=2, pad_on_left=True)
+
+    def test_batched_returns_same_features_with_windows(self):
+        self.assertSameFeatures(8, window_stride=3)
+
+
+class WindowsTestCase(unittest.TestCase):
+    PAD = -100
+
+    def test_window_starts_cover_all_tokens(self):
+        self.assertEqual(window_starts(10, 4, 3), [0, 3, 6])
+        self.assertEqual(window_starts(11, 4, 3), [0, 3, 6, 7])
+        self.assertEqual(window_starts(4, 4, 3), [0])
+
+    def test_window_starts_without_stride_truncate(self):
+        self.assertEqual(window_starts(10, 4, 0), [0])
+
+    def test_windows_of_long_example(self):
+        examples = [InputExample(guid='test-0', words=['a', 'bb', 'cc', 'dd', 'e'],
+                                 labels=['O', 'B-X', 'I-X', 'O', 'O'])]
+        features = convert_examples_to_features(
+            examples, ['O', 'B-X', 'I-X'], 5, CharTrigramTokenizer(), window_stride=2, pad_token_label_id=self.PAD)
+        self.assertEqual([f.example_id for f in features], [0, 0])
+        self.assertEqual([f.window_label_start for f in features], [0, 2])
+        self.assertEqual([f.label_ids for f in features],
+                         [[self.PAD, 0, 1, 2, self.PAD], [self.PAD, 2, 0, 0, self.PAD]])
+
+    def test_merger_averages_overlapping_logits(self):
+        # Example 0 has 4 labeled tokens in windows [0, 3) and [1, 4), example 1 has a single window
+        merger = WindowLogitsMerger([0, 0, 1], [0, 1, 0], [3, 3, 2], 2, self.PAD)
+        label_ids = np.array([[self.PAD, 0, 1, 1], [self.PAD, 1, 1, 0], [self.PAD, 1, 0, self.PAD]])
+        logits = np.zeros((3, 4, 2), dtype=np.float32)
+        logits[0, 1:, 0] = [1, 2, 3]
+        logits[1, 1:, 0] = [5, 6, 7]
+        logits[2, 1:3, 1] = [8, 9]
+        merger.add(0, logits[:2], label_ids[:2])
+        merger.add(2, logits[2:], label_ids[2:])
+
+        merged_logits, merged_label_ids, mask = merger.merged()
+        np.testing.assert_array_equal(merged_logits[:, 0], [1, 3.5, 4.5, 7, 0, 0])
+        np.testing.assert_array_equal(merged_logits[:, 1], [0, 0, 0, 0, 8, 9])
+        np.testing.assert_array_equal(merged_label_ids, [[0, 1, 1, 0], [1, 0, self.PAD, self.PAD]])
+        np.testing.assert_array_equal(mask, [[True, True, True, True], [True, True, False, False]])
+
+
+class SpanMetricsTestCase(unittest.TestCase):
+    LABELS = ['O', 'B-DOX', 'I-DOX', 'B-INV', 'I-INV']
+    PAD = -100
+
+    def test_decode_label_ids_skips_padding(self):
+        label_ids = np.array([[self.PAD, 0, 1, 2, self.PAD], [self.PAD, 3, self.PAD, self.PAD, self.PAD]])
+        decoded = decode_label_ids(np.maximum(label_ids, 0), self.LABELS, label_ids != self.PAD)
+        self.assertEqual(decoded, [['O', 'B-DOX', 'I-DOX'], ['B-INV']])
+
+    def test_span_precision_recall_f1_counts_whole_spans(self):
+        out_label_ids = np.array([[0, 1, 2, 0], [3, 4, 0, self.PAD]])
+        # The first span is found, the second one has the wrong type
+        preds = np.array([[0, 1, 2, 0], [1, 2, 0, 0]])
+        precision, recall, f1 = span_precision_recall_f1(out_label_ids, preds, self.LABELS, out_label_ids != self.PAD)
+        self.assertEqual((precision, recall, f1), (0.5, 0.5, 0.5))
+
+    def test_span_precision_recall_f1_starts_span_on_i_tag_after_o(self):
+        out_label_ids = np.array([[0, 1, 2, 0]])
+        preds = np.array([[0, 2, 2, 0]])
+        precision, recall, f1 = span_precision_recall_f1(out_label_ids, preds, self.LABELS, out_label_ids != self.PAD)
+        self.assertEqual((precision, recall, f1), (1.0, 1.0, 1.0))
+
+    def test_span_precision_recall_f1_doesnt_join_spans_across_sentences(self):
+        out_label_ids = np.array([[0, 1], [2, 0]])
+        preds = np.array([[0, 1], [1, 0]])
+        precision, recall, f1 = span_precision_recall_f1(out_label_ids, preds, self.LABELS, out_label_ids != self.PAD)
+        self.assertEqual((precision, recall, f1), (1.0, 1.0, 1.0))
+
+    def test_span_precision_recall_f1_without_predicted_spans_is_zero(self):
+        out_label_ids = np.array([[0, 1, 2, 0]])
+        preds = np.zeros_like(out_label_ids)
+        precision, recall, f1 = span_precision_recall_f1(out_label_ids, preds, self.LABELS, out_label_ids != self.PAD)
+        self.assertEqual((precision, recall, f1), (0.0, 0.0, 0.0))
+
+
+class WritePredictionsTestCase(unittest.TestCase):
+    LABELS = ['O', 'B-DOX', 'I-DOX']
+    TEST_TXT = '-DOCSTART- O\n\nA O\ncat O\nmaybe B-DOX\n\nIt O\nmay B-DOX\nfly O\n\n'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.test_file_path = os.path.join(self.tmp_dir.name, 'test.txt')
+        with open(self.test_file_path, 'w') as f:
+            f.write(self.TEST_TXT)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _write_predictions(self, predictions):
+        output_file_path = os.path.join(self.tmp_dir.name, 'test_predictions.txt')
+        write_predictions_to_file(self.test_file_path, output_file_path, predictions)
+        with open(output_file_path) as f:
+            return f.read()
+
+    def test_write_predictions_replaces_labels(self):
+        output = self._write_predictions([['O', 'B-DOX', 'I-DOX'], ['B-DOX', 'O', 'O']])
+        self.assertEqual(output, '-DOCSTART- O\n\nA O\ncat B-DOX\nmaybe I-DOX\n\nIt B-DOX\nmay O\nfly O\n\n')
+
+    def test_write_predictions_skips_truncated_words(self):
+        with self.assertLogs('utils_ner', level='WARNING'):
+            output = self._write_predictions([['O', 'B-DOX'], ['B-DOX', 'O', 'O']])
+        self.assertEqual(output, '-DOCSTART- O\n\nA O\ncat B-DOX\n\nIt B-DOX\nmay O\nfly O\n\n')
+
+    def test_save_prediction_probabilities(self):
+        predictions = [['O', 'B-DOX'], ['B-DOX', 'O', 'O']]
+        probabilities = np.random.RandomState(0).rand(5, len(self.LABELS))
+        output_file_path = os.path.join(self.tmp_dir.name, 'test_predictions.npz')
+        examples = read_examples_from_file(self.tmp_dir.name, 'test')
+        save_prediction_probabilities(output_file_path, examples, predictions, probabilities, self.LABELS)
+
+        dump = np.load(output_file_path)
+        self.assertEqual(dump['example_ids'].tolist(), [0, 0, 1, 1, 1])
+        self.assertEqual(dump['word_ids'].tolist(), [0, 1, 0, 1, 2])
+        self.assertEqual(dump['words'].tolist(), ['A', 'cat', 'It', 'may', 'fly'])
+        self.assertEqual(dump['predicted_label_ids'].tolist(), [0, 1, 1, 0, 0])
+        np.testing.assert_allclose(dump['probabilities'], probabilities.astype(np.float32))
+        self.assertEqual(dump['labels'].tolist(), self.LABELS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,19 +13,39 @@ def _tokenizer_without_inside_word_splits(nlp):
                                      rules={})
 
 
+def _set_token_extensions():
+    if spacy.tokens.Token.has_extension('is_uncertain'):
+        return
+    spacy.tokens.Token.set_extension('is_uncertain', default=False)
+    spacy.tokens.Token.set_extension('uncertainty_type', default='')
+    spacy.tokens.Token.set_extension('uncertainty_span_idx', default=None)
+
+
 class SpacyNlpSingleton(object):
     instance = None
+    tokenizer_only_instance = None
 
     @classmethod
     def get(cls):
         if cls.instance is None:
             cls.instance = spacy.load("en_core_web_sm")
-            spacy.tokens.Token.set_extension('is_uncertain', default=False)
-            spacy.tokens.Token.set_extension('uncertainty_type', default='')
-            spacy.tokens.Token.set_extension('uncertainty_span_idx', default=None)
+            _set_token_extensions()
             cls.instance.tokenizer = _tokenizer_without_inside_word_splits(cls.instance)
         return cls.instance
 
+    @classmethod
+    def get_tokenizer_only(cls):
+        # A blank English pipeline has the same tokenizer punctuation rules as en_core_web_sm, but it doesn't
+        # load the tagger, parser and NER weights, so it starts faster and only tokenizes the text.
+        if cls.tokenizer_only_instance is None:
+            cls.tokenizer_only_instance = spacy.blank("en")
+            _set_token_extensions()
+            cls.tokenizer_only_instance.tokenizer = _tokenizer_without_inside_word_splits(
+                cls.tokenizer_only_instance)
+        return cls.tokenizer_only_instance
+
 
-def nlp():
+def nlp(tokenizer_only=False):
+    if tokenizer_only:
+        return SpacyNlpSingleton.get_tokenizer_only()
     return SpacyNlpSingleton.get()